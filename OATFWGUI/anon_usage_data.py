@@ -16,6 +16,7 @@ from pygments.formatters import HtmlFormatter
 from platform_check import get_platform, PlatformEnum
 from gui_state import LogicState
 from misc_utils import decode_bytes
+import network
 
 log = logging.getLogger('')
 
@@ -128,7 +129,7 @@ def upload_anon_stats(anon_stats: dict) -> bool:
     analytics_url = 'http://config.cloud.openastrotech.com/api/v1/config/'
     log.info(f'Uploading statistics to {analytics_url}')
     try:
-        r = requests.post(analytics_url, json=anon_stats, timeout=2.0)
+        r = network.post(analytics_url, json=anon_stats, timeout=2.0)
     except Exception as e:
         log.error(f'Failed to POST statistics: {e}')
         return False
@@ -200,7 +201,7 @@ def to_nearest_half(num: float) -> float:
 @lru_cache(maxsize=1)
 def get_approx_location() -> Tuple[float, float]:
     geo_ip_url = 'https://ipinfo.io/loc'
-    response = requests.get(geo_ip_url, timeout=2.0)
+    response = network.get(geo_ip_url, timeout=2.0)
     resp_str = decode_bytes(response.content).strip()
     lat_str, lon_str = resp_str.split(',')
     lat_approx = to_nearest_half(float(lat_str))
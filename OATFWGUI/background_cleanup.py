@@ -0,0 +1,104 @@
+import os
+import stat
+import time
+import uuid
+import logging
+import threading
+from pathlib import Path
+from typing import List, Optional, Callable
+
+from platform_check import get_platform, PlatformEnum
+
+log = logging.getLogger('')
+
+TOMBSTONE_PREFIX = '.oatfwguiTombstone_'
+# Stop deleting after this long, whatever is left over is deleted on the next launch
+CLEANUP_TIME_BUDGET_S = 60.0
+
+
+def tombstone_directory(dir_to_delete: Path, tombstone_parent: Optional[Path] = None) -> Optional[Path]:
+    """
+    Rename a directory out of the way so it is gone (as far as anything else is concerned)
+    straight away. The actual deletion is done later by delete_tombstones(tombstone_parent).
+    """
+    if tombstone_parent is None:
+        tombstone_parent = dir_to_delete.parent
+    tombstone_path = Path(tombstone_parent, f'{TOMBSTONE_PREFIX}{uuid.uuid4().hex[:8]}_{dir_to_delete.name}')
+    try:
+        dir_to_delete.rename(tombstone_path)
+    except OSError as e:
+        # i.e. something still has a file open in there on Windows
+        log.warning(f'Could not rename {dir_to_delete} for deletion: {e}')
+        return None
+    log.debug(f'Renamed {dir_to_delete} to {tombstone_path}')
+    return tombstone_path
+
+
+def _lower_thread_priority():
+    # Only Linux can set the priority of a single thread
+    if get_platform() != PlatformEnum.LINUX:
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError) as e:
+        log.debug(f'Could not lower cleanup thread priority: {e}')
+
+
+def _remove_path(path: str, is_dir: bool):
+    remove_fn = os.rmdir if is_dir else os.unlink
+    try:
+        remove_fn(path)
+    except PermissionError:
+        # Windows has a problem with deleting some git files
+        os.chmod(path, stat.S_IWRITE)
+        remove_fn(path)
+
+
+def delete_tombstones(parent_dir: Path, time_budget_s: float = CLEANUP_TIME_BUDGET_S) -> int:
+    """Delete tombstoned directories in parent_dir until the time budget runs out. Returns bytes reclaimed."""
+    start_time = time.monotonic()
+    reclaimed_bytes = 0
+    with os.scandir(parent_dir) as dir_entries:
+        tombstones = [Path(e.path) for e in dir_entries if e.name.startswith(TOMBSTONE_PREFIX) and e.is_dir()]
+    for tombstone in tombstones:
+        for dir_path, dir_names, file_names in os.walk(tombstone, topdown=False):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                try:
+                    reclaimed_bytes += os.lstat(file_path).st_size
+                    _remove_path(file_path, is_dir=False)
+                except OSError as e:
+                    log.debug(f'Could not delete {file_path}: {e}')
+            for dir_name in dir_names:
+                sub_dir_path = os.path.join(dir_path, dir_name)
+                try:
+                    # A symlink to a directory is removed like a file, never followed
+                    _remove_path(sub_dir_path, is_dir=not os.path.islink(sub_dir_path))
+                except OSError as e:
+                    log.debug(f'Could not delete {sub_dir_path}: {e}')
+            if time.monotonic() - start_time > time_budget_s:
+                log.info(f'Cleanup time budget ({time_budget_s}s) used up, continuing next launch. '
+                         f'Reclaimed {reclaimed_bytes / 1e6:.1f}MB so far')
+                return reclaimed_bytes
+        try:
+            _remove_path(str(tombstone), is_dir=True)
+        except OSError as e:
+            log.debug(f'Could not delete {tombstone}: {e}')
+    log.info(f'Cleanup of {len(tombstones)} old directories finished in {time.monotonic() - start_time:.1f}s, '
+             f'reclaimed {reclaimed_bytes / 1e6:.1f}MB')
+    return reclaimed_bytes
+
+
+def start_background_cleanup(parent_dirs: List[Path],
+                             before_cleanup: Optional[Callable[[], None]] = None) -> threading.Thread:
+    def cleanup_thread_fn():
+        _lower_thread_priority()
+        if before_cleanup is not None:
+            before_cleanup()
+        for parent_dir in parent_dirs:
+            delete_tombstones(parent_dir)
+
+    # Daemon, so that an unfinished cleanup never keeps the app from exiting
+    cleanup_thread = threading.Thread(target=cleanup_thread_fn, name='background_cleanup', daemon=True)
+    cleanup_thread.start()
+    return cleanup_thread
@@ -0,0 +1,238 @@
+import json
+import time
+import shutil
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, NamedTuple
+
+from _version import __version__
+from gui_state import FWVersion
+from pio_project import pio_env_is_avr_based
+from gui_logic import download_fw, extract_fw
+from fw_releases import list_fw_releases, FW_BRANCHES
+from fw_build import do_hot_patches, install_config_file, build_env, get_build_dir, run_platformio
+from build_cache import build_artifacts
+from build_jobs import get_total_build_jobs, benchmark_build_jobs, save_benchmark
+from external_processes import get_install_dir, get_platformio_version
+
+log = logging.getLogger('')
+
+
+class BatchJob(NamedTuple):
+    release: str
+    pio_env: str
+    config_file_path: Path
+    upload_port: Optional[str] = None
+
+
+class BatchError(Exception):
+    pass
+
+
+def read_manifest(manifest_path: Path) -> List[BatchJob]:
+    """
+    The manifest is a JSON list of jobs (or {"jobs": [...]}), each like
+    {"release": "V1.13.14", "env": "ramps", "config": "Configuration_local.hpp", "port": "COM3"}.
+    "port" is optional, without it the job only builds. Config paths are relative to the manifest.
+    """
+    with open(manifest_path, 'r') as fp:
+        manifest = json.load(fp)
+    if isinstance(manifest, dict):
+        manifest = manifest.get('jobs')
+    if not isinstance(manifest, list):
+        raise BatchError(f'{manifest_path} should contain a list of jobs')
+    jobs = []
+    for job_json in manifest:
+        try:
+            jobs.append(BatchJob(
+                release=str(job_json['release']),
+                pio_env=str(job_json['env']),
+                config_file_path=Path(manifest_path.parent, job_json['config']).resolve(),
+                upload_port=job_json.get('port'),
+            ))
+        except (KeyError, TypeError) as e:
+            raise BatchError(f'Bad job {job_json} in {manifest_path}: missing {e}')
+    return jobs
+
+
+def resolve_fw_versions(release_names: List[str]) -> Dict[str, FWVersion]:
+    fw_versions = {fw_version.nice_name: fw_version for fw_version in FW_BRANCHES}
+    if any(release_name not in fw_versions for release_name in release_names):
+        for fw_version in list_fw_releases():
+            fw_versions.setdefault(fw_version.nice_name, fw_version)
+            # Also allow the tag name, the release name can be different
+            fw_versions.setdefault(fw_version.url.rsplit('/', maxsplit=1)[-1], fw_version)
+    missing = [release_name for release_name in release_names if release_name not in fw_versions]
+    if missing:
+        raise BatchError(f'Unknown firmware release(s): {missing}')
+    return {release_name: fw_versions[release_name] for release_name in release_names}
+
+
+class BatchRunner:
+    """
+    Runs download -> extract -> build -> upload for every job in a manifest, without Qt.
+    Jobs for the same firmware release share one firmware directory, so the config install
+    and build are done under a per-directory lock. Uploads are done from a copy of the
+    artifacts, so uploading to several ports runs in parallel with the next build.
+    """
+
+    def __init__(self, jobs: List[BatchJob], concurrency: int, log_dir: Path):
+        self.jobs = jobs
+        self.concurrency = max(1, concurrency)
+        self.log_dir = log_dir
+        self.build_jobs = max(1, get_total_build_jobs() // self.concurrency)
+        self.fw_versions: Dict[str, FWVersion] = {}
+        self.fw_dirs: Dict[str, Path] = {}
+        # The archive cache and worktrees aren't thread safe, one download/extract at a time
+        self.download_lock = threading.Lock()
+        self.fw_dir_locks: Dict[Path, threading.Lock] = {}
+        self.fw_dir_locks_lock = threading.Lock()
+
+    def get_fw_dir(self, release: str, stages: Dict[str, float]) -> Path:
+        with self.download_lock:
+            if release not in self.fw_dirs:
+                fw_version = self.fw_versions[release]
+                start_time = time.perf_counter()
+                zipfile_name = download_fw(fw_version)
+                stages['download'] = time.perf_counter() - start_time
+                start_time = time.perf_counter()
+                self.fw_dirs[release] = extract_fw(zipfile_name, fw_version)
+                stages['extract'] = time.perf_counter() - start_time
+            return self.fw_dirs[release]
+
+    def get_fw_dir_lock(self, fw_dir: Path) -> threading.Lock:
+        with self.fw_dir_locks_lock:
+            return self.fw_dir_locks.setdefault(fw_dir, threading.Lock())
+
+    def run_job(self, job_idx: int, job: BatchJob) -> dict:
+        job_name = f'{job_idx:03d}_{job.release}_{job.pio_env}'
+        stages: Dict[str, float] = {}
+        job_result = {
+            'release': job.release,
+            'env': job.pio_env,
+            'config': str(job.config_file_path),
+            'port': job.upload_port,
+            'success': False,
+            'from_cache': False,
+            'error': None,
+            'stages': stages,
+            'build_log': None,
+            'upload_log': None,
+        }
+        try:
+            fw_dir = self.get_fw_dir(job.release, stages)
+            job_build_dir = Path(self.log_dir, 'artifacts', job_name)
+            with self.get_fw_dir_lock(fw_dir):
+                start_time = time.perf_counter()
+                do_hot_patches(fw_dir, pio_env_is_avr_based(fw_dir, job.pio_env), job.release)
+                install_config_file(job.config_file_path, fw_dir)
+                stages['prepare'] = time.perf_counter() - start_time
+                build_result = build_env(fw_dir, job.pio_env, job.release, self.build_jobs,
+                                         Path(self.log_dir, f'{job_name}_build.log'))
+                stages['build'] = build_result.duration_s
+                job_result['from_cache'] = build_result.from_cache
+                job_result['build_log'] = str(build_result.log_path) if build_result.log_path else None
+                if not build_result.success:
+                    raise BatchError(f'Build failed, see {build_result.log_path}')
+                # Take a copy while we still hold the lock, the next job can change the build directory
+                Path(job_build_dir, job.pio_env).mkdir(parents=True, exist_ok=True)
+                for artifact in build_artifacts(get_build_dir(fw_dir, job.pio_env)):
+                    shutil.copy2(artifact, Path(job_build_dir, job.pio_env, artifact.name))
+
+            if job.upload_port is not None:
+                upload_log_path = Path(self.log_dir, f'{job_name}_upload.log')
+                job_result['upload_log'] = str(upload_log_path)
+                start_time = time.perf_counter()
+                exit_code = run_platformio(
+                    ['run',
+                     '--environment', job.pio_env,
+                     '--project-dir', str(fw_dir),
+                     '--verbose',
+                     '--target', 'upload',
+                     '--target', 'nobuild',
+                     # job_build_dir has no project.checksum, an auto clean would delete the artifacts
+                     '--disable-auto-clean',
+                     '--upload-port', job.upload_port,
+                     ],
+                    {'PLATFORMIO_BUILD_DIR': str(job_build_dir)},
+                    upload_log_path,
+                )
+                stages['upload'] = time.perf_counter() - start_time
+                if not build_artifacts(Path(job_build_dir, job.pio_env)):
+                    raise BatchError(f'platformio removed the build artifacts in {job_build_dir}, '
+                                     f'see {upload_log_path}')
+                if exit_code != 0:
+                    raise BatchError(f'Upload to {job.upload_port} failed ({exit_code}), see {upload_log_path}')
+            job_result['success'] = True
+        except (BatchError, OSError) as e:
+            log.error(f'Job {job_name} failed: {e}')
+            job_result['error'] = str(e)
+        except Exception as e:
+            # i.e. a download or extraction error, keep going with the other jobs
+            log.exception(f'Job {job_name} failed')
+            job_result['error'] = f'{type(e).__name__}: {e}'
+        log.info(f'Job {job_name} {"succeeded" if job_result["success"] else "FAILED"} stages={stages}')
+        return job_result
+
+    def run(self) -> dict:
+        start_time = time.perf_counter()
+        self.fw_versions = resolve_fw_versions(sorted({job.release for job in self.jobs}))
+        log.info(f'Running {len(self.jobs)} job(s), {self.concurrency} at a time with {self.build_jobs} build job(s) each')
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='batch') as executor:
+            job_results = list(executor.map(self.run_job, range(len(self.jobs)), self.jobs))
+        return {
+            'oatfwgui_version': __version__,
+            'platformio_version': get_platformio_version(),
+            'success': all(job_result['success'] for job_result in job_results),
+            'total_s': time.perf_counter() - start_time,
+            'jobs': job_results,
+        }
+
+
+def run_batch(manifest_path: Path, concurrency: int, summary_path: Optional[Path]) -> int:
+    date_str = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    log_dir = Path(get_install_dir(), 'logs', f'batch_{date_str}')
+    if summary_path is None:
+        summary_path = Path(log_dir, 'summary.json')
+    try:
+        jobs = read_manifest(manifest_path)
+        summary = BatchRunner(jobs, concurrency, log_dir).run()
+    except (BatchError, OSError, json.decoder.JSONDecodeError) as e:
+        log.error(f'Batch failed: {e}')
+        summary = {'oatfwgui_version': __version__, 'success': False, 'error': str(e), 'jobs': []}
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(summary_path, 'w') as fp:
+        json.dump(summary, fp, indent=2)
+    num_ok = sum(job_result['success'] for job_result in summary['jobs'])
+    log.info(f'Batch finished, {num_ok}/{len(summary["jobs"])} job(s) succeeded. Summary: {summary_path}')
+    return 0 if summary['success'] else 1
+
+
+def run_jobs_benchmark(manifest_path: Path) -> int:
+    """Benchmark --jobs for every environment in a batch manifest, using the first job's release and config"""
+    date_str = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    log_dir = Path(get_install_dir(), 'logs', f'benchmark_{date_str}')
+    try:
+        jobs = read_manifest(manifest_path)
+        runner = BatchRunner(jobs, 1, log_dir)
+        runner.fw_versions = resolve_fw_versions(sorted({job.release for job in jobs}))
+        benchmark_jobs = {}
+        for job in jobs:
+            benchmark_jobs.setdefault(job.pio_env, job)
+        all_ok = True
+        for pio_env, job in benchmark_jobs.items():
+            fw_dir = runner.get_fw_dir(job.release, {})
+            do_hot_patches(fw_dir, pio_env_is_avr_based(fw_dir, pio_env), job.release)
+            install_config_file(job.config_file_path, fw_dir)
+            timings = benchmark_build_jobs(fw_dir, pio_env, log_dir)
+            if timings:
+                save_benchmark(pio_env, timings)
+            else:
+                all_ok = False
+    except (BatchError, OSError, json.decoder.JSONDecodeError) as e:
+        log.error(f'Benchmark failed: {e}')
+        return 1
+    return 0 if all_ok else 1
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Optional, Dict, List
+
+from fw_extract import SYNC_MANIFEST_NAME
+from hot_patches import HOT_PATCH_MARKER_NAME
+from misc_utils import load_json_index, save_json_index
+
+log = logging.getLogger('')
+
+BUILD_CACHE_MAX_ENTRIES = 20
+# Everything in .pio/build/<env> that's needed to upload without building
+ARTIFACT_PATTERNS = ['*.hex', '*.bin', '*.elf']
+# Not part of the firmware source, never hashed
+TREE_HASH_SKIP_NAMES = {'.pio', SYNC_MANIFEST_NAME, HOT_PATCH_MARKER_NAME}
+
+
+def file_sha256(file_path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def tree_sha256(tree_dir: Path) -> str:
+    sha256 = hashlib.sha256()
+    for sub_dir, dir_names, file_names in os.walk(tree_dir):
+        # Sort so the walk order (and so the hash) is the same on every platform
+        dir_names[:] = sorted(d for d in dir_names if d not in TREE_HASH_SKIP_NAMES)
+        for file_name in sorted(file_names):
+            if file_name in TREE_HASH_SKIP_NAMES:
+                continue
+            file_path = Path(sub_dir, file_name)
+            rel_path = file_path.relative_to(tree_dir).as_posix()
+            sha256.update(f'{rel_path}\n{file_sha256(file_path)}\n'.encode())
+    return sha256.hexdigest()
+
+
+def build_cache_key(fw_dir: Path, config_file_path: Path, pio_env: str,
+                    pio_version: Optional[str], env_vars: Dict[str, str]) -> str:
+    """
+    Everything that goes into a build. Call this after the hot patches are applied and the
+    config has been copied, then the patched platformio.ini is part of the tree hash.
+    """
+    key_parts = {
+        'tree': tree_sha256(fw_dir),
+        'config': file_sha256(config_file_path),
+        'pio_env': pio_env,
+        'pio_version': pio_version,
+        'env_vars': env_vars,
+    }
+    return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode()).hexdigest()
+
+
+def build_artifacts(build_dir: Path) -> List[Path]:
+    artifacts = []
+    for pattern in ARTIFACT_PATTERNS:
+        artifacts.extend(p for p in build_dir.glob(pattern) if p.is_file())
+    return sorted(artifacts)
+
+
+class BuildCache:
+    """
+    Firmware build outputs, keyed by everything that went into the build (see build_cache_key).
+    Flashing the same configuration onto several mounts only builds once, after that the
+    artifacts are copied back into .pio/build/<env> and uploaded without building.
+    """
+
+    def __init__(self, cache_dir: Path, max_entries: int = BUILD_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.index_path = Path(cache_dir, 'index.json')
+        self.index: Dict[str, dict] = {}
+        # Several environments can be building at once (see build_matrix)
+        self.lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self):
+        self.index = load_json_index(self.index_path, 'build cache index')
+        # Forget about any entries whose artifacts have gone missing
+        self.index = {
+            key: entry for key, entry in self.index.items()
+            if all(Path(self.cache_dir, key, f).is_file() for f in entry['files'])
+        }
+
+    def _save_index(self):
+        save_json_index(self.index_path, self.index)
+
+    def restore(self, key: str, build_dir: Path) -> bool:
+        """Copy cached artifacts into build_dir, returns False on a cache miss"""
+        with self.lock:
+            return self._restore(key, build_dir)
+
+    def _restore(self, key: str, build_dir: Path) -> bool:
+        entry = self.index.get(key)
+        if entry is None:
+            return False
+        build_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            for file_name in entry['files']:
+                shutil.copy2(Path(self.cache_dir, key, file_name), Path(build_dir, file_name))
+        except OSError as e:
+            log.warning(f'Could not restore cached build {key}: {e}')
+            return False
+        log.info(f'Build cache hit for {entry["pio_env"]} ({entry["fw_name"]}), '
+                 f'built {time.ctime(entry["created"])}')
+        entry['last_used'] = time.time()
+        self._save_index()
+        return True
+
+    def store(self, key: str, build_dir: Path, pio_env: str, fw_name: str):
+        with self.lock:
+            self._store(key, build_dir, pio_env, fw_name)
+
+    def _store(self, key: str, build_dir: Path, pio_env: str, fw_name: str):
+        artifacts = build_artifacts(build_dir)
+        if not artifacts:
+            log.warning(f'No build artifacts in {build_dir}, not caching')
+            return
+        entry_dir = Path(self.cache_dir, key)
+        tmp_entry_dir = Path(self.cache_dir, f'{key}.tmp')
+        if tmp_entry_dir.exists():
+            shutil.rmtree(tmp_entry_dir)
+        tmp_entry_dir.mkdir(parents=True)
+        for artifact in artifacts:
+            shutil.copy2(artifact, Path(tmp_entry_dir, artifact.name))
+        if entry_dir.exists():
+            shutil.rmtree(entry_dir)
+        tmp_entry_dir.rename(entry_dir)
+        now = time.time()
+        self.index[key] = {
+            'files': [a.name for a in artifacts],
+            'pio_env': pio_env,
+            'fw_name': fw_name,
+            'created': now,
+            'last_used': now,
+        }
+        log.info(f'Cached build artifacts {[a.name for a in artifacts]} for {pio_env}')
+        self._evict(keep_key=key)
+        self._save_index()
+
+    def _evict(self, keep_key: str):
+        lru_keys = sorted(self.index, key=lambda k: self.index[k]['last_used'])
+        for key in lru_keys:
+            if len(self.index) <= self.max_entries:
+                break
+            if key == keep_key:
+                continue
+            entry = self.index.pop(key)
+            log.info(f'Evicting {entry["pio_env"]} ({entry["fw_name"]}) from build cache')
+            shutil.rmtree(Path(self.cache_dir, key), ignore_errors=True)
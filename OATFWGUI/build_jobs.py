@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import ctypes
+import logging
+from pathlib import Path
+from typing import Optional, Union, List, Dict
+
+from external_processes import get_install_dir
+from pio_project import pio_env_is_avr_based
+from platform_check import get_platform, PlatformEnum
+from misc_utils import atomic_write_text
+from fw_build import get_build_env_vars, run_platformio, get_lib_mirror
+
+log = logging.getLogger('')
+
+AUTO_BUILD_JOBS = 'auto'
+# Rough peak memory of one compiler process, the esp32 framework is a lot heavier than AVR
+AVR_JOB_MEMORY_BYTES = 200 * 1024 * 1024
+ESP32_JOB_MEMORY_BYTES = 600 * 1024 * 1024
+
+BuildJobsSetting = Union[str, int]  # AUTO_BUILD_JOBS or a fixed number of jobs
+
+
+def get_settings_path() -> Path:
+    return Path(get_install_dir(), '.build_jobs.json')
+
+
+def load_settings() -> dict:
+    try:
+        with open(get_settings_path(), 'r') as fp:
+            settings = json.load(fp)
+    except FileNotFoundError:
+        settings = {}
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        log.warning(f'Could not read build jobs settings {get_settings_path()}: {e}')
+        settings = {}
+    settings.setdefault('setting', AUTO_BUILD_JOBS)
+    settings.setdefault('benchmarks', {})
+    return settings
+
+
+def save_settings(settings: dict):
+    atomic_write_text(get_settings_path(), json.dumps(settings, indent=2))
+
+
+_setting_override: Optional[BuildJobsSetting] = None
+
+
+def parse_build_jobs_setting(setting_str: str) -> BuildJobsSetting:
+    if setting_str == AUTO_BUILD_JOBS:
+        return AUTO_BUILD_JOBS
+    jobs = int(setting_str)
+    if jobs < 1:
+        raise ValueError(f'Build jobs must be at least 1, not {jobs}')
+    return jobs
+
+
+def override_build_jobs_setting(setting: BuildJobsSetting):
+    # i.e. from the command line, only for this run
+    global _setting_override
+    _setting_override = setting
+
+
+def get_build_jobs_setting() -> BuildJobsSetting:
+    if _setting_override is not None:
+        return _setting_override
+    return load_settings()['setting']
+
+
+def set_build_jobs_setting(setting: BuildJobsSetting):
+    log.info(f'Setting build jobs to {setting}')
+    settings = load_settings()
+    settings['setting'] = setting
+    save_settings(settings)
+
+
+def get_cpu_count() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        # Only the cores we're allowed to run on
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_available_memory_bytes() -> Optional[int]:
+    if get_platform() == PlatformEnum.WINDOWS:
+        class MemoryStatusEx(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+        memory_status = MemoryStatusEx()
+        memory_status.dwLength = ctypes.sizeof(MemoryStatusEx)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(memory_status)):
+            return memory_status.ullAvailPhys
+        return None
+    try:
+        with open('/proc/meminfo', 'r') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_idle_cpu_count() -> int:
+    cpu_count = get_cpu_count()
+    if hasattr(os, 'getloadavg'):
+        # Leave room for whatever else is already keeping the CPU busy
+        busy_cpus = int(os.getloadavg()[0])
+        return max(1, cpu_count - busy_cpus)
+    return cpu_count
+
+
+def adaptive_build_jobs(fw_dir: Optional[Path], pio_env: Optional[str]) -> int:
+    """As many jobs as there are idle cores, as long as they all fit in the free memory"""
+    jobs = get_idle_cpu_count()
+    available_memory = get_available_memory_bytes()
+    if available_memory is not None:
+        job_memory = AVR_JOB_MEMORY_BYTES if pio_env_is_avr_based(fw_dir, pio_env) else ESP32_JOB_MEMORY_BYTES
+        jobs = min(jobs, max(1, available_memory // job_memory))
+    return jobs
+
+
+def get_build_jobs(fw_dir: Optional[Path], pio_env: Optional[str]) -> int:
+    setting = get_build_jobs_setting()
+    if setting != AUTO_BUILD_JOBS:
+        return setting
+    benchmark = load_settings()['benchmarks'].get(pio_env)
+    if benchmark is not None:
+        # Never go over what the machine can take right now
+        jobs = min(benchmark['best_jobs'], adaptive_build_jobs(fw_dir, pio_env))
+        log.debug(f'Using benchmarked build jobs for {pio_env}: {jobs}')
+        return jobs
+    return adaptive_build_jobs(fw_dir, pio_env)
+
+
+def get_total_build_jobs() -> int:
+    """All compile jobs, when several builds run at once"""
+    setting = get_build_jobs_setting()
+    if setting != AUTO_BUILD_JOBS:
+        return setting
+    return get_idle_cpu_count()
+
+
+def benchmark_candidates(cpu_count: int) -> List[int]:
+    candidates = {cpu_count}
+    jobs = 1
+    while jobs < cpu_count:
+        candidates.add(jobs)
+        jobs *= 2
+    return sorted(candidates)
+
+
+def benchmark_build_jobs(fw_dir: Path, pio_env: str, log_dir: Path,
+                         candidates: Optional[List[int]] = None) -> Dict[int, float]:
+    """
+    Time a clean build of pio_env at each number of jobs. Goes straight to platformio, so
+    neither the build cache nor the compiler cache hide the real compile time.
+    """
+    if candidates is None:
+        candidates = benchmark_candidates(get_cpu_count())
+    get_lib_mirror().prepare(fw_dir, pio_env)
+    env_vars = get_build_env_vars(fw_dir, pio_env)
+    base_args = ['run', '--environment', pio_env, '--project-dir', str(fw_dir)]
+    # Installs the toolchain and libraries, so that doesn't count towards the first timing
+    log.info(f'Benchmarking {pio_env} with jobs={candidates}, warming up first')
+    if run_platformio(base_args, env_vars, Path(log_dir, f'{pio_env}_warmup.log')) != 0:
+        log.error(f'Warm up build of {pio_env} failed, see {log_dir}')
+        return {}
+    timings = {}
+    for jobs in candidates:
+        run_platformio(base_args + ['--target', 'clean'], env_vars, Path(log_dir, f'{pio_env}_clean.log'))
+        start_time = time.perf_counter()
+        exit_code = run_platformio(base_args + ['--jobs', str(jobs)], env_vars,
+                                   Path(log_dir, f'{pio_env}_jobs{jobs}.log'))
+        if exit_code != 0:
+            log.error(f'Benchmark build of {pio_env} with {jobs} jobs failed, see {log_dir}')
+            continue
+        timings[jobs] = time.perf_counter() - start_time
+        log.info(f'{pio_env} with {jobs} jobs: {timings[jobs]:.1f}s')
+    return timings
+
+
+def save_benchmark(pio_env: str, timings: Dict[int, float]) -> int:
+    best_jobs = min(timings, key=lambda j: timings[j])
+    settings = load_settings()
+    settings['benchmarks'][pio_env] = {
+        'best_jobs': best_jobs,
+        'timings': {str(jobs): duration_s for jobs, duration_s in timings.items()},
+        'date': time.time(),
+    }
+    save_settings(settings)
+    log.info(f'Best build jobs for {pio_env} is {best_jobs}, timings={timings}')
+    return best_jobs
@@ -0,0 +1,189 @@
+import logging
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Callable, Tuple
+
+from PySide6.QtCore import Slot, Qt, QThreadPool
+from PySide6.QtWidgets import QDialog, QDialogButtonBox, QListWidget, QListWidgetItem, QPlainTextEdit, \
+    QVBoxLayout, QLabel, QPushButton
+
+from qt_extensions import Worker
+from gui_state import PioEnv
+from pio_project import pio_env_is_avr_based
+from external_processes import get_install_dir
+from fw_build import EnvBuildResult, do_hot_patches, install_config_file, build_env
+from build_jobs import get_total_build_jobs
+from pkg_prefetch import get_pkg_prefetcher
+
+log = logging.getLogger('')
+
+
+def plan_parallelism(num_envs: int, max_jobs: int) -> Tuple[int, List[int]]:
+    """
+    Split max_jobs compile jobs between the environments. Returns how many environments
+    build at once and the --jobs for each environment, the total running at any one time
+    never goes over max_jobs.
+    """
+    parallel_builds = max(1, min(num_envs, max_jobs))
+    base_jobs, extra_jobs = divmod(max_jobs, parallel_builds)
+    env_jobs = [
+        max(1, base_jobs + (1 if i % parallel_builds < extra_jobs else 0))
+        for i in range(num_envs)
+    ]
+    return parallel_builds, env_jobs
+
+
+def prepare_fw_dir(fw_dir: Path, fw_name: str, config_file_path: Path, pio_envs: List[str]) -> Path:
+    # The firmware directory is shared by all environments, so patch/copy once up front
+    do_hot_patches(fw_dir, any(pio_env_is_avr_based(fw_dir, pio_env) for pio_env in pio_envs), fw_name)
+    return install_config_file(config_file_path, fw_dir)
+
+
+def get_matrix_log_dir() -> Path:
+    date_str = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    return Path(get_install_dir(), 'logs', f'build_matrix_{date_str}')
+
+
+def run_build_matrix(fw_dir: Path, pio_envs: List[str], fw_name: str, log_dir: Path,
+                     max_jobs: Optional[int] = None,
+                     result_callback: Optional[Callable[[EnvBuildResult], None]] = None) -> List[EnvBuildResult]:
+    """
+    Build several environments of one (already prepared) firmware directory at the same time.
+    Each environment builds into its own .pio/build/<env> and logs to log_dir/<env>.log.
+    """
+    if max_jobs is None:
+        max_jobs = get_total_build_jobs()
+    parallel_builds, env_jobs = plan_parallelism(len(pio_envs), max_jobs)
+    log.info(f'Building {pio_envs}, {parallel_builds} at a time with jobs={env_jobs} (max {max_jobs})')
+    results = {}
+    with ThreadPoolExecutor(max_workers=parallel_builds, thread_name_prefix='build_matrix') as executor:
+        futures = {
+            executor.submit(build_env, fw_dir, pio_env, fw_name, jobs, Path(log_dir, f'{pio_env}.log')): pio_env
+            for pio_env, jobs in zip(pio_envs, env_jobs)
+        }
+        for future in as_completed(futures):
+            pio_env = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                log.error(f'Building {pio_env} failed: {e}')
+                result = EnvBuildResult(pio_env, False, False, 0.0, None)
+            results[pio_env] = result
+            if result_callback is not None:
+                result_callback(result)
+    return [results[pio_env] for pio_env in pio_envs]
+
+
+def format_env_build_result(result: EnvBuildResult) -> str:
+    status_str = 'OK' if result.success else 'FAILED'
+    cache_str = ' (cached)' if result.from_cache else ''
+    log_str = f' log: {result.log_path}' if result.log_path is not None else ''
+    return f'{result.pio_env}: {status_str}{cache_str} in {result.duration_s:.1f}s{log_str}'
+
+
+class BuildMatrixDialog(QDialog):
+    def __init__(self, fw_dir: Path, fw_name: str, pio_envs: List[PioEnv], config_file_path: Path,
+                 threadpool: QThreadPool, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle('Build multiple boards')
+        self.fw_dir = fw_dir
+        self.fw_name = fw_name
+        self.config_file_path = config_file_path
+        self.threadpool = threadpool
+        self.worker: Optional[Worker] = None
+
+        wLbl_info = QLabel(f'Build {fw_name} with {config_file_path.name} for these boards, '
+                           f'using up to {get_total_build_jobs()} compile jobs at once:')
+        wLbl_info.setWordWrap(True)
+
+        self.wList_envs = QListWidget()
+        for pio_env in pio_envs:
+            item = QListWidgetItem(pio_env.nice_name)
+            item.setData(Qt.UserRole, pio_env.raw_name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Unchecked)
+            self.wList_envs.addItem(item)
+
+        self.wBtn_build = QPushButton('Build selected')
+        self.wBtn_build.clicked.connect(self.start_build)
+
+        self.wTxt_results = QPlainTextEdit()
+        self.wTxt_results.setReadOnly(True)
+        self.wTxt_results.setMinimumSize(500, 150)
+
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.Close)
+        self.buttonBox.rejected.connect(self.reject)
+
+        self.layout = QVBoxLayout()
+        self.layout.addWidget(wLbl_info)
+        self.layout.addWidget(self.wList_envs)
+        self.layout.addWidget(self.wBtn_build)
+        self.layout.addWidget(self.wTxt_results)
+        self.layout.addWidget(self.buttonBox)
+        self.setLayout(self.layout)
+
+    def selected_envs(self) -> List[str]:
+        return [
+            self.wList_envs.item(i).data(Qt.UserRole)
+            for i in range(self.wList_envs.count())
+            if self.wList_envs.item(i).checkState() == Qt.Checked
+        ]
+
+    def is_building(self) -> bool:
+        return self.worker is not None
+
+    @Slot()
+    def start_build(self):
+        pio_envs = self.selected_envs()
+        if not pio_envs:
+            self.wTxt_results.appendPlainText('Select at least one board')
+            return
+        self.wBtn_build.setEnabled(False)
+        self.buttonBox.setEnabled(False)
+        self.wTxt_results.clear()
+        self.wTxt_results.appendPlainText(f'Building {", ".join(pio_envs)}...')
+
+        def build_matrix_fn(partial_result_callback: Callable[[EnvBuildResult], None]) -> List[EnvBuildResult]:
+            prepare_fw_dir(self.fw_dir, self.fw_name, self.config_file_path, pio_envs)
+            # The parallel builds would all install packages at once, install them one at a time first
+            for pio_env in pio_envs:
+                get_pkg_prefetcher().start(self.fw_dir, pio_env, self.fw_name)
+            get_pkg_prefetcher().wait_all()
+            return run_build_matrix(self.fw_dir, pio_envs, self.fw_name, get_matrix_log_dir(),
+                                    result_callback=partial_result_callback)
+
+        self.worker = Worker(build_matrix_fn)
+        self.worker.signals.partial_result.connect(self.env_build_finished)
+        self.worker.signals.result.connect(self.build_finished)
+        self.worker.signals.error.connect(self.build_error)
+        self.worker.setAutoDelete(False)
+        # Same pool as the other platformio workers, so this never overlaps with a GUI build
+        self.threadpool.start(self.worker)
+
+    @Slot()
+    def env_build_finished(self, result: EnvBuildResult):
+        self.wTxt_results.appendPlainText(format_env_build_result(result))
+
+    @Slot()
+    def build_finished(self, results: List[EnvBuildResult]):
+        num_ok = sum(result.success for result in results)
+        self.wTxt_results.appendPlainText(f'Finished, {num_ok}/{len(results)} boards built')
+        self.build_done()
+
+    @Slot()
+    def build_error(self, error_tup: tuple):
+        self.wTxt_results.appendPlainText(f'Build failed: {error_tup[1]}')
+        self.build_done()
+
+    def build_done(self):
+        self.worker = None
+        self.wBtn_build.setEnabled(True)
+        self.buttonBox.setEnabled(True)
+
+    def reject(self):
+        # Don't close the dialog out from under a running build
+        if self.is_building():
+            return
+        super().reject()
@@ -0,0 +1,120 @@
+import re
+import json
+import time
+import logging
+from pathlib import Path
+from typing import Optional, Callable, NamedTuple
+
+from external_processes import get_install_dir
+from misc_utils import atomic_write_text
+
+log = logging.getLogger('')
+
+# `pio run --verbose` prints the full command for each step, the non-verbose output has
+# 'Compiling x.o' style lines instead. Match both, and through a compiler cache launcher.
+COMPILE_STEP_RE = re.compile(r'^Compiling \S+\.o$|^(?=.*\s-c\s).*\s-o\s+"?\S+\.o"?(\s|$)')
+ARCHIVE_STEP_RE = re.compile(r'^Archiving \S+\.a$|^\S*ar"?\s+rcs?\s+"?\S+\.a')
+LINK_STEP_RE = re.compile(r'^Linking \S+\.elf$|\s-o\s+"?\S+\.elf"?(\s|$)')
+
+
+class BuildProgress(NamedTuple):
+    units_done: int
+    units_total: Optional[int]  # None if we've never built this environment before
+    percent: int  # -1 if unknown
+    eta_s: Optional[float]
+
+
+def get_history_path() -> Path:
+    return Path(get_install_dir(), '.build_progress.json')
+
+
+def load_history() -> dict:
+    try:
+        with open(get_history_path(), 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        log.warning(f'Could not read build progress history {get_history_path()}: {e}')
+        return {}
+
+
+def get_expected_units(pio_env: str) -> Optional[int]:
+    env_history = load_history().get(pio_env)
+    if env_history is None:
+        return None
+    return env_history.get('units')
+
+
+def save_build_units(pio_env: str, units: int, duration_s: float):
+    history = load_history()
+    history[pio_env] = {'units': units, 'duration_s': duration_s}
+    atomic_write_text(get_history_path(), json.dumps(history, indent=2))
+
+
+class BuildProgressParser:
+    """
+    Counts compile/archive/link steps in platformio's output as it arrives. Each chunk is
+    only looked at once, just the unfinished last line is kept for the next chunk.
+    Progress is against the number of steps in the previous build of the same environment.
+    """
+
+    def __init__(self, pio_env: str, progress_callback: Optional[Callable[[BuildProgress], None]] = None):
+        self.pio_env = pio_env
+        self.progress_callback = progress_callback
+        self.expected_units = get_expected_units(pio_env)
+        self.units_done = 0
+        self.start_time = time.perf_counter()
+        self._partial_line = ''
+
+    def feed(self, chunk: str):
+        lines = (self._partial_line + chunk).split('\n')
+        self._partial_line = lines.pop()
+        units_before = self.units_done
+        for line in lines:
+            self.parse_line(line.rstrip('\r'))
+        # At most one update per chunk, a chunk often has several steps in it
+        if self.units_done != units_before:
+            self.report()
+
+    def parse_line(self, line: str):
+        if COMPILE_STEP_RE.search(line) or ARCHIVE_STEP_RE.search(line) or LINK_STEP_RE.search(line):
+            self.units_done += 1
+
+    def progress(self) -> BuildProgress:
+        if not self.expected_units:
+            return BuildProgress(self.units_done, None, -1, None)
+        # Don't claim to be done until platformio is, this build could have more steps than the last
+        units_total = max(self.expected_units, self.units_done + 1)
+        percent = min(99, self.units_done * 100 // units_total)
+        eta_s = None
+        if self.units_done > 0:
+            elapsed_s = time.perf_counter() - self.start_time
+            eta_s = elapsed_s / self.units_done * (units_total - self.units_done)
+        return BuildProgress(self.units_done, units_total, percent, eta_s)
+
+    def report(self):
+        if self.progress_callback is not None:
+            self.progress_callback(self.progress())
+
+    def finish(self, success: bool):
+        if self._partial_line:
+            self.parse_line(self._partial_line)
+            self._partial_line = ''
+        duration_s = time.perf_counter() - self.start_time
+        if self.progress_callback is not None:
+            # Also stops the busy bar if the build failed
+            percent = 100 if success else 0
+            self.progress_callback(BuildProgress(self.units_done, self.units_done, percent, 0.0))
+        if success and self.units_done > 0:
+            # Incremental builds have fewer steps, only remember full-ish builds as the estimate
+            if self.expected_units is None or self.units_done >= self.expected_units // 2:
+                save_build_units(self.pio_env, self.units_done, duration_s)
+        log.info(f'Build of {self.pio_env} ran {self.units_done} steps in {duration_s:.1f}s')
+
+
+def format_eta(eta_s: Optional[float]) -> str:
+    if eta_s is None:
+        return ''
+    minutes, seconds = divmod(int(eta_s), 60)
+    return f'{minutes}:{seconds:02d}'
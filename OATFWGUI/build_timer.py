@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Times one compiler/archiver/linker invocation, used by pre_script_build_timer.py when
+profiling a build. Run as `build_timer.py <program> <program args...>`.
+
+Appends a JSON line per invocation to the file in OATFWGUI_BUILD_TIMES, see build_times.py
+for the report. This runs inside platformio's python for every step, so it only uses the
+standard library (and compiler_cache.py next to it).
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+from typing import List
+
+from compiler_cache import append_line, expand_response_files
+
+BUILD_TIMES_ENV = 'OATFWGUI_BUILD_TIMES'
+
+
+def step_kind(args: List[str], output: str) -> str:
+    if '-c' in args:
+        return 'compile'
+    if output.endswith('.a') or (len(args) > 1 and args[0] in ('rc', 'rcs')):
+        return 'archive'
+    return 'link'
+
+
+def step_output(args: List[str]) -> str:
+    if '-o' in args and args.index('-o') + 1 < len(args):
+        return args[args.index('-o') + 1]
+    # ar: `ar rc libfoo.a a.o b.o`
+    return next((a for a in args if a.endswith('.a')), '')
+
+
+def record_time(step: dict):
+    times_path = os.environ.get(BUILD_TIMES_ENV)
+    if times_path:
+        append_line(times_path, json.dumps(step))
+
+
+def main() -> int:
+    if len(sys.argv) < 2:
+        print(f'usage: {sys.argv[0]} <program> [program args...]', file=sys.stderr)
+        return 2
+    program, args = sys.argv[1], sys.argv[2:]
+    start_time = time.time()
+    start_perf = time.perf_counter()
+    # Read the @file platformio uses for long command lines now, it's deleted right after the step
+    step_args = expand_response_files(args)
+    return_code = subprocess.call([program] + args)
+    output = step_output(step_args)
+    try:
+        record_time({
+            'kind': step_kind(step_args, output),
+            'output': output,
+            'start': start_time,
+            'duration_s': time.perf_counter() - start_perf,
+            'return_code': return_code,
+        })
+    except OSError as e:
+        # Never fail a build because of the profiling
+        print(f'build_timer.py: could not record time: {e}', file=sys.stderr)
+    return return_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
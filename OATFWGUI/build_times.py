@@ -0,0 +1,171 @@
+import re
+import json
+import time
+import uuid
+import logging
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Optional
+
+from external_processes import get_install_dir
+from misc_utils import atomic_write_text
+
+log = logging.getLogger('')
+
+SLOWEST_STEPS_SHOWN = 25
+# Only call out a step as slower if it's a real difference, not just noise
+REGRESSION_MIN_S = 0.5
+REGRESSION_MIN_RATIO = 1.25
+LIB_DIR_RE = re.compile(r'^lib[0-9a-f]+$')
+
+
+def new_build_times_path() -> Path:
+    # Raw per-step times from build_timer.py, only kept until the report is made
+    return Path(tempfile.gettempdir(), f'oatfwgui_build_times_{uuid.uuid4().hex}.jsonl')
+
+
+def read_build_times(times_path: Path) -> List[dict]:
+    steps = []
+    try:
+        with open(times_path, 'r') as fp:
+            for line in fp:
+                try:
+                    steps.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    log.warning(f'Bad build time line in {times_path}: {line!r}')
+    except FileNotFoundError:
+        log.warning(f'No build times recorded in {times_path}')
+    return steps
+
+
+def relative_output(output: str, pio_env: str) -> str:
+    # Relative to .pio/build/<env>, so the same step in a different worktree has the same name
+    parts = Path(output).parts
+    for i in range(len(parts) - 2):
+        if parts[i:i + 3] == ('.pio', 'build', pio_env):
+            return '/'.join(parts[i + 3:])
+    return Path(output).as_posix()
+
+
+def step_library(rel_output: str) -> str:
+    parts = rel_output.split('/')
+    if len(parts) > 1 and LIB_DIR_RE.match(parts[0]):
+        # .pio/build/<env>/lib1a2/<library>/... or lib1a2/lib<library>.a
+        library = parts[1]
+    elif len(parts) > 1:
+        # i.e. src or FrameworkArduino
+        library = parts[0]
+    else:
+        library = Path(parts[0]).stem
+    if library.startswith('lib') and library.endswith('.a'):
+        library = library[len('lib'):-len('.a')]
+    return library
+
+
+def build_times_report(steps: List[dict], pio_env: str) -> dict:
+    report_steps = []
+    libraries: Dict[str, float] = {}
+    for step in steps:
+        rel_output = relative_output(step.get('output', ''), pio_env)
+        library = step_library(rel_output)
+        report_steps.append({
+            'output': rel_output,
+            'kind': step.get('kind'),
+            'library': library,
+            'duration_s': step['duration_s'],
+        })
+        libraries[library] = libraries.get(library, 0.0) + step['duration_s']
+    report_steps.sort(key=lambda s: s['duration_s'], reverse=True)
+    wall_s = 0.0
+    if steps:
+        wall_s = max(s['start'] + s['duration_s'] for s in steps) - min(s['start'] for s in steps)
+    return {
+        'pio_env': pio_env,
+        'date': time.time(),
+        'total_s': sum(s['duration_s'] for s in steps),
+        'wall_s': wall_s,
+        'libraries': dict(sorted(libraries.items(), key=lambda l: l[1], reverse=True)),
+        'steps': report_steps,
+    }
+
+
+def compare_build_times(report: dict, previous_report: dict) -> List[str]:
+    lines = [f'Total {previous_report["total_s"]:.1f}s -> {report["total_s"]:.1f}s, '
+             f'wall {previous_report["wall_s"]:.1f}s -> {report["wall_s"]:.1f}s']
+    previous_steps = {s['output']: s['duration_s'] for s in previous_report['steps']}
+    for step in report['steps']:
+        previous_s = previous_steps.get(step['output'])
+        if previous_s is None:
+            lines.append(f'  new    {step["duration_s"]:7.2f}s {step["output"]}')
+        elif (step['duration_s'] - previous_s >= REGRESSION_MIN_S
+              and step['duration_s'] >= previous_s * REGRESSION_MIN_RATIO):
+            lines.append(f'  slower {previous_s:7.2f}s -> {step["duration_s"]:.2f}s {step["output"]}')
+    return lines
+
+
+def format_build_times_report(report: dict, comparison: Optional[List[str]]) -> str:
+    lines = [
+        f'Build times for {report["pio_env"]} ({datetime.fromtimestamp(report["date"]).isoformat()})',
+        f'{len(report["steps"])} steps, {report["total_s"]:.1f}s total, {report["wall_s"]:.1f}s wall clock',
+        '',
+        f'Slowest {min(SLOWEST_STEPS_SHOWN, len(report["steps"]))} steps:',
+    ]
+    for step in report['steps'][:SLOWEST_STEPS_SHOWN]:
+        lines.append(f'  {step["duration_s"]:7.2f}s {step["kind"]:<8} {step["output"]}')
+    lines += ['', 'Per library:']
+    for library, duration_s in report['libraries'].items():
+        lines.append(f'  {duration_s:7.2f}s {library}')
+    if comparison is not None:
+        lines += ['', 'Compared to the previous profile:'] + comparison
+    return '\n'.join(lines) + '\n'
+
+
+def find_previous_report(report_dir: Path, pio_env: str, exclude: Path) -> Optional[dict]:
+    previous_reports = []
+    for report_path in report_dir.glob('build_times_*.json'):
+        if report_path == exclude:
+            continue
+        try:
+            with open(report_path, 'r') as fp:
+                report = json.load(fp)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            log.warning(f'Could not read previous build times {report_path}: {e}')
+            continue
+        if report.get('pio_env') == pio_env:
+            previous_reports.append(report)
+    if not previous_reports:
+        return None
+    return max(previous_reports, key=lambda r: r['date'])
+
+
+def save_build_times_report(times_path: Path, pio_env: str) -> Optional[Path]:
+    """
+    Turn the raw build_timer.py output into a report in the logs directory (a .json to compare
+    against later, and a .txt to read). Returns the .txt path.
+    """
+    steps = read_build_times(times_path)
+    times_path.unlink(missing_ok=True)
+    if not steps:
+        return None
+    report = build_times_report(steps, pio_env)
+
+    # Next to the log files, timestamped so that profiles can be compared later
+    date_str = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    report_dir = Path(get_install_dir(), 'logs')
+    report_json_path = Path(report_dir, f'build_times_{date_str}_{pio_env}.json')
+    report_txt_path = report_json_path.with_suffix('.txt')
+
+    previous_report = find_previous_report(report_dir, pio_env, report_json_path)
+    comparison = compare_build_times(report, previous_report) if previous_report is not None else None
+    report_json_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(report_json_path, json.dumps(report, indent=2))
+    atomic_write_text(report_txt_path, format_build_times_report(report, comparison))
+
+    log.info(f'Build took {report["wall_s"]:.1f}s, slowest steps:')
+    for step in report['steps'][:5]:
+        log.info(f'  {step["duration_s"]:.2f}s {step["output"]}')
+    if comparison is not None:
+        log.info(comparison[0])
+    log.info(f'Build times report: {report_txt_path}')
+    return report_txt_path
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Minimal ccache-like compiler launcher, used by pre_script_compiler_cache.py when ccache isn't
+installed. Run as `compiler_cache.py <compiler> <compiler args...>`.
+
+Objects are stored by a hash of the compiler (path, size, mtime), the flags and the preprocessed
+source. Include paths are left out of the hash (the preprocessed source already has what they
+pulled in), so identical sources in different firmware worktrees share objects.
+
+This runs inside platformio's python for every compile, so it only uses the standard library.
+"""
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from typing import List, Optional, Tuple
+
+CACHE_DIR_ENV = 'OATFWGUI_COMPILER_CACHE_DIR'
+STATS_PATH_ENV = 'OATFWGUI_COMPILER_CACHE_STATS'
+SOURCE_SUFFIXES = ('.c', '.cpp', '.cc', '.cxx', '.ino')
+# These are followed by a path that can differ between worktrees
+PATH_ARGS = ['-I', '-iprefix', '-iwithprefixbefore', '-isystem', '-include']
+MAX_RESPONSE_FILE_DEPTH = 10
+
+
+def split_response_file(text: str) -> List[str]:
+    """Split like gcc does: whitespace separated, '' and "" quoting, backslash escapes anything"""
+    args = []
+    arg = None
+    quote = None
+    escape = False
+    for ch in text:
+        if escape:
+            arg = (arg or '') + ch
+            escape = False
+        elif ch == '\\':
+            escape = True
+        elif quote is not None:
+            if ch == quote:
+                quote = None
+            else:
+                arg += ch
+        elif ch in '\'"':
+            quote = ch
+            arg = arg or ''
+        elif ch.isspace():
+            if arg is not None:
+                args.append(arg)
+                arg = None
+        else:
+            arg = (arg or '') + ch
+    if arg is not None:
+        args.append(arg)
+    return args
+
+
+def expand_response_files(args: List[str], depth: int = 0) -> List[str]:
+    """
+    Replace @file arguments with the arguments in the file. platformio (SCons TEMPFILE) puts
+    long command lines, i.e. most of an ESP32 compile on Windows, into one.
+    A @file that can't be read is kept as it is, same as gcc does.
+    """
+    expanded_args = []
+    for arg in args:
+        if arg.startswith('@') and depth < MAX_RESPONSE_FILE_DEPTH:
+            try:
+                with open(arg[1:], 'r') as fp:
+                    file_args = split_response_file(fp.read())
+            except OSError:
+                expanded_args.append(arg)
+                continue
+            expanded_args.extend(expand_response_files(file_args, depth + 1))
+        else:
+            expanded_args.append(arg)
+    return expanded_args
+
+
+def write_response_file(args: List[str]) -> str:
+    tmp_fd, tmp_name = tempfile.mkstemp(suffix='.rsp', prefix='oatfwgui_')
+    with os.fdopen(tmp_fd, 'w') as fp:
+        fp.write(' '.join('"' + a.replace('\\', '\\\\').replace('"', '\\"') + '"' for a in args))
+    return tmp_name
+
+
+def parse_compile_args(args: List[str]) -> Optional[Tuple[str, str]]:
+    """Returns (output, source) for a plain single source compile, else None (not cacheable)"""
+    if '-c' not in args or '-o' not in args or any(a.startswith('@') or a.startswith('-M') for a in args):
+        return None
+    output_idx = args.index('-o') + 1
+    if output_idx >= len(args):
+        return None
+    sources = [a for a in args if a.endswith(SOURCE_SUFFIXES) and not a.startswith('-')]
+    if len(sources) != 1:
+        return None
+    return args[output_idx], sources[0]
+
+
+def hashed_flags(args: List[str], output: str, source: str) -> List[str]:
+    flags = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+        elif arg in PATH_ARGS or arg == '-o':
+            skip_next = True
+        elif arg in (output, source) or any(arg.startswith(p) for p in PATH_ARGS):
+            continue
+        else:
+            flags.append(arg)
+    return flags
+
+
+def compiler_identity(compiler: str) -> str:
+    compiler_path = shutil.which(compiler) or compiler
+    compiler_stat = os.stat(compiler_path)
+    return f'{os.path.realpath(compiler_path)}:{compiler_stat.st_size}:{compiler_stat.st_mtime_ns}'
+
+
+def cache_key(compiler: str, args: List[str], output: str, source: str,
+              use_response_file: bool = False) -> Optional[str]:
+    # -P drops the line markers, they have absolute paths in them
+    preprocess_args = [a for a in args if a != '-c']
+    output_idx = preprocess_args.index('-o')
+    del preprocess_args[output_idx:output_idx + 2]
+    preprocess_args += ['-E', '-P']
+    response_file_path = None
+    if use_response_file:
+        # Too long for the command line, that's why platformio used a response file
+        response_file_path = write_response_file(preprocess_args)
+        preprocess_args = [f'@{response_file_path}']
+    try:
+        sub_proc = subprocess.run([compiler] + preprocess_args,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    finally:
+        if response_file_path is not None:
+            os.unlink(response_file_path)
+    if sub_proc.returncode != 0:
+        return None  # let the real compile report the error
+    sha256 = hashlib.sha256()
+    sha256.update(compiler_identity(compiler).encode())
+    sha256.update('\0'.join(hashed_flags(args, output, source)).encode())
+    sha256.update(os.path.splitext(source)[1].encode())
+    sha256.update(sub_proc.stdout)
+    return sha256.hexdigest()
+
+
+def append_line(file_path: str, line: str):
+    # Single small appends, so parallel compiles/steps don't mix up lines
+    fd = os.open(file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, f'{line}\n'.encode())
+    finally:
+        os.close(fd)
+
+
+def record_stat(result: str):
+    stats_path = os.environ.get(STATS_PATH_ENV)
+    if stats_path:
+        append_line(stats_path, result)
+
+
+def copy_replace(src_path: str, dest_path: str):
+    tmp_path = f'{dest_path}.{os.getpid()}.tmp'
+    shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+def run_cached(compiler: str, args: List[str]) -> int:
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    # The real compile still gets args, with the response files
+    expanded_args = expand_response_files(args)
+    parsed_args = parse_compile_args(expanded_args)
+    key = None
+    if cache_dir and parsed_args is not None:
+        key = cache_key(compiler, expanded_args, *parsed_args, use_response_file=expanded_args != args)
+    if key is None:
+        return subprocess.call([compiler] + args)
+
+    output, _ = parsed_args
+    object_path = os.path.join(cache_dir, key[:2], f'{key}.o')
+    stderr_path = os.path.join(cache_dir, key[:2], f'{key}.stderr')
+    if os.path.isfile(object_path):
+        copy_replace(object_path, output)
+        os.utime(object_path)  # for least recently used trimming
+        if os.path.isfile(stderr_path):
+            # Replay warnings, so a cache hit looks the same as a compile
+            with open(stderr_path, 'rb') as fp:
+                sys.stderr.buffer.write(fp.read())
+        record_stat('hit')
+        return 0
+
+    sub_proc = subprocess.run([compiler] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    sys.stdout.buffer.write(sub_proc.stdout)
+    sys.stderr.buffer.write(sub_proc.stderr)
+    if sub_proc.returncode == 0 and os.path.isfile(output):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if sub_proc.stderr:
+            with open(f'{stderr_path}.{os.getpid()}.tmp', 'wb') as fp:
+                fp.write(sub_proc.stderr)
+            os.replace(f'{stderr_path}.{os.getpid()}.tmp', stderr_path)
+        copy_replace(output, object_path)
+        # The bytes added to the cache, so trimming doesn't have to walk it to know its size
+        record_stat(f'miss {os.path.getsize(object_path) + len(sub_proc.stderr)}')
+    return sub_proc.returncode
+
+
+def main() -> int:
+    if len(sys.argv) < 2:
+        print(f'usage: {sys.argv[0]} <compiler> [compiler args...]', file=sys.stderr)
+        return 2
+    compiler, args = sys.argv[1], sys.argv[2:]
+    try:
+        return run_cached(compiler, args)
+    except OSError as e:
+        # Never fail a build because of the cache
+        print(f'compiler_cache.py: {e}, compiling without cache', file=sys.stderr)
+        return subprocess.call([compiler] + args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
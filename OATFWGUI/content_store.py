@@ -0,0 +1,98 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import logging
+from pathlib import Path
+from typing import BinaryIO
+
+log = logging.getLogger('')
+
+# An object add() has just returned isn't linked into a worktree yet, leave it alone for a while
+PRUNE_MIN_AGE_S = 10 * 60
+
+
+class ContentStore:
+    """
+    Files stored by the sha256 of their content, and hard linked into wherever they're
+    needed. A file that is identical in several firmware worktrees only takes up disk
+    space once.
+
+    Because the same inode is shared, anything written into a worktree has to replace
+    the file (write a temporary file and rename it over), never modify it in place.
+    """
+
+    def __init__(self, store_dir: Path):
+        self.store_dir = store_dir
+        self.objects_dir = Path(store_dir, 'objects')
+        # An empty file per object, touched whenever add() hands the object out. Not the
+        # object itself, that inode is shared with the worktrees.
+        self.used_dir = Path(store_dir, 'used')
+        self.tmp_dir = Path(store_dir, 'tmp')
+
+    def object_path(self, digest: str) -> Path:
+        return Path(self.objects_dir, digest[:2], digest)
+
+    def used_path(self, digest: str) -> Path:
+        return Path(self.used_dir, digest[:2], digest)
+
+    def _mark_used(self, digest: str):
+        used_path = self.used_path(digest)
+        used_path.parent.mkdir(parents=True, exist_ok=True)
+        used_path.touch()
+
+    def add(self, src_fp: BinaryIO) -> Path:
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        hasher = hashlib.sha256()
+        tmp_fd, tmp_name = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(tmp_fd, 'wb') as tmp_fp:
+            for chunk in iter(lambda: src_fp.read(64 * 1024), b''):
+                hasher.update(chunk)
+                tmp_fp.write(chunk)
+        digest = hasher.hexdigest()
+        obj_path = self.object_path(digest)
+        if obj_path.exists():
+            os.unlink(tmp_name)
+        else:
+            obj_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_name, obj_path)
+        self._mark_used(digest)  # see prune()
+        return obj_path
+
+    def materialize(self, src_fp: BinaryIO, dest_path: Path):
+        obj_path = self.add(src_fp)
+        tmp_dest_path = dest_path.with_name(dest_path.name + '.oatfwgui_tmp')
+        tmp_dest_path.unlink(missing_ok=True)
+        try:
+            os.link(obj_path, tmp_dest_path)
+        except OSError as e:
+            # e.g. the store and worktree are on different filesystems
+            log.debug(f'Could not hard link {obj_path}, copying instead: {e}')
+            shutil.copyfile(obj_path, tmp_dest_path)
+        os.replace(tmp_dest_path, dest_path)
+
+    def prune(self) -> int:
+        # An object that is only linked from the store isn't used by any worktree
+        num_pruned = 0
+        if not self.objects_dir.is_dir():
+            return num_pruned
+        prune_before = time.time() - PRUNE_MIN_AGE_S
+        for obj_path in self.objects_dir.glob('*/*'):
+            used_path = self.used_path(obj_path.name)
+            try:
+                if obj_path.stat().st_nlink > 1:
+                    continue
+                try:
+                    if used_path.stat().st_mtime >= prune_before:
+                        continue
+                except FileNotFoundError:
+                    pass  # i.e. stored by an older OATFWGUI, the link count is all there is
+                obj_path.unlink()
+                used_path.unlink(missing_ok=True)
+                num_pruned += 1
+            except FileNotFoundError:
+                pass  # i.e. pruned by another OATFWGUI at the same time
+        log.debug(f'Pruned {num_pruned} unused objects from {self.store_dir}')
+        return num_pruned
+
@@ -0,0 +1,167 @@
+import json
+import hashlib
+import logging
+import zipfile
+from pathlib import Path
+from typing import Optional, Callable, Tuple, NamedTuple
+
+import requests
+
+import network
+
+log = logging.getLogger('')
+
+# (connect, read) timeouts in seconds
+DOWNLOAD_TIMEOUT = (10.0, 30.0)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_MAX_ATTEMPTS = 5
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadResult(NamedTuple):
+    path: Optional[Path]  # None if the server said the resource was not modified
+    etag: Optional[str]
+
+
+def _part_paths(dest_path: Path) -> Tuple[Path, Path]:
+    part_path = dest_path.with_name(dest_path.name + '.part')
+    part_meta_path = dest_path.with_name(dest_path.name + '.part.json')
+    return part_path, part_meta_path
+
+
+def _read_part_meta(part_meta_path: Path) -> dict:
+    try:
+        with open(part_meta_path, 'r') as fp:
+            return json.load(fp)
+    except (OSError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def _write_part_meta(part_meta_path: Path, part_meta: dict):
+    with open(part_meta_path, 'w') as fp:
+        json.dump(part_meta, fp)
+
+
+def _total_size_from_response(r: requests.Response, resume_from: int) -> Optional[int]:
+    if r.status_code == requests.codes.partial_content:
+        # Content-Range: bytes 1000-4999/5000
+        content_range = r.headers.get('Content-Range', '')
+        total_str = content_range.rpartition('/')[2]
+        if total_str.isdigit():
+            return int(total_str)
+        return None
+    content_length = r.headers.get('Content-Length')
+    if content_length is not None and content_length.isdigit():
+        return int(content_length) + resume_from
+    return None
+
+
+def _hash_file(file_path: Path, hasher) -> None:
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def stream_download(url: str, dest_path: Path,
+                    progress_callback: Optional[Callable[[int], None]] = None,
+                    expected_size: Optional[int] = None,
+                    expected_sha256: Optional[str] = None,
+                    if_none_match: Optional[str] = None) -> DownloadResult:
+    """
+    Download url to dest_path without holding the file in memory. Data is written to a
+    `.part` file next to dest_path, and if a previous download of the same url was
+    interrupted only the missing bytes are requested (HTTP Range). The `.part` file is
+    renamed to dest_path once its size (and optionally sha256) has been validated.
+
+    progress_callback is called with a percentage, or -1 if the total size is unknown.
+    If if_none_match is given and the server replies 304, nothing is downloaded.
+    """
+    part_path, part_meta_path = _part_paths(dest_path)
+    part_meta = _read_part_meta(part_meta_path)
+    if part_meta.get('url') != url and part_path.exists():
+        log.info(f'Discarding partial download of {part_meta.get("url")}')
+        part_path.unlink()
+
+    last_percent = None
+
+    def report_progress(num_bytes: int, total_bytes: Optional[int]):
+        nonlocal last_percent
+        if progress_callback is None:
+            return
+        percent = -1 if not total_bytes else min(100, num_bytes * 100 // total_bytes)
+        if percent != last_percent:
+            last_percent = percent
+            progress_callback(percent)
+
+    total_size = expected_size
+    for attempt in range(1, DOWNLOAD_MAX_ATTEMPTS + 1):
+        resume_from = part_path.stat().st_size if part_path.exists() else 0
+        # Byte ranges and sizes only line up if the body isn't content-encoded
+        headers = {'Accept-Encoding': 'identity'}
+        if resume_from > 0:
+            headers['Range'] = f'bytes={resume_from}-'
+            if part_meta.get('etag'):
+                # If the resource changed, the server sends the whole thing instead of a range
+                headers['If-Range'] = part_meta['etag']
+            log.info(f'Resuming download at {resume_from} bytes')
+        elif if_none_match is not None:
+            headers['If-None-Match'] = if_none_match
+        try:
+            with network.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status_code == requests.codes.not_modified:
+                    log.info(f'{url} not modified (ETag {if_none_match})')
+                    return DownloadResult(None, if_none_match)
+                if r.status_code == requests.codes.requested_range_not_satisfiable:
+                    log.warning(f'Server rejected range {resume_from}-, restarting download')
+                    part_path.unlink()
+                    continue
+                if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+                    raise DownloadError(f'Failed to download {url}: {r.status_code} {r.reason}')
+                if r.status_code == requests.codes.ok and resume_from > 0:
+                    log.info('Server does not support resuming this download, starting over')
+                    resume_from = 0
+
+                total_size = _total_size_from_response(r, resume_from) or total_size
+                part_meta = {'url': url, 'etag': r.headers.get('ETag')}
+                _write_part_meta(part_meta_path, part_meta)
+
+                num_bytes = resume_from
+                report_progress(num_bytes, total_size)
+                with open(part_path, 'ab' if resume_from > 0 else 'wb') as fd:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        fd.write(chunk)
+                        num_bytes += len(chunk)
+                        report_progress(num_bytes, total_size)
+            break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            log.warning(f'Download attempt {attempt}/{DOWNLOAD_MAX_ATTEMPTS} interrupted: {e}')
+    else:
+        raise DownloadError(f'Could not download {url} after {DOWNLOAD_MAX_ATTEMPTS} attempts')
+
+    downloaded_size = part_path.stat().st_size
+    if total_size is not None and downloaded_size != total_size:
+        part_path.unlink()
+        raise DownloadError(f'Downloaded size {downloaded_size} does not match expected size {total_size}')
+    if expected_sha256 is not None:
+        hasher = hashlib.sha256()
+        _hash_file(part_path, hasher)
+        if hasher.hexdigest() != expected_sha256.lower():
+            part_path.unlink()
+            raise DownloadError(f'Checksum mismatch for {url}: {hasher.hexdigest()} != {expected_sha256}')
+
+    part_path.replace(dest_path)
+    part_meta_path.unlink(missing_ok=True)
+    report_progress(downloaded_size, downloaded_size)
+    log.info(f'Downloaded {downloaded_size} bytes to {dest_path}')
+    return DownloadResult(dest_path, part_meta.get('etag'))
+
+
+def validate_zip(zip_path: Path):
+    # Checks that the central directory is present, i.e. the archive isn't truncated
+    if not zipfile.is_zipfile(zip_path):
+        raise DownloadError(f'{zip_path} is not a valid zip file')
@@ -1,5 +1,6 @@
 import sys
 import logging
+import importlib.metadata
 from typing import List, Dict, Optional, Callable
 from pathlib import Path
 
@@ -20,10 +21,14 @@ class ExternalProcess:
         self.state = QProcess.NotRunning
 
         self.qproc: Optional[QProcess] = None
+        self.stdout_callback: Optional[Callable[[str], None]] = None
 
     def start(self, extra_args: List[str], finish_signal: Optional[Callable],
-              env_vars: Optional[Dict[str, str]] = None):
+              env_vars: Optional[Dict[str, str]] = None,
+              stdout_callback: Optional[Callable[[str], None]] = None):
         self.qproc = QProcess()
+        # Gets each new chunk of stdout as it arrives, i.e. for parsing build progress
+        self.stdout_callback = stdout_callback
         self.qproc.setProgram(self.proc_name)
         self.qproc.setArguments(self.base_args)
 
@@ -59,6 +64,7 @@ class ExternalProcess:
         log.debug(f'Cleaning up external process: {self.proc_name}. Exited with {self.qproc.exitCode()}')
         self.stdout_text = ''
         self.stderr_text = ''
+        self.stdout_callback = None
         self.qproc.deleteLater()
 
     @Slot()
@@ -74,6 +80,8 @@ class ExternalProcess:
         stdout = decode_bytes(bytes(data))
         self.stdout_text += stdout
         log.info(stdout)
+        if self.stdout_callback is not None:
+            self.stdout_callback(stdout)
 
     @Slot()
     def handle_state(self, state):
@@ -112,3 +120,10 @@ def get_install_dir(cache=True) -> Path:
         main_script_parent_dir = main_script_path.parent.parent.resolve()
         log.debug(f'Install directory is {main_script_parent_dir}')
     return main_script_parent_dir
+
+
+def get_platformio_version() -> Optional[str]:
+    try:
+        return importlib.metadata.version('platformio')
+    except importlib.metadata.PackageNotFoundError:
+        return None
@@ -0,0 +1,96 @@
+import time
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional, Callable, Dict
+
+from download_utils import stream_download, validate_zip
+from misc_utils import load_json_index, save_json_index
+
+log = logging.getLogger('')
+
+FW_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _sha256_str(in_str: str) -> str:
+    return hashlib.sha256(in_str.encode()).hexdigest()
+
+
+class FWArchiveCache:
+    """
+    Persistent cache of downloaded firmware archives. Archives are stored by a hash of
+    their URL and the ETag the server gave us, so the same file name always means the
+    same content. Tagged releases never change, so a cache hit doesn't touch the network.
+    Branches are revalidated with a conditional request, which is just a 304 if nothing
+    was pushed. Least recently used archives are evicted once over max_bytes.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = FW_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = Path(cache_dir, 'index.json')
+        self.index: Dict[str, dict] = {}
+        self._load_index()
+
+    def _load_index(self):
+        self.index = load_json_index(self.index_path, 'FW cache index')
+        # Forget about any entries whose archive has gone missing
+        self.index = {
+            url: entry for url, entry in self.index.items()
+            if Path(self.cache_dir, entry['file']).is_file()
+        }
+
+    def _save_index(self):
+        save_json_index(self.index_path, self.index)
+
+    def get(self, url: str, is_branch: bool,
+            progress_callback: Optional[Callable[[int], None]] = None) -> Path:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = self.index.get(url)
+        if entry is not None and not is_branch:
+            log.info(f'FW archive cache hit for {url}')
+            return self._touch(url)
+
+        # Download into a per-url file so an interrupted download can be resumed
+        incoming_path = Path(self.cache_dir, f'incoming_{_sha256_str(url)[:16]}.zip')
+        if_none_match = entry['etag'] if entry is not None else None
+        result = stream_download(url, incoming_path, progress_callback=progress_callback,
+                                 if_none_match=if_none_match)
+        if result.path is None:
+            log.info(f'FW archive cache revalidated for {url}')
+            return self._touch(url)
+
+        validate_zip(result.path)
+        archive_name = f'{_sha256_str(url + chr(10) + (result.etag or str(time.time())))}.zip'
+        archive_path = Path(self.cache_dir, archive_name)
+        result.path.replace(archive_path)
+        if entry is not None and entry['file'] != archive_name:
+            Path(self.cache_dir, entry['file']).unlink(missing_ok=True)
+        self.index[url] = {
+            'file': archive_name,
+            'etag': result.etag,
+            'size': archive_path.stat().st_size,
+            'last_used': time.time(),
+        }
+        self._evict(keep_url=url)
+        self._save_index()
+        return archive_path
+
+    def _touch(self, url: str) -> Path:
+        entry = self.index[url]
+        entry['last_used'] = time.time()
+        self._save_index()
+        return Path(self.cache_dir, entry['file'])
+
+    def _evict(self, keep_url: str):
+        total_bytes = sum(entry['size'] for entry in self.index.values())
+        lru_urls = sorted(self.index, key=lambda u: self.index[u]['last_used'])
+        for url in lru_urls:
+            if total_bytes <= self.max_bytes:
+                break
+            if url == keep_url:
+                continue
+            entry = self.index.pop(url)
+            log.info(f'Evicting {url} from FW archive cache ({entry["size"]} bytes)')
+            Path(self.cache_dir, entry['file']).unlink(missing_ok=True)
+            total_bytes -= entry['size']
@@ -0,0 +1,263 @@
+import os
+import time
+import uuid
+import logging
+import threading
+import subprocess
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Dict, Optional, NamedTuple
+
+from build_cache import BuildCache, build_cache_key
+from hot_patches import HotPatchResult, get_hot_patcher
+from lib_mirror import LibMirror
+from pio_project import get_pio_project
+from external_processes import external_processes, get_install_dir, get_platformio_version
+from misc_utils import atomic_write_text, copy_file_if_changed, decode_bytes
+
+log = logging.getLogger('')
+
+COMPILER_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# One per compile. ccache 4.x also logs other counters (i.e. local_storage_hit) for the same compile.
+COMPILER_CACHE_HIT_COUNTERS = ['hit', 'direct_cache_hit', 'preprocessed_cache_hit']
+COMPILER_CACHE_MISS_COUNTERS = ['miss', 'cache_miss']
+# Builds of a matrix finish at the same time, only one updates the tracked cache size
+compiler_cache_size_lock = threading.Lock()
+
+
+class CompilerCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    added_bytes: int  # only compiler_cache.py reports these, ccache trims itself
+
+
+class EnvBuildResult(NamedTuple):
+    pio_env: str
+    success: bool
+    from_cache: bool
+    duration_s: float
+    log_path: Optional[Path]
+
+
+@lru_cache(maxsize=1)
+def get_build_cache() -> BuildCache:
+    return BuildCache(Path(get_install_dir(), '.build_cache'))
+
+
+@lru_cache(maxsize=1)
+def get_lib_mirror() -> LibMirror:
+    return LibMirror(Path(get_install_dir(), '.lib_mirror'), run_platformio, Path(get_install_dir(), 'logs'))
+
+
+def do_hot_patches(fw_dir: Path, is_avr_based: bool, fw_version_name: Optional[str] = None) -> HotPatchResult:
+    result = get_hot_patcher().patch(fw_dir, is_avr_based, fw_version_name)
+    if result.fired:
+        log.info(f'Hot patches applied: {result.fired}')
+    return result
+
+
+def install_config_file(config_file_path: Path, fw_dir: Path) -> Path:
+    """Copy the local config into the firmware directory. Raises OSError if it can't be copied."""
+    config_dest_path = Path(fw_dir, 'Configuration_local.hpp').resolve()
+    if config_dest_path == Path(config_file_path).resolve():
+        log.info(f'Not copying config file since source and destination are the same: {config_dest_path}')
+        return config_dest_path
+    # Almost everything includes the config, so only touch it if it actually changed
+    if copy_file_if_changed(Path(config_file_path), config_dest_path):
+        log.info(f'Copied config file from {config_file_path} -> {config_dest_path}')
+    else:
+        log.info(f'Config file {config_dest_path} is unchanged, not copying')
+    return config_dest_path
+
+
+def get_build_env_vars(fw_dir: Path, pio_env: str) -> Dict[str, str]:
+    env_config = get_pio_project(fw_dir).env(pio_env)
+    log.info(f'Extra scripts={env_config.extra_scripts}')
+    if not any('iprefix' in extra_script for extra_script in env_config.extra_scripts) \
+            and not env_config.is_avr_based:
+        # Make sure base firmware doesn't already have the iprefix script
+        # AND
+        # Shouldn't be harmful, but it's a bit weird so we only do this on
+        # esp32 boards. Assume that anything not AVR based is esp32 :S
+        pre_script_path = Path(get_install_dir(), 'OATFWGUI', 'pre_script_esp32_iprefix.py')
+        return {'PLATFORMIO_EXTRA_SCRIPTS': f'pre:{pre_script_path.absolute()}'}
+    return {}
+
+
+def get_compiler_cache_dir() -> Path:
+    return Path(get_install_dir(), '.compiler_cache')
+
+
+def new_compiler_cache_stats_path() -> Path:
+    stats_dir = Path(get_compiler_cache_dir(), 'stats')
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    return Path(stats_dir, f'{uuid.uuid4().hex}.log')
+
+
+def with_compiler_cache(env_vars: Dict[str, str], stats_path: Path) -> Dict[str, str]:
+    """
+    Add the compiler cache pre-script to a build's environment variables. Kept separate from
+    get_build_env_vars since it doesn't change the build output (so isn't in the build cache key).
+    """
+    compiler_cache_dir = get_compiler_cache_dir()
+    pre_script_path = Path(get_install_dir(), 'OATFWGUI', 'pre_script_compiler_cache.py')
+    cache_env_vars = dict(env_vars)
+    cache_env_vars.update({
+        'OATFWGUI_COMPILER_CACHE_DIR': str(Path(compiler_cache_dir, 'objects')),
+        'OATFWGUI_COMPILER_CACHE_WRAPPER': str(Path(get_install_dir(), 'OATFWGUI', 'compiler_cache.py')),
+        'OATFWGUI_COMPILER_CACHE_STATS': str(stats_path),
+        # Only used if ccache is installed
+        'CCACHE_DIR': str(Path(compiler_cache_dir, 'ccache')),
+        'CCACHE_BASEDIR': str(get_install_dir()),  # so paths in different worktrees hash the same
+        'CCACHE_NOHASHDIR': 'true',
+        'CCACHE_STATSLOG': str(stats_path),
+        'CCACHE_MAXSIZE': f'{COMPILER_CACHE_MAX_BYTES // (1024 * 1024)}M',
+    })
+    add_extra_script(cache_env_vars, pre_script_path)
+    return cache_env_vars
+
+
+def add_extra_script(env_vars: Dict[str, str], pre_script_path: Path):
+    # After any scripts already there, i.e. the iprefix script
+    extra_scripts = [f'pre:{pre_script_path.absolute()}']
+    if 'PLATFORMIO_EXTRA_SCRIPTS' in env_vars:
+        extra_scripts.insert(0, env_vars['PLATFORMIO_EXTRA_SCRIPTS'])
+    env_vars['PLATFORMIO_EXTRA_SCRIPTS'] = ', '.join(extra_scripts)
+    # So the pre-scripts can import scons_launcher.py
+    env_vars['OATFWGUI_SCRIPT_DIR'] = str(pre_script_path.parent.absolute())
+
+
+def with_build_timer(env_vars: Dict[str, str], times_path: Path) -> Dict[str, str]:
+    """Add the build timer pre-script to a build's environment variables, see build_times.py"""
+    pre_script_path = Path(get_install_dir(), 'OATFWGUI', 'pre_script_build_timer.py')
+    timer_env_vars = dict(env_vars)
+    timer_env_vars.update({
+        'OATFWGUI_BUILD_TIMER': str(Path(get_install_dir(), 'OATFWGUI', 'build_timer.py')),
+        'OATFWGUI_BUILD_TIMES': str(times_path),
+    })
+    add_extra_script(timer_env_vars, pre_script_path)
+    return timer_env_vars
+
+
+def read_compiler_cache_stats(stats_path: Path) -> CompilerCacheStats:
+    hits, misses, added_bytes = 0, 0, 0
+    try:
+        with open(stats_path, 'r') as fp:
+            stat_lines = fp.readlines()
+    except FileNotFoundError:
+        return CompilerCacheStats(hits, misses, added_bytes)
+    for stat_line in stat_lines:
+        # ccache's stats log also has '# <source file>' lines
+        if stat_line.startswith('#') or not stat_line.strip():
+            continue
+        # compiler_cache.py logs 'miss <bytes stored>'
+        counter, *counter_args = stat_line.split()
+        if counter in COMPILER_CACHE_HIT_COUNTERS:
+            hits += 1
+        elif counter in COMPILER_CACHE_MISS_COUNTERS:
+            misses += 1
+            if counter_args and counter_args[0].isdigit():
+                added_bytes += int(counter_args[0])
+    return CompilerCacheStats(hits, misses, added_bytes)
+
+
+def log_compiler_cache_stats(stats_path: Path):
+    stats = read_compiler_cache_stats(stats_path)
+    stats_path.unlink(missing_ok=True)
+    if stats.hits + stats.misses == 0:
+        log.info('Compiler cache: nothing compiled')
+        return
+    log.info(f'Compiler cache: {stats.hits} hits, {stats.misses} misses '
+             f'({stats.hits / (stats.hits + stats.misses) * 100:.0f}% hit rate)')
+    trim_compiler_cache(stats.added_bytes)
+
+
+def trim_compiler_cache(added_bytes: int, max_bytes: int = COMPILER_CACHE_MAX_BYTES):
+    # ccache trims itself, this is for compiler_cache.py. The size is tracked in a file,
+    # the objects are only walked when that says they're over the budget (or it's missing).
+    size_path = Path(get_compiler_cache_dir(), 'objects_size.txt')
+    with compiler_cache_size_lock:
+        try:
+            total_bytes = int(size_path.read_text()) + added_bytes
+        except (OSError, ValueError):
+            total_bytes = None
+        if total_bytes is None or total_bytes > max_bytes:
+            total_bytes = trim_compiler_cache_objects(max_bytes)
+        atomic_write_text(size_path, str(total_bytes))
+
+
+def trim_compiler_cache_objects(max_bytes: int) -> int:
+    # Hits touch the object, so oldest mtime == least used. Returns the size left.
+    cache_files = []
+    for sub_dir, _, file_names in os.walk(Path(get_compiler_cache_dir(), 'objects')):
+        for file_name in file_names:
+            file_stat = os.stat(os.path.join(sub_dir, file_name))
+            cache_files.append((file_stat.st_mtime, file_stat.st_size, os.path.join(sub_dir, file_name)))
+    total_bytes = sum(size for _, size, _ in cache_files)
+    for _, size, file_path in sorted(cache_files):
+        if total_bytes <= max_bytes:
+            break
+        os.unlink(file_path)
+        total_bytes -= size
+    return total_bytes
+
+
+def get_build_dir(fw_dir: Path, pio_env: str) -> Path:
+    return Path(fw_dir, '.pio', 'build', pio_env)
+
+
+def pio_command() -> List[str]:
+    # Same program the GUI runs, i.e. `python -m platformio` in embedded python
+    pio_proc = external_processes['platformio']
+    return [pio_proc.proc_name] + pio_proc.base_args
+
+
+def run_platformio(pio_args: List[str], env_vars: Dict[str, str], log_path: Path) -> int:
+    """
+    Run platformio as a plain subprocess (no Qt event loop needed), so several can run at once.
+    All output goes to log_path. Returns the exit code.
+    """
+    all_args = pio_command() + pio_args
+    proc_env = dict(os.environ)
+    proc_env.update(env_vars)
+    log.info(f'Starting {all_args} with env {env_vars}, logging to {log_path}')
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, 'w') as log_fp:
+        sub_proc = subprocess.Popen(all_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=proc_env)
+        for line in sub_proc.stdout:
+            log_fp.write(decode_bytes(line))
+        return sub_proc.wait()
+
+
+def build_env(fw_dir: Path, pio_env: str, fw_name: str, jobs: Optional[int], log_path: Path) -> EnvBuildResult:
+    """
+    Build one environment of an already patched firmware directory, with the config already
+    installed. Goes through the build cache, so an unchanged build doesn't run platformio at all.
+    """
+    start_time = time.perf_counter()
+    env_vars = get_build_env_vars(fw_dir, pio_env)
+    cache_key = build_cache_key(fw_dir, Path(fw_dir, 'Configuration_local.hpp'), pio_env,
+                                get_platformio_version(), env_vars)
+    if get_build_cache().restore(cache_key, get_build_dir(fw_dir, pio_env)):
+        return EnvBuildResult(pio_env, True, True, time.perf_counter() - start_time, None)
+
+    pio_args = ['run', '--environment', pio_env, '--project-dir', str(fw_dir), '--verbose']
+    if jobs is not None:
+        pio_args += ['--jobs', str(jobs)]
+    stats_path = new_compiler_cache_stats_path()
+    try:
+        get_lib_mirror().prepare(fw_dir, pio_env)
+        exit_code = run_platformio(pio_args, with_compiler_cache(env_vars, stats_path), log_path)
+    except OSError as e:
+        log.error(f'Could not run platformio for {pio_env}: {e}')
+        exit_code = -1
+    log_compiler_cache_stats(stats_path)
+    success = exit_code == 0
+    duration_s = time.perf_counter() - start_time
+    if success:
+        log.info(f'Built {pio_env} in {duration_s:.1f}s')
+        get_lib_mirror().store(fw_dir, pio_env)
+        get_build_cache().store(cache_key, get_build_dir(fw_dir, pio_env), pio_env, fw_name)
+    else:
+        log.error(f'Building {pio_env} failed ({exit_code}), see {log_path}')
+    return EnvBuildResult(pio_env, success, False, duration_s, log_path)
@@ -0,0 +1,220 @@
+import os
+import json
+import zlib
+import shutil
+import fnmatch
+import logging
+import zipfile
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple, Dict
+
+from content_store import ContentStore
+
+log = logging.getLogger('')
+
+# Paths (relative to the top level firmware directory) that the build never needs
+DEFAULT_SKIP_PATTERNS = [
+    '.github/*',
+    '.vscode/*',
+    '.devcontainer/*',
+    'docs/*',
+    '*.png',
+    '*.jpg',
+    '*.jpeg',
+    '*.gif',
+    '*.svg',
+    '*.pdf',
+]
+# Members bigger than this are decompressed on the thread pool
+LARGE_MEMBER_BYTES = 256 * 1024
+EXTRACT_MAX_WORKERS = 4
+# Records what the last sync wrote, so we know what to delete next time
+SYNC_MANIFEST_NAME = '.oatfwgui_manifest.json'
+# Never touched by a sync: build outputs/libdeps and the user's configuration
+SYNC_PRESERVE_PATTERNS = [
+    '.pio/*',
+    'Configuration_local*.hpp',
+    SYNC_MANIFEST_NAME,
+]
+
+
+class ExtractError(Exception):
+    pass
+
+
+def get_top_level_prefix(zip_infolist: List[zipfile.ZipInfo]) -> str:
+    # GitHub archives have everything under a single directory like OpenAstroTracker-Firmware-1a2b3c/
+    top_level_names = {info.filename.split('/', maxsplit=1)[0] for info in zip_infolist}
+    if len(top_level_names) != 1:
+        raise ExtractError(f'Could not find FW top level directory, found {sorted(top_level_names)[:10]}')
+    return top_level_names.pop() + '/'
+
+
+def strip_member_path(info: zipfile.ZipInfo, prefix: str) -> Optional[PurePosixPath]:
+    rel_name = info.filename[len(prefix):]
+    if not rel_name or info.is_dir():
+        return None
+    rel_path = PurePosixPath(rel_name)
+    if rel_path.is_absolute() or '..' in rel_path.parts:
+        raise ExtractError(f'Refusing to extract {info.filename} outside of the target directory')
+    return rel_path
+
+
+def is_skipped(rel_path: PurePosixPath, skip_patterns: Sequence[str]) -> bool:
+    rel_str = str(rel_path)
+    return any(fnmatch.fnmatch(rel_str, pattern) for pattern in skip_patterns)
+
+
+def extract_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo, dest_path: Path,
+                   content_store: Optional[ContentStore] = None):
+    if content_store is not None:
+        with zip_ref.open(info) as src_fp:
+            content_store.materialize(src_fp, dest_path)
+        return
+    # Write to a temporary file first so that an interrupted extraction never leaves a truncated file
+    tmp_path = dest_path.with_name(dest_path.name + '.oatfwgui_tmp')
+    with zip_ref.open(info) as src_fp, open(tmp_path, 'wb') as dst_fp:
+        shutil.copyfileobj(src_fp, dst_fp, 64 * 1024)
+    os.replace(tmp_path, dest_path)
+
+
+def extract_members(zip_ref: zipfile.ZipFile, to_extract: List[Tuple[zipfile.ZipInfo, Path]],
+                    max_workers: int = EXTRACT_MAX_WORKERS, content_store: Optional[ContentStore] = None):
+    for parent_dir in {dest_path.parent for _, dest_path in to_extract}:
+        os.makedirs(parent_dir, exist_ok=True)
+
+    # Small files are quicker to just do inline, only farm out the big ones
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(extract_member, zip_ref, info, dest_path, content_store)
+            for info, dest_path in to_extract
+            if info.file_size >= LARGE_MEMBER_BYTES
+        ]
+        for info, dest_path in to_extract:
+            if info.file_size < LARGE_MEMBER_BYTES:
+                extract_member(zip_ref, info, dest_path, content_store)
+        for future in futures:
+            future.result()  # re-raise any exceptions
+
+
+def list_fw_members(zip_ref: zipfile.ZipFile,
+                    skip_patterns: Sequence[str]) -> Tuple[Dict[PurePosixPath, zipfile.ZipInfo], int]:
+    prefix = get_top_level_prefix(zip_ref.infolist())
+    members = {}
+    num_skipped = 0
+    for info in zip_ref.infolist():
+        rel_path = strip_member_path(info, prefix)
+        if rel_path is None:
+            continue
+        if is_skipped(rel_path, skip_patterns):
+            num_skipped += 1
+            continue
+        members[rel_path] = info
+    return members, num_skipped
+
+
+def file_crc32(file_path: Path) -> int:
+    crc = 0
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def read_sync_manifest(target_dir: Path) -> Optional[Dict[str, dict]]:
+    try:
+        with open(Path(target_dir, SYNC_MANIFEST_NAME), 'r') as fp:
+            return json.load(fp)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+
+
+def write_sync_manifest(target_dir: Path, manifest: Dict[str, dict]):
+    manifest_path = Path(target_dir, SYNC_MANIFEST_NAME)
+    tmp_manifest_path = manifest_path.with_name(manifest_path.name + '.oatfwgui_tmp')
+    with open(tmp_manifest_path, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_manifest_path, manifest_path)
+
+
+def is_unchanged(dest_path: Path, info: zipfile.ZipInfo, manifest_entry: Optional[dict]) -> bool:
+    try:
+        dest_stat = dest_path.stat()
+    except FileNotFoundError:
+        return False
+    if dest_stat.st_size != info.file_size:
+        return False
+    if manifest_entry is not None and \
+            manifest_entry['crc'] == info.CRC and manifest_entry['mtime_ns'] == dest_stat.st_mtime_ns:
+        # Same as what we wrote last time and not touched since, no need to read it
+        return True
+    return file_crc32(dest_path) == info.CRC
+
+
+def remove_empty_dirs(target_dir: Path, rel_paths: Sequence[PurePosixPath]):
+    parent_dirs = {Path(target_dir, *rel_path.parent.parts) for rel_path in rel_paths}
+    # Deepest first, so that a parent can be removed after its children
+    for parent_dir in sorted(parent_dirs, key=lambda p: len(p.parts), reverse=True):
+        while parent_dir != target_dir:
+            try:
+                parent_dir.rmdir()
+            except OSError:
+                break  # not empty (or already gone)
+            parent_dir = parent_dir.parent
+
+
+def sync_fw_archive(zipfile_name: Path, target_dir: Path,
+                    skip_patterns: Sequence[str] = DEFAULT_SKIP_PATTERNS,
+                    max_workers: int = EXTRACT_MAX_WORKERS,
+                    content_store: Optional[ContentStore] = None) -> Tuple[int, int]:
+    """
+    Make target_dir match the firmware archive while touching as little as possible.
+    Files whose content (the CRC32 stored in the archive) already matches are left alone,
+    so their mtimes don't change and PlatformIO doesn't rebuild them. Files that were in the
+    previous archive but not in this one are deleted. The .pio directory (build outputs,
+    libdeps) and the user's local configuration are never touched.
+    If a content_store is given, files are hard linked from it instead of written directly.
+    Returns the number of (written, deleted) files.
+    """
+    target_dir.mkdir(parents=True, exist_ok=True)
+    old_manifest = read_sync_manifest(target_dir)
+
+    with zipfile.ZipFile(zipfile_name, 'r') as zip_ref:
+        members, num_skipped = list_fw_members(zip_ref, skip_patterns)
+        manifest_lookup = old_manifest or {}
+        to_extract = []
+        for rel_path, info in members.items():
+            dest_path = Path(target_dir, *rel_path.parts)
+            if not is_unchanged(dest_path, info, manifest_lookup.get(str(rel_path))):
+                to_extract.append((info, dest_path))
+        extract_members(zip_ref, to_extract, max_workers, content_store)
+
+    if old_manifest is not None:
+        stale_paths = [PurePosixPath(p) for p in old_manifest if PurePosixPath(p) not in members]
+    else:
+        # Don't know what was extracted before (or nothing was), so anything not in the archive is stale
+        log.debug(f'No sync manifest in {target_dir}, checking every file')
+        stale_paths = []
+        for dir_path, dir_names, file_names in os.walk(target_dir):
+            if Path(dir_path) == target_dir and '.pio' in dir_names:
+                dir_names.remove('.pio')  # can be huge, and is preserved anyway
+            for file_name in file_names:
+                rel_path = PurePosixPath(Path(dir_path, file_name).relative_to(target_dir).as_posix())
+                if rel_path not in members:
+                    stale_paths.append(rel_path)
+    stale_paths = [p for p in stale_paths if not is_skipped(p, SYNC_PRESERVE_PATTERNS)]
+    for stale_path in stale_paths:
+        log.debug(f'Removing {stale_path}')
+        Path(target_dir, *stale_path.parts).unlink(missing_ok=True)
+    remove_empty_dirs(target_dir, stale_paths)
+
+    new_manifest = {}
+    for rel_path, info in members.items():
+        dest_stat = Path(target_dir, *rel_path.parts).stat()
+        new_manifest[str(rel_path)] = {'crc': info.CRC, 'mtime_ns': dest_stat.st_mtime_ns}
+    write_sync_manifest(target_dir, new_manifest)
+
+    log.info(f'Synced FW: {len(to_extract)} files written, {len(members) - len(to_extract)} unchanged, '
+             f'{len(stale_paths)} removed, {num_skipped} skipped')
+    return len(to_extract), len(stale_paths)
@@ -0,0 +1,88 @@
+import shutil
+import logging
+import subprocess
+from pathlib import Path
+from typing import List
+
+from misc_utils import decode_bytes
+
+log = logging.getLogger('')
+
+FW_GIT_REMOTE_URL = 'https://github.com/OpenAstroTech/OpenAstroTracker-Firmware.git'
+# A fetch that hasn't finished by then has stalled, the caller falls back to downloading the archive
+GIT_TIMEOUT_S = 5 * 60
+
+
+class GitError(Exception):
+    pass
+
+
+def git_available() -> bool:
+    return shutil.which('git') is not None
+
+
+class FWGitMirror:
+    """
+    A local bare mirror of the firmware repository. Fetching a ref only transfers the
+    objects we don't already have, which for a branch that moved a few commits is
+    a tiny fraction of a full archive download. Refs are exported with `git archive`
+    so the result goes through the same extraction/sync path as a downloaded archive.
+    """
+
+    def __init__(self, mirror_dir: Path, remote_url: str = FW_GIT_REMOTE_URL):
+        self.mirror_dir = mirror_dir
+        self.remote_url = remote_url
+        self.archive_dir = Path(mirror_dir.parent, 'archives')
+
+    def _git(self, args: List[str]) -> str:
+        all_args = ['git', '--git-dir', str(self.mirror_dir)] + args
+        log.debug(f'Running {all_args}')
+        try:
+            sub_proc = subprocess.run(all_args, capture_output=True, timeout=GIT_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            raise GitError(f'{args} timed out after {GIT_TIMEOUT_S}s')
+        stdout = decode_bytes(sub_proc.stdout)
+        if sub_proc.returncode != 0:
+            raise GitError(f'{args} failed ({sub_proc.returncode}): {decode_bytes(sub_proc.stderr)}')
+        return stdout
+
+    def _ensure_mirror(self):
+        if Path(self.mirror_dir, 'HEAD').is_file():
+            return
+        log.info(f'Creating FW git mirror in {self.mirror_dir}')
+        self.mirror_dir.mkdir(parents=True, exist_ok=True)
+        self._git(['init', '--bare', '--quiet'])
+        self._git(['remote', 'add', 'origin', self.remote_url])
+
+    def fetch(self, git_ref: str) -> str:
+        """Fetch a single ref (i.e. refs/heads/develop or refs/tags/V1.13.14) and return its commit SHA"""
+        self._ensure_mirror()
+        log.info(f'Fetching {git_ref} from {self.remote_url}')
+        self._git(['fetch', '--quiet', '--force', '--no-tags', 'origin', f'+{git_ref}:{git_ref}'])
+        commit_sha = self._git(['rev-parse', f'{git_ref}^{{commit}}']).strip()
+        log.info(f'{git_ref} is at {commit_sha}')
+        return commit_sha
+
+    def archive(self, commit_sha: str) -> Path:
+        zipfile_name = Path(self.archive_dir, f'{commit_sha}.zip')
+        if zipfile_name.is_file():
+            log.debug(f'Already have archive for {commit_sha}')
+            return zipfile_name
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        tmp_zipfile_name = zipfile_name.with_suffix('.tmp')
+        # Same layout as a GitHub archive, everything under one top level directory
+        self._git(['archive', '--format=zip', f'--prefix=OpenAstroTracker-Firmware-{commit_sha[:7]}/',
+                   '--output', str(tmp_zipfile_name), commit_sha])
+        tmp_zipfile_name.replace(zipfile_name)
+        return zipfile_name
+
+    def fetch_archive(self, git_ref: str) -> Path:
+        commit_sha = self.fetch(git_ref)
+        zipfile_name = self.archive(commit_sha)
+        # Only keep the archives that are still being pointed to by a ref
+        live_shas = set(self._git(['for-each-ref', '--format=%(objectname)']).split())
+        live_shas.update(self._git(['for-each-ref', '--format=%(*objectname)', 'refs/tags']).split())
+        for old_zipfile_name in self.archive_dir.glob('*.zip'):
+            if old_zipfile_name.stem not in live_shas:
+                old_zipfile_name.unlink()
+        return zipfile_name
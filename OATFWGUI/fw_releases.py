@@ -0,0 +1,105 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Callable, Dict
+from urllib.parse import urlsplit, parse_qs
+
+import semver
+from requests.utils import parse_header_links
+
+import network
+from gui_state import FWVersion
+
+log = logging.getLogger('')
+
+FW_RELEASES_API_URL = 'https://api.github.com/repos/OpenAstroTech/OpenAstroTracker-Firmware/releases'
+RELEASES_PER_PAGE = 100  # GitHub maximum
+RELEASE_PAGE_MAX_WORKERS = 4
+# Development branches, listed before the releases
+FW_BRANCHES = [
+    FWVersion('develop',
+              'https://github.com/OpenAstroTech/OpenAstroTracker-Firmware/archive/refs/heads/develop.zip',
+              is_branch=True, git_ref='refs/heads/develop'),
+    FWVersion('oae-fw',
+              'https://github.com/OpenAstroTech/OpenAstroTracker-Firmware/archive/refs/heads/oae-fw.zip',
+              is_branch=True, git_ref='refs/heads/oae-fw'),
+]
+
+
+def release_semver(release_json: dict) -> Optional[semver.VersionInfo]:
+    # Firmware tags look like V1.13.14
+    tag_name = str(release_json.get('tag_name', ''))
+    try:
+        return semver.VersionInfo.parse(tag_name.lstrip('vV'))
+    except ValueError:
+        return None
+
+
+def sort_releases(releases_json: List[dict]) -> List[dict]:
+    # Newest first, anything that isn't semver goes at the end
+    return sorted(
+        releases_json,
+        key=lambda r: (release_semver(r) is not None, release_semver(r) or semver.VersionInfo(0)),
+        reverse=True,
+    )
+
+
+def last_page_number(link_header: Optional[str]) -> int:
+    if not link_header:
+        return 1
+    for link in parse_header_links(link_header):
+        if link.get('rel') == 'last':
+            page_strs = parse_qs(urlsplit(link['url']).query).get('page', [])
+            if page_strs and page_strs[0].isdigit():
+                return int(page_strs[0])
+    return 1
+
+
+def page_url(api_url: str, page: int) -> str:
+    return f'{api_url}?per_page={RELEASES_PER_PAGE}&page={page}'
+
+
+def list_fw_releases(api_url: str = FW_RELEASES_API_URL,
+                     page_callback: Optional[Callable[[List[FWVersion]], None]] = None) -> List[FWVersion]:
+    """
+    Get all firmware releases, not just the first page. The first page tells us (through the
+    Link header) how many pages there are, the rest are then fetched concurrently.
+    page_callback is called with the sorted releases so far every time a page arrives.
+    """
+    pages: Dict[int, List[dict]] = {}
+
+    def merged_releases() -> List[FWVersion]:
+        all_releases_json = [release_json for page in pages.values() for release_json in page]
+        fw_versions = []
+        for release_json in sort_releases(all_releases_json):
+            try:
+                fw_versions.append(FWVersion(release_json['name'] or release_json['tag_name'],
+                                             release_json['zipball_url']))
+            except (TypeError, KeyError) as e:
+                log.error(f'Bad release_json={release_json} {e}')
+        return fw_versions
+
+    def add_page(page: int, cached_response: Optional[network.CachedJsonResponse]):
+        if cached_response is None or not isinstance(cached_response.body, list):
+            # i.e. offline with nothing cached, or an error dict from the API
+            log.error(f'Failed to grab FW versions page {page}: {cached_response}')
+            return
+        pages[page] = cached_response.body
+        if page_callback is not None:
+            page_callback(merged_releases())
+
+    first_page = network.get_json_cached_response(page_url(api_url, 1))
+    add_page(1, first_page)
+    if first_page is None:
+        return merged_releases()
+
+    num_pages = last_page_number(first_page.link)
+    log.debug(f'{num_pages} page(s) of FW versions')
+    if num_pages > 1:
+        with ThreadPoolExecutor(max_workers=RELEASE_PAGE_MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(network.get_json_cached_response, page_url(api_url, page)): page
+                for page in range(2, num_pages + 1)
+            }
+            for future in as_completed(futures):
+                add_page(futures[future], future.result())
+    return merged_releases()
@@ -0,0 +1,105 @@
+import time
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+from content_store import ContentStore
+from fw_extract import sync_fw_archive
+from gui_state import FWVersion
+from background_cleanup import tombstone_directory, start_background_cleanup
+from misc_utils import load_json_index, save_json_index
+
+log = logging.getLogger('')
+
+
+def worktree_name(fw_version: FWVersion) -> str:
+    # Used as a directory name, every character counts against the Windows path length.
+    # The nice name is in the index.
+    return hashlib.sha256(fw_version.url.encode()).hexdigest()[:6]
+
+
+class FWWorktrees:
+    """
+    One extracted firmware directory per release, side by side under root_dir. Each
+    worktree keeps its own .pio build directory, so switching between releases doesn't
+    throw away build caches. Files are hard linked out of a shared ContentStore, so files
+    that are the same between releases only take up space once.
+    """
+
+    def __init__(self, root_dir: Path, store_dir: Path):
+        self.root_dir = root_dir
+        self.content_store = ContentStore(store_dir)
+        self.index_path = Path(root_dir, 'index.json')
+        self.index: Dict[str, dict] = {}
+        self._migrate_single_tree()
+        self._load_index()
+
+    def _migrate_single_tree(self):
+        # Older versions extracted a single firmware tree directly into root_dir
+        if not Path(self.root_dir, 'platformio.ini').is_file():
+            return
+        config_paths = list(self.root_dir.glob('Configuration_local*.hpp'))
+        if config_paths:
+            saved_configs_dir = Path(self.root_dir.parent, f'{self.root_dir.name}_saved_configs')
+            saved_configs_dir.mkdir(parents=True, exist_ok=True)
+            for config_path in config_paths:
+                shutil.copy2(config_path, Path(saved_configs_dir, config_path.name))
+            log.warning(f'Saved {[p.name for p in config_paths]} from the old firmware directory '
+                        f'to {saved_configs_dir}')
+        log.info(f'Removing single firmware tree layout from {self.root_dir}')
+        # Deleting a whole tree (with its .pio) takes a while, do it in the background
+        if tombstone_directory(self.root_dir, tombstone_parent=self.root_dir.parent) is not None:
+            start_background_cleanup([self.root_dir.parent])
+
+    def _load_index(self):
+        self.index = load_json_index(self.index_path, 'worktree index')
+        self.index = {
+            name: entry for name, entry in self.index.items()
+            if Path(self.root_dir, name, 'platformio.ini').is_file()
+        }
+        self._migrate_worktree_names()
+
+    def _migrate_worktree_names(self):
+        # Worktrees used to be named after the release, keep them (and their .pio) under the new name
+        renamed = False
+        for name, entry in list(self.index.items()):
+            new_name = worktree_name(FWVersion(entry['nice_name'], entry['url']))
+            if new_name == name or new_name in self.index:
+                continue
+            log.info(f'Renaming FW worktree {name} to {new_name}')
+            try:
+                Path(self.root_dir, name).rename(Path(self.root_dir, new_name))
+            except OSError as e:
+                log.warning(f'Could not rename FW worktree {name}: {e}')
+                continue
+            self.index[new_name] = self.index.pop(name)
+            renamed = True
+        if renamed:
+            self._save_index()
+
+    def _save_index(self):
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        save_json_index(self.index_path, self.index)
+
+    def get(self, fw_version: FWVersion) -> Optional[Path]:
+        name = worktree_name(fw_version)
+        entry = self.index.get(name)
+        if entry is None or entry['url'] != fw_version.url:
+            return None
+        return Path(self.root_dir, name)
+
+    def sync(self, fw_version: FWVersion, zipfile_name: Path) -> Path:
+        name = worktree_name(fw_version)
+        fw_dir = Path(self.root_dir, name)
+        log.info(f'Syncing FW worktree {fw_dir} from {zipfile_name}')
+        sync_fw_archive(zipfile_name, fw_dir, content_store=self.content_store)
+        self.index[name] = {
+            'nice_name': fw_version.nice_name,
+            'url': fw_version.url,
+            'synced': time.time(),
+        }
+        self._save_index()
+        self.content_store.prune()
+        return fw_dir
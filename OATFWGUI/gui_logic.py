@@ -1,40 +1,40 @@
-import configparser
-import re
 import logging
 import sys
-import zipfile
 import json
-import shutil
-from typing import List, Optional
+from functools import lru_cache, partial
+from typing import List, Optional, Callable
 from pathlib import Path
 
-from PySide6.QtCore import Slot, QThreadPool, QFile, QProcess
+from PySide6.QtCore import Slot, QThreadPool, QProcess, QTimer
 from PySide6.QtWidgets import QWidget, QFileDialog
 
-import requests
-
 from log_utils import LoggedExternalFile
 from qt_extensions import Worker
 from qbusyindicatorgoodbad import BusyIndicatorState
-from external_processes import external_processes, get_install_dir
+from external_processes import external_processes, get_install_dir, get_platformio_version
 from gui_state import LogicState, PioEnv, FWVersion
 from anon_usage_data import AnonStatsDialog, create_anon_stats, upload_anon_stats
+from build_matrix import BuildMatrixDialog
+from build_jobs import get_build_jobs
+from build_progress import BuildProgress, BuildProgressParser, format_eta
+from build_times import new_build_times_path, save_build_times_report
+from fw_archive_cache import FWArchiveCache
+from fw_worktrees import FWWorktrees
+from fw_releases import list_fw_releases, FW_RELEASES_API_URL, FW_BRANCHES
+from fw_git_mirror import FWGitMirror, GitError, git_available
 from misc_utils import delete_directory
+from build_cache import build_cache_key
+from pio_project import PioProject, get_pio_project
+from pkg_prefetch import get_pkg_prefetcher
+from fw_build import get_build_cache, do_hot_patches, install_config_file, \
+    get_build_env_vars, get_build_dir, new_compiler_cache_stats_path, with_compiler_cache, log_compiler_cache_stats, \
+    with_build_timer, get_lib_mirror
 
 log = logging.getLogger('')
 
 
-def read_platformio_ini_file(logic_state: LogicState) -> List[str]:
-    ini_path = Path(logic_state.fw_dir, 'platformio.ini')
-    with open(ini_path.resolve(), 'r') as fp:
-        ini_lines = fp.readlines()
-    return ini_lines
-
-
-def get_pio_environments(ini_lines: List[str]) -> List[PioEnv]:
-    platformio_ini = configparser.ConfigParser()
-    platformio_ini.read_string(''.join(ini_lines))
-    raw_pio_envs = [s.split(':', maxsplit=1)[1] for s in platformio_ini.sections() if s.startswith('env:')]
+def get_pio_environments(pio_project: PioProject) -> List[PioEnv]:
+    raw_pio_envs = pio_project.env_names
     log.info(f'Found pio environments: {raw_pio_envs}')
 
     # we don't want to build native
@@ -56,35 +56,42 @@ def get_pio_environments(ini_lines: List[str]) -> List[PioEnv]:
     return pio_environments
 
 
-def download_fw(zip_url: str) -> Path:
-    log.info(f'Downloading OAT FW from: {zip_url}')
-    r = requests.get(zip_url)
-    zipfile_name = Path(get_install_dir(), 'OATFW.zip')
-    with open(zipfile_name, 'wb') as fd:
-        fd.write(r.content)
-        fd.close()
+@lru_cache(maxsize=1)
+def get_fw_archive_cache() -> FWArchiveCache:
+    return FWArchiveCache(Path(get_install_dir(), '.fw_cache'))
+
+
+@lru_cache(maxsize=1)
+def get_fw_git_mirror() -> FWGitMirror:
+    return FWGitMirror(Path(get_install_dir(), '.fw_git', 'OATFW.git'))
+
+
+def download_fw(fw_version: FWVersion, progress_callback: Optional[Callable[[int], None]] = None) -> Path:
+    if fw_version.git_ref is not None and git_available():
+        # Only transfers what changed since the last fetch
+        if progress_callback is not None:
+            progress_callback(-1)
+        try:
+            zipfile_name = get_fw_git_mirror().fetch_archive(fw_version.git_ref)
+            if progress_callback is not None:
+                progress_callback(100)
+            return zipfile_name
+        except GitError as e:
+            log.warning(f'Could not fetch {fw_version.git_ref} with git, downloading archive instead: {e}')
+    log.info(f'Downloading OAT FW from: {fw_version.url}')
+    zipfile_name = get_fw_archive_cache().get(fw_version.url, fw_version.is_branch, progress_callback)
     return zipfile_name
 
 
-def extract_fw(zipfile_name: Path) -> Path:
-    # For Windows path length reasons, keep the firmware folder name short
-    fw_dir = Path(get_install_dir(), 'OATFW')
-    if fw_dir.exists():
-        log.info(f'Removing previously downloaded FW from {fw_dir}')
-        delete_directory(fw_dir)
+@lru_cache(maxsize=1)
+def get_fw_worktrees() -> FWWorktrees:
+    # For Windows path length reasons, keep the firmware folder names short (OATFW/<6 hex chars>)
+    return FWWorktrees(Path(get_install_dir(), 'OATFW'), Path(get_install_dir(), '.fw_store'))
 
-    log.info(f'Extracting FW from {zipfile_name}')
-    with zipfile.ZipFile(zipfile_name, 'r') as zip_ref:
-        zip_infolist = zip_ref.infolist()
-        if len(zip_infolist) > 0 and zip_infolist[0].is_dir():
-            extracted_dir = Path(get_install_dir(), zip_infolist[0].filename)
-        else:
-            log.fatal(f'Could not find FW top level directory in {zip_infolist}!')
-            sys.exit(1)
-        zip_ref.extractall()
 
-    log.info(f'Rename {extracted_dir} to {fw_dir}')
-    shutil.move(extracted_dir, fw_dir)
+def extract_fw(zipfile_name: Path, fw_version: FWVersion) -> Path:
+    # Only rewrite what changed, so the .pio build cache stays valid
+    fw_dir = get_fw_worktrees().sync(fw_version, zipfile_name)
     log.info(f'Extracted FW to {fw_dir}')
     return fw_dir
 
@@ -96,10 +103,13 @@ class BusinessLogic:
         self.main_app = main_app
         main_app.wCombo_fw_version.currentIndexChanged.connect(self.fw_version_combo_box_changed)
         main_app.wBtn_download_fw.setEnabled(True)
-        main_app.wBtn_download_fw.clicked.connect(self.spawn_worker_thread(self.download_and_extract_fw))
+        main_app.wBtn_download_fw.clicked.connect(
+            self.spawn_worker_thread(self.download_and_extract_fw, self.download_progress,
+                                     finished_slot=self.download_finished))
         main_app.wBtn_select_local_config.clicked.connect(self.open_local_config_file)
         main_app.wCombo_pio_env.currentIndexChanged.connect(self.pio_env_combo_box_changed)
-        main_app.wBtn_build_fw.clicked.connect(self.spawn_worker_thread(self.build_fw))
+        main_app.wBtn_build_fw.clicked.connect(
+            self.spawn_worker_thread(self.build_fw, partial_result_slot=self.build_progress))
         main_app.wBtn_refresh_ports.clicked.connect(self.spawn_worker_thread(self.refresh_ports))
         main_app.wCombo_serial_port.currentIndexChanged.connect(self.serial_port_combo_box_changed)
         main_app.wBtn_upload_fw.clicked.connect(self.spawn_worker_thread(self.upload_fw))
@@ -107,40 +117,65 @@ class BusinessLogic:
 
         self.threadpool = QThreadPool()
         self.threadpool.setMaxThreadCount(1)  # Only one worker
+        # Network only tasks, these don't need to wait on (or hold up) the platformio worker
+        self.background_threadpool = QThreadPool()
+        self.background_threadpool.setMaxThreadCount(2)
 
+        # Start these once the event loop is running, so that the window is shown first
         # Manually spawn a worker to grab tags from GitHub
-        self.spawn_worker_thread(self.get_fw_versions)()
+        QTimer.singleShot(0, self.spawn_worker_thread(
+            self.get_fw_versions, partial_result_slot=self.get_fw_versions_partial_result, background=True))
         # Manually spawn a worker to refresh serial ports
-        self.spawn_worker_thread(self.refresh_ports)()
+        QTimer.singleShot(0, self.spawn_worker_thread(self.refresh_ports))
+        # Only needed for the log, so don't hold up startup with it
+        QTimer.singleShot(0, self.spawn_worker_thread(self.log_pio_system_info, background=True))
 
         # Need to create in the main thread else it doesn't work?
         self.avr_dude_logwatch = LoggedExternalFile()
+        self.build_progress_parser: Optional[BuildProgressParser] = None
 
-    def spawn_worker_thread(self, fn):
+    def spawn_worker_thread(self, fn, progress_slot: Optional[Callable[[int], None]] = None,
+                            partial_result_slot: Optional[Callable[[object], None]] = None,
+                            background: bool = False,
+                            finished_slot: Optional[Callable[[], None]] = None):
         @Slot()
         def worker_thread_slot():
-            msecs = 5000
-            all_threads_removed = self.threadpool.waitForDone(msecs)
-            if not all_threads_removed:
-                log.fatal(f'Waited too long for threads to sys.exit! {self.threadpool.activeThreadCount()}')
-                sys.exit(1)
+            if background:
+                threadpool = self.background_threadpool
+            else:
+                threadpool = self.threadpool
+                msecs = 5000
+                all_threads_removed = threadpool.waitForDone(msecs)
+                if not all_threads_removed:
+                    log.fatal(f'Waited too long for threads to sys.exit! {threadpool.activeThreadCount()}')
+                    sys.exit(1)
 
             log.debug(f'Creating worker {str(fn)}')
             worker = Worker(fn)
             worker.signals.result.connect(self.worker_finished)
+            if progress_slot is not None:
+                worker.signals.progress.connect(progress_slot)
+            if partial_result_slot is not None:
+                worker.signals.partial_result.connect(partial_result_slot)
+            if finished_slot is not None:
+                # Also emitted if fn raised
+                worker.signals.finished.connect(finished_slot)
             # this fixes a bug with thread signal allocation/deallocation
             worker.setAutoDelete(False)
-            self.threadpool.start(worker)
+            threadpool.start(worker)
 
         return worker_thread_slot
 
+    @staticmethod
+    def log_pio_system_info():
+        external_processes['platformio_background'].start(['system', 'info'], None)
+
     @Slot()
     def worker_finished(self, worker_name: Optional[str] = None):
         # Update all of the gui logic
 
-        if worker_name == self.get_fw_versions.__name__ and self.logic_state.release_list is not None:
-            self.get_fw_versions_result(self.main_app, self.logic_state.release_list)
-        elif worker_name == self.download_and_extract_fw.__name__ and self.logic_state.pio_envs is not None:
+        if (worker_name in [self.download_and_extract_fw.__name__, self.switch_to_fw_worktree.__name__]
+                and self.logic_state.pio_envs is not None):
             self.logic_state.pio_env = None
             self.download_and_extract_fw_result(self.main_app, self.logic_state.pio_envs)
 
@@ -161,47 +196,52 @@ class BusinessLogic:
         ])
         self.main_app.wBtn_upload_fw.setEnabled(upload_reqs_ok)
 
-    def get_fw_versions(self) -> str:
-        fw_api_url = 'https://api.github.com/repos/OpenAstroTech/OpenAstroTracker-Firmware/releases'
-        log.info(f'Grabbing available FW versions from {fw_api_url}')
-        r = requests.get(fw_api_url, timeout=5000)
-        releases_list = [
-            FWVersion('develop',
-                      'https://github.com/OpenAstroTech/OpenAstroTracker-Firmware/archive/refs/heads/develop.zip'),
-            FWVersion('oae-fw',
-                      'https://github.com/OpenAstroTech/OpenAstroTracker-Firmware/archive/refs/heads/oae-fw.zip'),
-        ]
-        if r.status_code != requests.codes.ok:
-            log.error(f'Failed to grab latest FW versions: {r.status_code} {r.reason} {r.text}')
-        for release_json in r.json():
-            try:
-                fw_version = FWVersion(release_json['name'], release_json['zipball_url'])
-            except TypeError as e:
-                log.error(f'release_json={release_json}')
-                raise e
-            releases_list.append(fw_version)
+    def get_fw_versions(self, partial_result_callback: Optional[Callable[[List[FWVersion]], None]] = None) -> str:
+        log.info(f'Grabbing available FW versions from {FW_RELEASES_API_URL}')
+        branches_list = list(FW_BRANCHES)
+
+        def page_callback(fw_versions: List[FWVersion]):
+            if partial_result_callback is not None:
+                partial_result_callback(branches_list + fw_versions)
 
-        self.logic_state.release_list = releases_list
+        releases_list = list_fw_releases(page_callback=page_callback)
+        # Also when no page arrived (i.e. offline), the branches are still there.
+        # logic_state is only set in the GUI thread, by the partial result slot.
+        page_callback(releases_list)
         return self.get_fw_versions.__name__
 
-    @staticmethod
-    def get_fw_versions_result(main_app: 'MainWidget', fw_versions_list: List[FWVersion]):
-        # Add all the FW versions to the combo box
-        main_app.wCombo_fw_version.clear()
+    @Slot()
+    def get_fw_versions_partial_result(self, fw_versions_list: List[FWVersion]):
+        # More pages of releases arrived, add them without losing the user's selection
+        combo_box = self.main_app.wCombo_fw_version
+        selected_name = combo_box.currentText()
+        selected_fw_version = None
+        if self.logic_state.release_list is not None and self.logic_state.release_idx is not None:
+            selected_fw_version = self.logic_state.release_list[self.logic_state.release_idx]
+
+        combo_box.blockSignals(True)
+        combo_box.clear()
         for fw_version in fw_versions_list:
-            main_app.wCombo_fw_version.addItem(fw_version.nice_name)
-        main_app.wCombo_fw_version.setCurrentIndex(0)
-        main_app.wBtn_download_fw.setEnabled(True)
-
-    def download_and_extract_fw(self) -> str:
+            combo_box.addItem(fw_version.nice_name)
+        combo_box.setCurrentIndex(max(combo_box.findText(selected_name), 0))
+        combo_box.blockSignals(False)
+
+        self.logic_state.release_list = fw_versions_list
+        if selected_fw_version in fw_versions_list:
+            self.logic_state.release_idx = fw_versions_list.index(selected_fw_version)
+        self.main_app.wBtn_download_fw.setEnabled(True)
+        if combo_box.currentText() != selected_name:
+            # i.e. the first time the combo box is filled
+            self.fw_version_combo_box_changed(combo_box.currentIndex())
+
+    def download_and_extract_fw(self, progress_callback: Optional[Callable[[int], None]] = None) -> str:
         self.main_app.wSpn_download.setState(BusyIndicatorState.BUSY)
         self.logic_state.release_idx = self.main_app.wCombo_fw_version.currentIndex()
-        zip_url = self.logic_state.release_list[self.logic_state.release_idx].url
-        zipfile_name = download_fw(zip_url)
+        fw_version = self.logic_state.release_list[self.logic_state.release_idx]
+        zipfile_name = download_fw(fw_version, progress_callback)
 
-        self.logic_state.fw_dir = extract_fw(zipfile_name)
-        ini_lines = read_platformio_ini_file(self.logic_state)
-        self.logic_state.pio_envs = get_pio_environments(ini_lines)
+        self.logic_state.fw_dir = extract_fw(zipfile_name, fw_version)
+        self.logic_state.pio_envs = get_pio_environments(get_pio_project(self.logic_state.fw_dir))
         return self.download_and_extract_fw.__name__
 
     @staticmethod
@@ -213,6 +253,42 @@ class BusinessLogic:
             main_app.wCombo_pio_env.addItem(pio_env_name.nice_name)
         main_app.wCombo_pio_env.setPlaceholderText('Select Board')
 
+    @Slot()
+    def download_progress(self, percent: int):
+        progress_bar = self.main_app.wProgress_download
+        if percent < 0:
+            # Unknown total size, show a busy bar
+            progress_bar.setRange(0, 0)
+        else:
+            progress_bar.setRange(0, 100)
+            progress_bar.setValue(percent)
+
+    @Slot()
+    def download_finished(self):
+        # Don't leave a busy bar behind if a git fetch failed before any progress was reported
+        progress_bar = self.main_app.wProgress_download
+        if progress_bar.maximum() == 0:
+            progress_bar.setRange(0, 100)
+            progress_bar.setValue(0)
+
+    @Slot()
+    def set_profile_build(self, profile_build: bool):
+        self.logic_state.profile_build = profile_build
+
+    @Slot()
+    def build_progress(self, progress: BuildProgress):
+        progress_bar = self.main_app.wProgress_build
+        if progress.percent < 0:
+            # First build of this board, no idea how many steps there are
+            progress_bar.setRange(0, 0)
+            return
+        progress_bar.setRange(0, 100)
+        progress_bar.setValue(progress.percent)
+        if progress.eta_s is not None and progress.percent < 100:
+            progress_bar.setFormat(f'Build %p% ({format_eta(progress.eta_s)} left)')
+        else:
+            progress_bar.setFormat('Build %p%')
+
     @Slot()
     def fw_version_combo_box_changed(self, idx: int):
         if idx == self.logic_state.release_idx:
@@ -225,17 +301,42 @@ class BusinessLogic:
         self.main_app.wSpn_download.setState(BusyIndicatorState.NONE)
         self.main_app.wCombo_pio_env.clear()
         self.main_app.wSpn_build.setState(BusyIndicatorState.NONE)
+        self.logic_state.build_success = False
+
+        # If we already have this release extracted, switch to it straight away. Looking that up
+        # can touch the disk (the first time especially), so not on the GUI thread.
+        if self.logic_state.release_list is not None and idx != -1:
+            self.spawn_worker_thread(partial(self.switch_to_fw_worktree, idx), background=True)()
         self.worker_finished()
 
+    def switch_to_fw_worktree(self, idx: int) -> Optional[str]:
+        fw_version = self.logic_state.release_list[idx]
+        fw_dir = get_fw_worktrees().get(fw_version)
+        if fw_dir is None or self.main_app.wCombo_fw_version.currentIndex() != idx:
+            return None  # Not extracted yet, or the user has picked another version since
+        log.info(f'Switching to existing FW worktree {fw_dir}')
+        self.logic_state.release_idx = idx
+        self.logic_state.fw_dir = fw_dir
+        self.logic_state.pio_envs = get_pio_environments(get_pio_project(fw_dir))
+        return self.switch_to_fw_worktree.__name__
+
     @Slot()
     def pio_env_combo_box_changed(self, idx: int):
         if self.logic_state.pio_envs and idx != -1:
             self.logic_state.pio_env = self.logic_state.pio_envs[idx].raw_name
+            # Install the packages while the user is still picking a config file
+            self.prefetch_packages()
             # manually update GUI
             self.worker_finished()
         else:
             self.logic_state.pio_env = None
 
+    def prefetch_packages(self):
+        if self.logic_state.fw_dir is None or self.logic_state.pio_env is None:
+            return
+        fw_version = self.logic_state.release_list[self.logic_state.release_idx]
+        get_pkg_prefetcher().start(self.logic_state.fw_dir, self.logic_state.pio_env, fw_version.nice_name)
+
     @Slot()
     def open_local_config_file(self):
         file_path, file_filter = QFileDialog.getOpenFileName(self.main_app, 'Open Local Config', '.',
@@ -247,80 +348,23 @@ class BusinessLogic:
         self.worker_finished()
 
     def do_hot_patches(self):
-        # Before logging anything, check that we need to do something
-        ini_lines = read_platformio_ini_file(self.logic_state)
-
-        bad_git_tag_re = re.compile(r'(^[^;\n]+github\.com.+)@')
-        if any(bad_git_tag_re.search(ini_line) for ini_line in ini_lines):
-            log.warning('Hot patching git tag specifiers!!!')
-            def patch_line(in_str: str) -> str:
-                if bad_git_tag_re.search(in_str):
-                    out_str = bad_git_tag_re.sub(r'\1#', in_str)
-                    log.warning(f'Replacing {in_str} with {out_str}')
-                    return out_str
-                else:
-                    return in_str
-            ini_lines = [
-                patch_line(line)
-                for line in ini_lines
-            ]
-
-        if self.logic_state.env_is_avr_based():
-            # hard match the entire line
-            # readline[s]() will always terminate a line with \n (and not \r\n on windows! :D)
-            # https://docs.python.org/3.11/tutorial/inputoutput.html#methods-of-file-objects
-            bad_platform_line = 'platform = atmelavr\n'
-            good_platform_line = 'platform = atmelavr@4.2.0\n'
-            if bad_platform_line in ini_lines:
-                log.warning('Hot patching platformio AVR platform!!!')
-                log.warning(f'Replacing {repr(bad_platform_line)} with {repr(good_platform_line)}')
-                ini_lines = [
-                    good_platform_line if line == bad_platform_line else line
-                    for line in ini_lines
-                ]
-
-        bad_ssd_1306_revision_re = re.compile(r'(ClutchplateDude/esp8266-oled-ssd1306\s*#\s*4\.6\.0)')
-        if any(bad_ssd_1306_revision_re.search(ini_line) for ini_line in ini_lines):
-            log.warning('Hot patching oled-ssd1306 revision!!!')
-            def patch_line(in_str: str) -> str:
-                if bad_ssd_1306_revision_re.search(in_str):
-                    out_str = bad_ssd_1306_revision_re.sub(r'ClutchplateDude/esp8266-oled-ssd1306#4.6.2', in_str)
-                    log.warning(f'Replacing {in_str} with {out_str}')
-                    return out_str
-                else:
-                    return in_str
-            ini_lines = [
-                patch_line(line)
-                for line in ini_lines
-            ]
-
-        # Just re-read the ini file to see if we changed anything
-        if ini_lines != read_platformio_ini_file(self.logic_state):
-            log.debug('Writing out patched ini file')
-            with open(Path(self.logic_state.fw_dir, 'platformio.ini').resolve(), 'w') as fp:
-                fp.writelines(ini_lines)
-        else:
-            log.debug('No patches applied')
+        fw_version = self.logic_state.release_list[self.logic_state.release_idx]
+        do_hot_patches(self.logic_state.fw_dir, self.logic_state.env_is_avr_based(), fw_version.nice_name)
 
-    def build_fw(self):
+    def build_fw(self, partial_result_callback: Optional[Callable[[BuildProgress], None]] = None):
         self.main_app.wSpn_build.setState(BusyIndicatorState.BUSY)
+        # platformio installs packages as part of the build, don't race any prefetch for it
+        get_pkg_prefetcher().wait_all()
 
         # Hot patches, since we can't re-release an old firmware tag
         self.do_hot_patches()
 
-        config_dest_path = str(Path(self.logic_state.fw_dir, 'Configuration_local.hpp').resolve())
-        if Path(config_dest_path) != Path(self.logic_state.config_file_path):
-            if QFile.exists(config_dest_path):
-                log.warning(f'Deleting existing configuration file {config_dest_path}')
-                QFile.remove(config_dest_path)
-            log.info(f'Copying config file from {self.logic_state.config_file_path} -> {config_dest_path}')
-            copy_success = QFile.copy(self.logic_state.config_file_path, config_dest_path)
-            if not copy_success:
-                log.error(f'Could not copy config file to {config_dest_path}')
-                self.main_app.wSpn_build.setState(BusyIndicatorState.BAD)
-                return
-        else:
-            log.info(f'Not copying config file since source and destination are the same: {config_dest_path}')
+        try:
+            config_dest_path = install_config_file(Path(self.logic_state.config_file_path), self.logic_state.fw_dir)
+        except OSError as e:
+            log.error(f'Could not copy config file: {e}')
+            self.main_app.wSpn_build.setState(BusyIndicatorState.BAD)
+            return
 
         log.info(f'Building FW environment={self.logic_state.pio_env} dir={self.logic_state.fw_dir}')
 
@@ -329,29 +373,49 @@ class BusinessLogic:
             self.main_app.wSpn_build.setState(BusyIndicatorState.BAD)
             return
 
-        # TODO: should probably refactor the hot patch logic to use ConfigParser...
-        platformio_ini = configparser.ConfigParser()
-        platformio_ini.read(Path(self.logic_state.fw_dir, 'platformio.ini'))
-        ini_extra_scripts = platformio_ini['env']['extra_scripts']
-        log.info(f'Extra scripts={ini_extra_scripts}')
-        if not 'iprefix' in ini_extra_scripts and not self.logic_state.env_is_avr_based():
-            # Make sure base firmware doesn't already have the iprefix script
-            # AND
-            # Shouldn't be harmful, but it's a bit weird so we only do this on
-            # esp32 boards. Assume that anything not AVR based is esp32 :S
-            pre_script_path = Path(get_install_dir(), 'OATFWGUI', 'pre_script_esp32_iprefix.py')
-            env_vars = {'PLATFORMIO_EXTRA_SCRIPTS': f'pre:{pre_script_path.absolute()}'}
-        else:
-            env_vars = {}
+        env_vars = get_build_env_vars(self.logic_state.fw_dir, self.logic_state.pio_env)
+        build_dir = get_build_dir(self.logic_state.fw_dir, self.logic_state.pio_env)
+
+        self.logic_state.build_from_cache = False
+        self.logic_state.build_cache_key = build_cache_key(
+            self.logic_state.fw_dir, config_dest_path, self.logic_state.pio_env,
+            get_platformio_version(), env_vars)
+        if self.logic_state.profile_build:
+            # Every step has to actually run to be timed
+            log.info('Profiling build, not using the build or compiler cache')
+            if build_dir.exists():
+                delete_directory(build_dir)
+        elif get_build_cache().restore(self.logic_state.build_cache_key, build_dir):
+            self.main_app.wSpn_build.setState(BusyIndicatorState.GOOD)
+            self.logic_state.build_from_cache = True
+            self.logic_state.build_success = True
+            if partial_result_callback is not None:
+                partial_result_callback(BuildProgress(0, 0, 100, 0.0))
+            return
 
+        if self.logic_state.profile_build:
+            self.logic_state.compiler_cache_stats_path = None
+            self.logic_state.build_times_path = new_build_times_path()
+            env_vars = with_build_timer(env_vars, self.logic_state.build_times_path)
+        else:
+            self.logic_state.compiler_cache_stats_path = new_compiler_cache_stats_path()
+            self.logic_state.build_times_path = None
+            env_vars = with_compiler_cache(env_vars, self.logic_state.compiler_cache_stats_path)
+        get_lib_mirror().prepare(self.logic_state.fw_dir, self.logic_state.pio_env)
+        build_jobs = get_build_jobs(self.logic_state.fw_dir, self.logic_state.pio_env)
+        log.info(f'Building with {build_jobs} jobs')
+        self.build_progress_parser = BuildProgressParser(self.logic_state.pio_env, partial_result_callback)
+        self.build_progress_parser.report()
         external_processes['platformio'].start(
             ['run',
              '--environment', self.logic_state.pio_env,
              '--project-dir', str(self.logic_state.fw_dir),
-             '--verbose'
+             '--verbose',
+             '--jobs', str(build_jobs),
              ],
             self.pio_build_finished,
             env_vars=env_vars,
+            stdout_callback=self.build_progress_parser.feed,
         )
 
     @Slot()
@@ -362,9 +426,22 @@ class BusinessLogic:
             log.info('Normal exit')
             self.main_app.wSpn_build.setState(BusyIndicatorState.GOOD)
             self.logic_state.build_success = True
+            fw_version = self.logic_state.release_list[self.logic_state.release_idx]
+            build_dir = get_build_dir(self.logic_state.fw_dir, self.logic_state.pio_env)
+            get_build_cache().store(self.logic_state.build_cache_key, build_dir,
+                                    self.logic_state.pio_env, fw_version.nice_name)
+            # Copies the whole libdeps directory the first time, not on the GUI thread
+            self.spawn_worker_thread(
+                partial(get_lib_mirror().store, self.logic_state.fw_dir, self.logic_state.pio_env),
+                background=True)()
         else:
             log.error('Did not exit normally')
             self.main_app.wSpn_build.setState(BusyIndicatorState.BAD)
+        self.build_progress_parser.finish(exit_code == 0)
+        if self.logic_state.compiler_cache_stats_path is not None:
+            log_compiler_cache_stats(self.logic_state.compiler_cache_stats_path)
+        if self.logic_state.build_times_path is not None:
+            save_build_times_report(self.logic_state.build_times_path, self.logic_state.pio_env)
 
     def refresh_ports(self):
         if external_processes['platformio'].state != QProcess.NotRunning:
@@ -413,6 +490,8 @@ class BusinessLogic:
         if external_processes['platformio'].state != QProcess.NotRunning:
             log.error(f"platformio already running! {external_processes['platformio']}")
             return
+        # Builds on a build cache miss, same as build_fw()
+        get_pkg_prefetcher().wait_all()
 
         # Stupid fix for avrdude outputting to stderr by default
         if self.logic_state.env_is_avr_based():
@@ -422,14 +501,21 @@ class BusinessLogic:
         else:
             env_vars = {}
 
+        pio_args = [
+            'run',
+            '--environment', self.logic_state.pio_env,
+            '--project-dir', str(self.logic_state.fw_dir),
+            '--verbose',
+            '--target', 'upload',
+            '--upload-port', self.logic_state.upload_port,
+        ]
+        if self.logic_state.build_from_cache:
+            # Only the artifacts were restored, a build would start from scratch. And without
+            # a matching project.checksum, platformio's auto clean would delete them first
+            pio_args += ['--target', 'nobuild', '--disable-auto-clean']
+
         external_processes['platformio'].start(
-            ['run',
-             '--environment', self.logic_state.pio_env,
-             '--project-dir', str(self.logic_state.fw_dir),
-             '--verbose',
-             '--target', 'upload',
-             '--upload-port', self.logic_state.upload_port,
-             ],
+            pio_args,
             self.pio_upload_finished,
             env_vars=env_vars,
         )
@@ -458,3 +544,14 @@ class BusinessLogic:
     def modal_show_stats(self):
         dlg = AnonStatsDialog(self.logic_state, self.main_app)
         dlg.exec_()
+
+    @Slot()
+    def modal_build_matrix(self):
+        if self.logic_state.fw_dir is None or not self.logic_state.pio_envs \
+                or self.logic_state.config_file_path is None:
+            log.error('Download the firmware and select a local configuration file before building multiple boards')
+            return
+        fw_version = self.logic_state.release_list[self.logic_state.release_idx]
+        dlg = BuildMatrixDialog(self.logic_state.fw_dir, fw_version.nice_name, self.logic_state.pio_envs,
+                                Path(self.logic_state.config_file_path), self.threadpool, self.main_app)
+        dlg.exec_()
@@ -2,12 +2,16 @@ import logging
 from typing import NamedTuple, List, Optional
 from pathlib import Path
 
+from pio_project import pio_env_is_avr_based
+
 log = logging.getLogger('')
 
 
 class FWVersion(NamedTuple):
     nice_name: str
     url: str
+    is_branch: bool = False  # branches can change under the same URL, tags can't
+    git_ref: Optional[str] = None  # if set, can be fetched from the git mirror instead of url
 
 
 class PioEnv(NamedTuple):
@@ -23,6 +27,11 @@ class LogicState:
     pio_env: Optional[str] = None
     config_file_path: Optional[str] = None
     build_success: bool = False
+    build_cache_key: Optional[str] = None
+    build_from_cache: bool = False  # artifacts were restored, so upload must not build
+    compiler_cache_stats_path: Optional[Path] = None
+    profile_build: bool = False  # time every build step, without any caching
+    build_times_path: Optional[Path] = None
     serial_ports: List[str] = []
     upload_port: Optional[str] = None
 
@@ -31,11 +40,4 @@ class LogicState:
         super().__setattr__(key, val)
 
     def env_is_avr_based(self):
-        # For stupid hot patches that only affect AVR based boards :/
-        env_not_none = self.pio_env is not None
-
-        is_avr_based = env_not_none and any(
-            avr_env_substr in self.pio_env.lower()
-            for avr_env_substr in ['mksgenl', 'ramps']
-        )
-        return is_avr_based
+        return pio_env_is_avr_based(self.fw_dir, self.pio_env)
@@ -0,0 +1,185 @@
+import re
+import json
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Dict, Optional, NamedTuple, Pattern, Tuple
+
+from misc_utils import atomic_write_text
+
+log = logging.getLogger('')
+
+# Records what was applied to a firmware directory, so an already patched tree is skipped
+HOT_PATCH_MARKER_NAME = '.oatfwgui_hot_patches.json'
+
+
+class HotPatchRule(NamedTuple):
+    """
+    One fix for platformio.ini of releases we can't re-tag. The pattern is matched against
+    each line (without the line ending) and must not match its own replacement, so that
+    patching an already patched file does nothing.
+    """
+    name: str
+    description: str
+    pattern: Pattern
+    replacement: str
+    avr_only: bool = False  # only for boards that use the atmelavr platform
+    max_fw_version: Optional[Tuple[int, ...]] = None  # only releases up to this one, branches always
+
+
+HOT_PATCH_RULES = [
+    HotPatchRule(
+        name='git_tag_specifier',
+        description='git tag specifiers',
+        pattern=re.compile(r'(^[^;\n]+github\.com.+)@'),
+        replacement=r'\1#',
+    ),
+    HotPatchRule(
+        name='avr_platform_version',
+        description='platformio AVR platform',
+        # hard match the entire line
+        pattern=re.compile(r'^platform = atmelavr$'),
+        replacement='platform = atmelavr@4.2.0',
+        avr_only=True,
+    ),
+    HotPatchRule(
+        name='oled_ssd1306_revision',
+        description='oled-ssd1306 revision',
+        # After git_tag_specifier, so it also matches what that turned an @4.6.0 into
+        pattern=re.compile(r'(ClutchplateDude/esp8266-oled-ssd1306\s*#\s*4\.6\.0)'),
+        replacement='ClutchplateDude/esp8266-oled-ssd1306#4.6.2',
+    ),
+]
+
+
+def rules_id(rules: List[HotPatchRule]) -> str:
+    # Changes whenever a rule does, so trees patched by older rules are looked at again
+    rule_defs = [[r.name, r.pattern.pattern, r.replacement, r.avr_only, r.max_fw_version] for r in rules]
+    return hashlib.sha256(json.dumps(rule_defs).encode()).hexdigest()[:16]
+
+
+HOT_PATCH_RULES_ID = rules_id(HOT_PATCH_RULES)
+
+
+class HotPatchResult(NamedTuple):
+    applied: List[str]  # every rule that has patched this tree
+    fired: List[str]  # rules that changed something just now
+    ini_sha256: str
+
+
+def parse_fw_version(fw_version_name: Optional[str]) -> Optional[Tuple[int, ...]]:
+    # i.e. 'V1.13.14' -> (1, 13, 14), None for a branch like 'develop'
+    if fw_version_name is None:
+        return None
+    version_match = re.match(r'^[vV]?(\d+(?:\.\d+)*)', fw_version_name)
+    if version_match is None:
+        return None
+    return tuple(int(n) for n in version_match.group(1).split('.'))
+
+
+def select_rules(is_avr_based: bool, fw_version_name: Optional[str]) -> List[HotPatchRule]:
+    fw_version = parse_fw_version(fw_version_name)
+    return [
+        rule for rule in HOT_PATCH_RULES
+        if (is_avr_based or not rule.avr_only)
+        and (rule.max_fw_version is None or fw_version is None or fw_version <= rule.max_fw_version)
+    ]
+
+
+def patch_ini_text(ini_text: str, rules: List[HotPatchRule]) -> Tuple[str, List[str]]:
+    """Apply all rules in one pass over the lines. Returns the patched text and the rules that fired."""
+    fired = []
+    out_lines = []
+    for line in ini_text.splitlines(keepends=True):
+        line_body = line.rstrip('\n')
+        line_ending = line[len(line_body):]
+        for rule in rules:
+            patched_body = rule.pattern.sub(rule.replacement, line_body)
+            if patched_body != line_body:
+                if rule.name not in fired:
+                    log.warning(f'Hot patching {rule.description}!!!')
+                    fired.append(rule.name)
+                log.warning(f'Replacing {repr(line_body)} with {repr(patched_body)}')
+                line_body = patched_body
+        out_lines.append(line_body + line_ending)
+    return ''.join(out_lines), fired
+
+
+class HotPatcher:
+    """
+    Applies HOT_PATCH_RULES to a firmware directory's platformio.ini. What was applied is kept
+    in HOT_PATCH_MARKER_NAME (and in memory) along with the patched file's size/mtime, so
+    patching a tree that hasn't changed since is just a stat.
+    """
+
+    def __init__(self):
+        self.memo: Dict[Path, Tuple[dict, HotPatchResult]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def ini_signature(ini_path: Path, context: str) -> dict:
+        ini_stat = ini_path.stat()
+        return {'size': ini_stat.st_size, 'mtime_ns': ini_stat.st_mtime_ns, 'context': context}
+
+    @staticmethod
+    def read_marker(fw_dir: Path) -> Optional[dict]:
+        try:
+            with open(Path(fw_dir, HOT_PATCH_MARKER_NAME), 'r') as fp:
+                return json.load(fp)
+        except (OSError, json.decoder.JSONDecodeError):
+            return None
+
+    def patch(self, fw_dir: Path, is_avr_based: bool, fw_version_name: Optional[str] = None) -> HotPatchResult:
+        fw_dir = fw_dir.resolve()
+        ini_path = Path(fw_dir, 'platformio.ini')
+        context = f'{HOT_PATCH_RULES_ID}:{is_avr_based}:{fw_version_name}'
+        with self.lock:
+            signature = self.ini_signature(ini_path, context)
+            memo_entry = self.memo.get(fw_dir)
+            if memo_entry is not None and memo_entry[0] == signature:
+                return memo_entry[1]._replace(fired=[])
+            marker = self.read_marker(fw_dir)
+            if marker is not None and marker.get('signature') == signature:
+                log.debug(f'Hot patches already applied to {ini_path}: {marker["applied"]}')
+                result = HotPatchResult(marker['applied'], [], marker['ini_sha256'])
+                self.memo[fw_dir] = (signature, result)
+                return result
+
+            result = self._patch(ini_path, is_avr_based, fw_version_name, marker)
+            signature = self.ini_signature(ini_path, context)
+            atomic_write_text(Path(fw_dir, HOT_PATCH_MARKER_NAME), json.dumps({
+                'signature': signature,
+                'applied': result.applied,
+                'ini_sha256': result.ini_sha256,
+            }))
+            self.memo[fw_dir] = (signature, result)
+            return result
+
+    @staticmethod
+    def _patch(ini_path: Path, is_avr_based: bool, fw_version_name: Optional[str],
+               marker: Optional[dict]) -> HotPatchResult:
+        # Text mode, so line endings are always \n (and written back as the platform's)
+        with open(ini_path, 'r') as fp:
+            ini_text = fp.read()
+        ini_sha256 = hashlib.sha256(ini_text.encode()).hexdigest()
+        # If the file is still what we wrote last time, it was patched by these rules already
+        previously_applied = []
+        if marker is not None and marker.get('ini_sha256') == ini_sha256:
+            previously_applied = marker.get('applied', [])
+
+        patched_text, fired = patch_ini_text(ini_text, select_rules(is_avr_based, fw_version_name))
+        if fired:
+            log.debug('Writing out patched ini file')
+            atomic_write_text(ini_path, patched_text)
+            ini_sha256 = hashlib.sha256(patched_text.encode()).hexdigest()
+        else:
+            log.debug('No patches applied')
+        applied = [rule.name for rule in HOT_PATCH_RULES if rule.name in previously_applied or rule.name in fired]
+        return HotPatchResult(applied, fired, ini_sha256)
+
+
+@lru_cache(maxsize=1)
+def get_hot_patcher() -> HotPatcher:
+    return HotPatcher()
@@ -0,0 +1,238 @@
+import re
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, NamedTuple
+
+from fw_git_mirror import GitError, git_available
+from misc_utils import decode_bytes, delete_directory
+from pio_project import PioEnvConfig, get_pio_project
+
+log = logging.getLogger('')
+
+LIBDEPS_MAX_SNAPSHOTS = 10
+# A clone/fetch that hasn't finished by then has stalled, platformio clones directly instead
+GIT_TIMEOUT_S = 5 * 60
+# lib_deps entries like [Name=][git+]https://github.com/owner/repo[.git][#ref]
+URL_DEP_RE = re.compile(r'^(?:[^=\s]+\s*=\s*)?(?P<git_prefix>git\+)?(?P<url>[a-z+]+://[^#\s]+)(?:#(?P<ref>\S*))?$')
+GIT_HOSTS = ['github.com', 'gitlab.com', 'bitbucket.org']
+ARCHIVE_SUFFIXES = ('.zip', '.tar.gz', '.tgz', '.tar.bz2')
+COMMIT_SHA_RE = re.compile(r'^[0-9a-f]{7,40}$')
+
+RunPlatformioFn = Callable[[List[str], Dict[str, str], Path], int]
+
+
+class GitDep(NamedTuple):
+    lib_dep: str
+    url: str
+    ref: Optional[str]
+
+
+def git_dep(lib_dep: str) -> Optional[GitDep]:
+    """lib_dep's repository if it's cloned with git by platformio, else None"""
+    dep_match = URL_DEP_RE.match(lib_dep.strip())
+    if dep_match is None:
+        return None
+    url = dep_match.group('url')
+    if url.endswith(ARCHIVE_SUFFIXES):
+        return None  # platformio downloads these, no git involved
+    if dep_match.group('git_prefix') or url.endswith('.git') or any(f'://{h}/' in url for h in GIT_HOSTS):
+        return GitDep(lib_dep.strip(), url, dep_match.group('ref') or None)
+    return None
+
+
+def git_config_env_vars(git_config: Dict[str, str]) -> Dict[str, str]:
+    # Same as `git -c ...` for every git a process runs (needs git 2.31+)
+    env_vars = {'GIT_CONFIG_COUNT': str(len(git_config))} if git_config else {}
+    for i, (key, value) in enumerate(git_config.items()):
+        env_vars[f'GIT_CONFIG_KEY_{i}'] = key
+        env_vars[f'GIT_CONFIG_VALUE_{i}'] = value
+    return env_vars
+
+
+class LibMirror:
+    """
+    Keeps the firmware's libraries locally, so a fresh worktree (or a bench without internet)
+    doesn't clone/download them again:
+    - A whole .pio/libdeps/<env> is snapshotted after a successful install, keyed by the
+      environment's resolved lib_deps/platform/framework, and copied into worktrees that
+      need the same libraries. platformio then finds them already installed.
+    - Without a snapshot, git lib_deps are installed into .pio/libdeps/<env> from bare
+      mirrors (updated with `git fetch`) before platformio's own install runs. Only that
+      install is pointed at the mirrors, platformio.ini and the build aren't changed.
+    """
+
+    def __init__(self, mirror_dir: Path, run_platformio: RunPlatformioFn, log_dir: Path,
+                 max_snapshots: int = LIBDEPS_MAX_SNAPSHOTS):
+        self.git_dir = Path(mirror_dir, 'git')
+        self.libdeps_dir = Path(mirror_dir, 'libdeps')
+        self.run_platformio = run_platformio
+        self.log_dir = log_dir
+        self.max_snapshots = max_snapshots
+        self.fetched_urls = set()  # only fetch each repository once per run
+        self.url_locks: Dict[str, threading.Lock] = {}
+        # Only for the libdeps snapshots and url_locks, never held during a clone/fetch
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _git(args: List[str]) -> str:
+        all_args = ['git'] + args
+        log.debug(f'Running {all_args}')
+        try:
+            sub_proc = subprocess.run(all_args, capture_output=True, timeout=GIT_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            raise GitError(f'{args} timed out after {GIT_TIMEOUT_S}s')
+        if sub_proc.returncode != 0:
+            raise GitError(f'{args} failed ({sub_proc.returncode}): {decode_bytes(sub_proc.stderr)}')
+        return decode_bytes(sub_proc.stdout)
+
+    def git_mirror_path(self, url: str) -> Path:
+        repo_name = re.sub(r'[^A-Za-z0-9_.-]', '_', url.rstrip('/').rsplit('/', maxsplit=1)[-1])
+        if repo_name.endswith('.git'):
+            repo_name = repo_name[:-len('.git')]
+        url_hash = hashlib.sha256(url.encode()).hexdigest()[:8]
+        return Path(self.git_dir, f'{repo_name}_{url_hash}.git')
+
+    def update_git_mirror(self, url: str, ref: Optional[str] = None) -> Optional[Path]:
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        # Different repositories can be cloned at the same time, the same one only once
+        with url_lock:
+            return self._update_git_mirror(url, ref)
+
+    def has_pinned_ref(self, mirror_path: Path, ref: Optional[str]) -> bool:
+        # A tag or commit doesn't change, so the mirror doesn't need fetching for it. A branch does.
+        if ref is None or not Path(mirror_path, 'HEAD').is_file():
+            return False
+        rev = ref if COMMIT_SHA_RE.match(ref) else f'refs/tags/{ref}'
+        try:
+            self._git(['--git-dir', str(mirror_path), 'rev-parse', '--verify', '--quiet', f'{rev}^{{commit}}'])
+        except GitError:
+            return False
+        return True
+
+    def _update_git_mirror(self, url: str, ref: Optional[str]) -> Optional[Path]:
+        mirror_path = self.git_mirror_path(url)
+        if url in self.fetched_urls or self.has_pinned_ref(mirror_path, ref):
+            return mirror_path
+        try:
+            if Path(mirror_path, 'HEAD').is_file():
+                log.info(f'Updating library mirror of {url}')
+                self._git(['--git-dir', str(mirror_path), 'fetch', '--quiet', '--prune', 'origin'])
+            else:
+                log.info(f'Creating library mirror of {url} in {mirror_path}')
+                tmp_mirror_path = mirror_path.with_name(mirror_path.name + '.oatfwgui_tmp')
+                if tmp_mirror_path.exists():
+                    delete_directory(tmp_mirror_path)
+                self.git_dir.mkdir(parents=True, exist_ok=True)
+                self._git(['clone', '--quiet', '--mirror', url, str(tmp_mirror_path)])
+                tmp_mirror_path.replace(mirror_path)
+        except (GitError, OSError) as e:
+            if not Path(mirror_path, 'HEAD').is_file():
+                log.warning(f'Could not mirror {url}, platformio will clone it directly: {e}')
+                return None
+            # i.e. offline, what we already have is still good for tags and pinned commits
+            log.warning(f'Could not update library mirror of {url}, using it as it is: {e}')
+        self.fetched_urls.add(url)
+        return mirror_path
+
+    def install_git_libs(self, fw_dir: Path, env_config: PioEnvConfig):
+        """
+        Install the git lib_deps from the mirrors, with the lib_deps entries as they are. That's
+        what platformio records as installed, so its own install (and the build) finds them.
+        """
+        if not git_available():
+            return
+        git_config = {}
+        lib_specs = []
+        for lib_dep in env_config.lib_deps:
+            dep = git_dep(lib_dep)
+            if dep is None:
+                continue
+            mirror_path = self.update_git_mirror(dep.url, dep.ref)
+            if mirror_path is None:
+                continue
+            git_config[f'url.{mirror_path.absolute().as_uri()}.insteadOf'] = dep.url
+            lib_specs.append(dep.lib_dep)
+        if not lib_specs:
+            return
+        pio_args = ['pkg', 'install', '--environment', env_config.name, '--project-dir', str(fw_dir),
+                    '--no-save', '--skip-dependencies']
+        for lib_spec in lib_specs:
+            pio_args += ['--library', lib_spec]
+        date_str = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+        log_path = Path(self.log_dir, f'lib_install_{date_str}_{env_config.name}.log')
+        log.info(f'Installing {len(lib_specs)} libraries for {env_config.name} from the library mirror')
+        # Only the libraries themselves, so insteadOf can't redirect a dependency's URL
+        exit_code = self.run_platformio(pio_args, git_config_env_vars(git_config), log_path)
+        if exit_code != 0:
+            log.warning(f'Installing libraries from the mirror failed ({exit_code}), '
+                        f'platformio will clone them directly. See {log_path}')
+
+    @staticmethod
+    def libdeps_key(env_config: PioEnvConfig) -> str:
+        key_parts = [env_config.lib_deps, env_config.platform, env_config.framework]
+        return hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()
+
+    def restore_libdeps(self, fw_dir: Path, env_config: PioEnvConfig) -> bool:
+        env_libdeps_dir = Path(fw_dir, '.pio', 'libdeps', env_config.name)
+        if env_libdeps_dir.exists() or not env_config.lib_deps:
+            return False
+        snapshot_dir = Path(self.libdeps_dir, self.libdeps_key(env_config))
+        if not snapshot_dir.is_dir():
+            return False
+        log.info(f'Copying libraries for {env_config.name} from {snapshot_dir}')
+        tmp_libdeps_dir = env_libdeps_dir.with_name(env_libdeps_dir.name + '.oatfwgui_tmp')
+        if tmp_libdeps_dir.exists():
+            delete_directory(tmp_libdeps_dir)
+        shutil.copytree(snapshot_dir, tmp_libdeps_dir, symlinks=True)
+        tmp_libdeps_dir.replace(env_libdeps_dir)
+        snapshot_dir.touch()  # for least recently used pruning
+        return True
+
+    def store_libdeps(self, fw_dir: Path, env_config: PioEnvConfig):
+        env_libdeps_dir = Path(fw_dir, '.pio', 'libdeps', env_config.name)
+        snapshot_dir = Path(self.libdeps_dir, self.libdeps_key(env_config))
+        if not env_libdeps_dir.is_dir() or snapshot_dir.exists():
+            return
+        log.info(f'Saving libraries for {env_config.name} to {snapshot_dir}')
+        tmp_snapshot_dir = snapshot_dir.with_name(snapshot_dir.name + '.oatfwgui_tmp')
+        if tmp_snapshot_dir.exists():
+            delete_directory(tmp_snapshot_dir)
+        shutil.copytree(env_libdeps_dir, tmp_snapshot_dir, symlinks=True)
+        tmp_snapshot_dir.replace(snapshot_dir)
+        self._prune()
+
+    def _prune(self):
+        snapshot_dirs = [p for p in self.libdeps_dir.iterdir() if p.is_dir() and not p.name.endswith('_tmp')]
+        snapshot_dirs.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+        for old_snapshot_dir in snapshot_dirs[self.max_snapshots:]:
+            log.debug(f'Removing old library snapshot {old_snapshot_dir}')
+            delete_directory(old_snapshot_dir)
+
+    def prepare(self, fw_dir: Path, pio_env: str):
+        """Call before platformio installs libraries for pio_env (after the hot patches)"""
+        if Path(fw_dir, '.pio', 'libdeps', pio_env).exists():
+            return  # Installed already, platformio takes care of any changes
+        env_config = get_pio_project(fw_dir).env(pio_env)
+        with self.lock:
+            try:
+                if self.restore_libdeps(fw_dir, env_config):
+                    return
+            except OSError as e:
+                log.warning(f'Could not copy libraries for {pio_env}: {e}')
+        self.install_git_libs(fw_dir, env_config)
+
+    def store(self, fw_dir: Path, pio_env: str):
+        """Call after platformio installed everything for pio_env"""
+        env_config = get_pio_project(fw_dir).env(pio_env)
+        with self.lock:
+            try:
+                self.store_libdeps(fw_dir, env_config)
+            except OSError as e:
+                log.warning(f'Could not save libraries for {pio_env}: {e}')
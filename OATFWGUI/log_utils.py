@@ -134,7 +134,7 @@ class LoggedExternalFile:
             self.log.warning(f'Could not remove temp file {self.tempfile.name}')
 
 
-def setup_logging(logger, qt_log_obj: LogObject):
+def setup_logging(logger, qt_log_obj: Optional[LogObject]):
     logger.setLevel(logging.DEBUG)
     # file handler
     log_dir = Path(get_install_dir(), 'logs')
@@ -151,9 +151,10 @@ def setup_logging(logger, qt_log_obj: LogObject):
     ch.setFormatter(CustomFormatter(colour_type=LogColourTypes.terminal))
     logger.addHandler(ch)
     # gui handler
-    gh = logging.StreamHandler(stream=qt_log_obj)
-    gh.setLevel(logging.INFO)
-    gh.setFormatter(CustomFormatter(colour_type=LogColourTypes.html))
-    logger.addHandler(gh)
+    if qt_log_obj is not None:
+        gh = logging.StreamHandler(stream=qt_log_obj)
+        gh.setLevel(logging.INFO)
+        gh.setFormatter(CustomFormatter(colour_type=LogColourTypes.html))
+        logger.addHandler(gh)
 
     logger.debug(f'Logging initialized (logfile={log_file})')
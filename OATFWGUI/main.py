@@ -6,15 +6,17 @@ import os
 import argparse
 import time
 import tempfile
-import requests
 import json
 import signal
 import traceback
 from pathlib import Path
-from typing import Dict, Tuple, Optional
+from typing import Dict, Tuple, Optional, Union
+
+# Measure startup from as early as possible (just after the standard library imports)
+APP_START_TIME = time.perf_counter()
 
 import semver
-from PySide6.QtCore import Slot, Qt, QFile
+from PySide6.QtCore import Slot, Qt, QFile, QThreadPool, QTimer
 from PySide6.QtWidgets import QApplication, QMainWindow, QStatusBar, QLabel
 from PySide6.QtGui import QAction, QActionGroup
 from PySide6.QtUiTools import QUiLoader
@@ -22,14 +24,31 @@ from PySide6.QtUiTools import QUiLoader
 from _version import __version__
 from log_utils import LogObject, setup_logging
 from gui_logic import BusinessLogic
+from batch_cli import run_batch, run_jobs_benchmark
+from build_jobs import AUTO_BUILD_JOBS, parse_build_jobs_setting, override_build_jobs_setting, \
+    get_build_jobs_setting, set_build_jobs_setting, get_cpu_count, benchmark_candidates
 from platform_check import get_platform, PlatformEnum
-from external_processes import external_processes, add_external_process, get_install_dir
+from external_processes import external_processes, add_external_process, get_install_dir, get_platformio_version
 from anon_usage_data import create_anon_stats
-from misc_utils import delete_directory
+from background_cleanup import tombstone_directory, start_background_cleanup
+from toolchain_store import ToolchainStore, PIO_CORE_PREFIX
+from qt_extensions import Worker
+import network
 
 parser = argparse.ArgumentParser(usage='Graphical way to build and load OAT Firmware')
 parser.add_argument('--no-gui', action='store_true',
                     help='Do not start the graphics, exit just before then (used as a basic functionality test)')
+parser.add_argument('--batch', type=Path, metavar='MANIFEST',
+                    help='Run the download/build/upload jobs in a JSON manifest without the GUI')
+parser.add_argument('--concurrency', type=int, default=1,
+                    help='How many --batch jobs to run at once (default: %(default)s)')
+parser.add_argument('--summary', type=Path, metavar='FILE',
+                    help='Where to write the JSON summary of a --batch run (default: in the batch log directory)')
+parser.add_argument('--build-jobs', type=parse_build_jobs_setting, metavar='{auto,N}',
+                    help='Compile jobs per build for this run, "auto" picks from the idle cores and free memory')
+parser.add_argument('--benchmark-jobs', type=Path, metavar='MANIFEST',
+                    help='Time builds of every environment in a --batch style manifest with different '
+                         'numbers of compile jobs, and remember the fastest for "auto"')
 parser.add_argument('-v', '--version', action='version',
                     version=__version__,
                     help='Print version string and exit')
@@ -50,11 +69,12 @@ def setup_environment():
     log.debug(f'Install dir is {install_dir}')
     if get_platform() == PlatformEnum.WINDOWS:
         # With 54fa285a dependencies the maximum path length is 180.
-        # 260-152=108, but derate to 100 (for possible future increases)
+        # 260-152=108, but derate to 100 (for possible future increases).
+        # Each release is in its own OATFW/<6 hex chars> folder, which adds another 7.
         # pushd {install_dir} && find . -print|awk '{print length($0), $0}'|sort --numeric --reverse|head -n20
         log_msg = f'''If you get 'file not found' errors the easiest solution is to move
 the {install_dir.resolve()} folder somewhere with less characters in the path.'''
-        check_and_warn_directory_path_length(install_dir, 100, log_msg)
+        check_and_warn_directory_path_length(install_dir, 93, log_msg)
 
     portable_git_dir = Path(install_dir, '.portable_git', 'bin')
     if portable_git_dir.is_dir():
@@ -64,19 +84,32 @@ the {install_dir.resolve()} folder somewhere with less characters in the path.''
     # Putting the platformio core directory in a temporary folder is only needed because
     # Windows doesn't support long path names... :/
     tempdir_path = Path(tempfile.gettempdir())
-    pio_prefix_str = '.pioOATFWGUI'
-    pio_core_dir = Path(tempdir_path, f'{pio_prefix_str}{__version__}')
+    # Shared between OATFWGUI versions, so that upgrading doesn't re-download all the toolchains
+    toolchain_store = ToolchainStore(tempdir_path)
+    pio_core_dir = toolchain_store.get_core_dir(get_platformio_version() or f'unknown-{__version__}')
     log.info(f'Setting PLATFORMIO_CORE_DIR to {pio_core_dir}')
     os.environ['PLATFORMIO_CORE_DIR'] = str(pio_core_dir)
 
     log.debug('Checking for previous OATFWGUI pio core installs...')
-    for temp_path in tempdir_path.iterdir():
-        is_dir = temp_path.is_dir()
-        is_oatfwgui_core_dir = pio_prefix_str in temp_path.name
-        not_current_core_dir = temp_path.name != pio_core_dir
-        if is_dir and is_oatfwgui_core_dir and not_current_core_dir:
-            log.info(f'Removing other pio core directory:{temp_path.name}')
-            delete_directory(temp_path)
+    with os.scandir(tempdir_path) as temp_entries:
+        # Check the name first, it's much cheaper than is_dir on a big temp directory
+        old_core_dirs = [
+            Path(temp_entry.path) for temp_entry in temp_entries
+            if temp_entry.name.startswith(PIO_CORE_PREFIX)
+            and temp_entry.name not in toolchain_store.managed_core_dir_names()
+            and temp_entry.is_dir()
+        ]
+    for old_core_dir in old_core_dirs:
+        log.info(f'Removing other pio core directory:{old_core_dir.name}')
+        tombstone_directory(old_core_dir)
+
+    def maintain_toolchain_store():
+        toolchain_store.refresh(active_core_name=pio_core_dir.name)
+        toolchain_store.evict(keep_core_name=pio_core_dir.name)
+
+    # Deleting can take a long time (toolchains are big), so do it in the background.
+    # The install dir has whatever an earlier launch didn't finish deleting (i.e. old FW trees).
+    start_background_cleanup([tempdir_path, install_dir], before_cleanup=maintain_toolchain_store)
 
     python_interpreter_path = Path(sys.executable)
     log.debug(f'Python interpreter: {python_interpreter_path}')
@@ -88,14 +121,47 @@ the {install_dir.resolve()} folder somewhere with less characters in the path.''
     if embedded_python_scripts_dir.is_dir():
         log.info('Running in embedded python')
         os.environ['PATH'] += os.pathsep + str(embedded_python_scripts_dir)
-        add_external_process('platformio', str(python_interpreter_path), ['-m', 'platformio'])
+        pio_prog_and_args = (str(python_interpreter_path), ['-m', 'platformio'])
     else:
         log.info('Not running in embedded python')
-        add_external_process('platformio', 'platformio', [])
-
-    external_processes['platformio'].start(['system', 'info'], None)
-    external_processes['platformio'].start(['settings', 'set', 'check_platformio_interval', '9999'], None)
-    external_processes['platformio'].start(['settings', 'set', 'check_prune_system_threshold', '0'], None)
+        pio_prog_and_args = ('platformio', [])
+    add_external_process('platformio', *pio_prog_and_args)
+    # For things that can run at the same time as the main platformio process (i.e. logging system info)
+    add_external_process('platformio_background', *pio_prog_and_args)
+
+    apply_platformio_settings(pio_core_dir)
+
+
+def apply_platformio_settings(pio_core_dir: Path):
+    # Each platformio call costs a python interpreter startup + platformio import, so only
+    # apply the settings when they haven't already been applied to this core directory
+    pio_settings = [
+        ('check_platformio_interval', '9999'),
+        ('check_prune_system_threshold', '0'),
+    ]
+    stamp_path = Path(pio_core_dir, '.oatfwgui_settings_stamp')
+    stamp = {
+        'platformio_version': get_platformio_version(),
+        'core_dir': str(pio_core_dir),
+        'settings': [list(setting) for setting in pio_settings],
+    }
+    try:
+        with open(stamp_path, 'r') as fp:
+            stamp_ok = stamp['platformio_version'] is not None and json.load(fp) == stamp
+    except (OSError, json.decoder.JSONDecodeError):
+        stamp_ok = False
+    if stamp_ok:
+        log.debug(f'platformio settings already applied ({stamp_path})')
+        return
+
+    settings_ok = True
+    for setting_name, setting_value in pio_settings:
+        external_processes['platformio'].start(['settings', 'set', setting_name, setting_value], None)
+        settings_ok &= external_processes['platformio'].qproc.exitCode() == 0
+    if settings_ok and stamp['platformio_version'] is not None:
+        pio_core_dir.mkdir(parents=True, exist_ok=True)
+        with open(stamp_path, 'w') as fp:
+            json.dump(stamp, fp)
 
 
 def raw_version_to_semver() -> Optional[semver.VersionInfo]:
@@ -118,14 +184,14 @@ def check_new_oatfwgui_release() -> Optional[Tuple[str, str]]:
 
     oatfwgui_api_url = 'https://api.github.com/repos/OpenAstroTech/OATFWGUI/releases'
     log.info(f'Checking for new OATFWGUI release from {oatfwgui_api_url}')
-    r = requests.get(oatfwgui_api_url, timeout=2000)
-    if r.status_code != requests.codes.ok:
-        log.error(f'Failed to check for new release: {r.status_code} {r.reason} {r.text}')
+    releases_json = network.get_json_cached(oatfwgui_api_url)
+    if not isinstance(releases_json, list):
+        log.error(f'Failed to check for new release: {releases_json}')
         return None
 
     releases: Dict[semver.VersionInfo, str] = {}
     latest_release_ver: Optional[semver.VersionInfo] = None
-    for release_json in r.json():
+    for release_json in releases_json:
         try:
             release_ver = semver.VersionInfo.parse(release_json['tag_name'])
         except ValueError as e:
@@ -136,7 +202,7 @@ def check_new_oatfwgui_release() -> Optional[Tuple[str, str]]:
             latest_release_ver = release_ver
 
     if latest_release_ver is None:
-        log.debug(f'No latest release? {r.json()}')
+        log.debug(f'No latest release? {releases_json}')
         return None
 
     # need to 'finalize' the version, as we use the prerelease/build fields to indicate a release version
@@ -170,6 +236,13 @@ class MainWindow(QMainWindow):
         self.add_log_menu_helper('warning', self.log_warn)
         self.add_log_menu_helper('error', self.log_error)
 
+        self.build_jobs_submenu = self.file_menu.addMenu('Build jobs')
+        self.build_jobs_action_group = QActionGroup(self)
+        build_jobs_setting = get_build_jobs_setting()
+        self.add_build_jobs_menu_helper(AUTO_BUILD_JOBS, build_jobs_setting)
+        for build_jobs in benchmark_candidates(get_cpu_count()):
+            self.add_build_jobs_menu_helper(build_jobs, build_jobs_setting)
+
         self.exit_action = QAction('Exit')
         self.exit_action.triggered.connect(exit_handler)
         self.file_menu.addAction(self.exit_action)
@@ -177,12 +250,8 @@ class MainWindow(QMainWindow):
         self.status_bar = QStatusBar()
         self.setStatusBar(self.status_bar)
 
-        new_release_tup = check_new_oatfwgui_release()
-        if new_release_tup is not None:
-            new_release_html = f'<a href="{new_release_tup[1]}">New release {new_release_tup[0]} available!</a>'
-        else:
-            new_release_html = ''
-        self.new_release_hyperlink = QLabel(new_release_html)
+        # Filled in by the update check once it finishes
+        self.new_release_hyperlink = QLabel('')
         self.new_release_hyperlink.setTextInteractionFlags(Qt.TextBrowserInteraction)
         self.new_release_hyperlink.setOpenExternalLinks(True)
         self.status_bar.addWidget(self.new_release_hyperlink)  # addWidget == left side
@@ -210,6 +279,35 @@ class MainWindow(QMainWindow):
         # business logic will connect signals as well
         self.logic = BusinessLogic(self.main_widget)
 
+        self.build_matrix_action = QAction('Build multiple boards...')
+        self.build_matrix_action.triggered.connect(self.logic.modal_build_matrix)
+        self.file_menu.insertAction(self.exit_action, self.build_matrix_action)
+        self.profile_build_action = QAction('Profile build times')
+        self.profile_build_action.setCheckable(True)
+        self.profile_build_action.setToolTip('Time every compile/link step of the next builds, '
+                                             'the report is saved in the logs folder')
+        self.profile_build_action.triggered.connect(self.logic.set_profile_build)
+        self.file_menu.insertAction(self.exit_action, self.profile_build_action)
+
+        # Check for updates in the background, the window shouldn't wait on GitHub
+        self.update_check_worker = Worker(check_new_oatfwgui_release)
+        self.update_check_worker.signals.result.connect(self.new_release_result)
+        self.update_check_worker.setAutoDelete(False)
+        QThreadPool.globalInstance().start(self.update_check_worker)
+
+        # Runs once the event loop has processed the initial show/paint events
+        QTimer.singleShot(0, self.log_first_paint)
+
+    @Slot()
+    def log_first_paint(self):
+        log.info(f'Time to first paint: {(time.perf_counter() - APP_START_TIME) * 1000:.0f}ms')
+
+    @Slot()
+    def new_release_result(self, new_release_tup: Optional[Tuple[str, str]]):
+        if new_release_tup is not None:
+            new_release_html = f'<a href="{new_release_tup[1]}">New release {new_release_tup[0]} available!</a>'
+            self.new_release_hyperlink.setText(new_release_html)
+
     def add_log_menu_helper(self, name: str, cb_fn, is_checked=False):
         action = QAction(name)
         action.setCheckable(True)
@@ -221,6 +319,16 @@ class MainWindow(QMainWindow):
         self.log_action_group.addAction(action)
         self.log_level_submenu.addAction(action)
 
+    def add_build_jobs_menu_helper(self, build_jobs: Union[str, int], current_build_jobs: Union[str, int]):
+        action = QAction(str(build_jobs))
+        action.setCheckable(True)
+        action.setChecked(build_jobs == current_build_jobs)
+        action.triggered.connect(lambda: set_build_jobs_setting(build_jobs))
+        # set self so we don't delete the object when it goes out of scope
+        setattr(self, f'_auto_build_jobs_action_{build_jobs}', action)
+        self.build_jobs_action_group.addAction(action)
+        self.build_jobs_submenu.addAction(action)
+
     @staticmethod
     def set_gui_log_level(log_level: int):
         log.debug(f'Setting GUI log level to {logging.getLevelName(log_level)}')
@@ -268,6 +376,13 @@ and attach the latest log file from the 'logs' directory ({str(Path(get_install_
 
 def main():
     setup_environment()
+    if args.build_jobs is not None:
+        override_build_jobs_setting(args.build_jobs)
+    if args.benchmark_jobs is not None:
+        sys.exit(run_jobs_benchmark(args.benchmark_jobs))
+    if args.batch is not None:
+        sys.exit(run_batch(args.batch, args.concurrency, args.summary))
+
     log.debug('Creating app')
     app = QApplication()
 
@@ -298,7 +413,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     log = logging.getLogger('')
-    l_o = LogObject()
+    # Nothing to show the log in without the GUI
+    l_o = LogObject() if args.batch is None and args.benchmark_jobs is None else None
     setup_logging(log, l_o)
     log.debug('Set up logging')
     main()
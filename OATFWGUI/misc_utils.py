@@ -1,6 +1,8 @@
 import os
+import json
 import stat
 import shutil
+import filecmp
 import logging
 from pathlib import Path
 from typing import Callable
@@ -21,3 +23,43 @@ def delete_directory(dir_to_delete: Path):
 def decode_bytes(byte_string: bytes) -> str:
     # Just to consolidate all text decoding and make sure they're all the same
     return byte_string.decode('utf-8', errors='backslashreplace')
+
+
+def atomic_write_text(file_path: Path, text: str):
+    # Replace the file rather than writing into it, so a hard linked file (see ContentStore)
+    # is never modified in place and readers never see a half written file
+    tmp_path = file_path.with_name(file_path.name + '.oatfwgui_tmp')
+    with open(tmp_path, 'w') as fp:
+        fp.write(text)
+    os.replace(tmp_path, file_path)
+
+
+def load_json_index(index_path: Path, index_description: str) -> dict:
+    # A missing or broken index just means starting with an empty one
+    try:
+        with open(index_path, 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        log.warning(f'Could not read {index_description} {index_path}, starting fresh: {e}')
+        return {}
+
+
+def save_json_index(index_path: Path, index: dict):
+    atomic_write_text(index_path, json.dumps(index, indent=2))
+
+
+def copy_file_if_changed(src_path: Path, dest_path: Path) -> bool:
+    """
+    Copy src_path to dest_path, unless dest_path already has the same content. Leaving an
+    identical file alone keeps its mtime, so a build system doesn't think it changed.
+    Returns True if dest_path was written.
+    """
+    if dest_path.is_file() and filecmp.cmp(src_path, dest_path, shallow=False):
+        return False
+    tmp_path = dest_path.with_name(dest_path.name + '.oatfwgui_tmp')
+    # copyfile and not copy2: the destination should get a new mtime, not the source's
+    shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+    return True
@@ -0,0 +1,155 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Any, NamedTuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from _version import __version__
+from external_processes import get_install_dir
+from misc_utils import atomic_write_text
+
+log = logging.getLogger('')
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5.0, 30.0)
+MAX_RETRIES = 3
+
+
+class CachedJsonResponse(NamedTuple):
+    body: Any
+    link: Optional[str]  # the Link header, used for pagination
+
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session() -> requests.Session:
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=0.5,  # 0.5s, 1s, 2s...
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=['GET', 'HEAD'],  # POSTs are only retried if the connection couldn't be made
+        raise_on_status=False,  # hand back the last response, callers check the status code
+    )
+    adapter = HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = f'OATFWGUI/{__version__}'
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    # One keep-alive session per host, so repeated calls reuse the TCP+TLS connection
+    split_url = urlsplit(url)
+    host_key = f'{split_url.scheme}://{split_url.netloc}'
+    with _sessions_lock:
+        if host_key not in _sessions:
+            log.debug(f'Creating HTTP session for {host_key}')
+            _sessions[host_key] = _create_session()
+        return _sessions[host_key]
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    start_time = time.perf_counter()
+    try:
+        r = get_session(url).request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        log.debug(f'{method} {url} failed after {elapsed_ms:.0f}ms: {e}')
+        raise
+    # For streamed responses this is the time until the headers arrived
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    log.debug(f'{method} {url} -> {r.status_code} in {elapsed_ms:.0f}ms')
+    return r
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+def _read_cache_entry(cache_path: Path) -> Optional[dict]:
+    try:
+        with open(cache_path, 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        log.warning(f'Ignoring bad HTTP cache entry {cache_path}: {e}')
+        return None
+
+
+def get_json_cached(url: str, cache_dir: Optional[Path] = None) -> Optional[Any]:
+    cached_response = get_json_cached_response(url, cache_dir)
+    return cached_response.body if cached_response is not None else None
+
+
+def get_json_cached_response(url: str, cache_dir: Optional[Path] = None) -> Optional[CachedJsonResponse]:
+    """
+    GET a JSON API (i.e. the GitHub releases API) through an on-disk cache. The ETag and
+    Last-Modified of the last good response are sent back as a conditional request, and a
+    304 (which GitHub doesn't count against the rate limit) is answered from the cache.
+    If we're offline or rate limited the last good response is returned instead.
+    Returns None if there is neither a good response nor a cached one.
+    """
+    if cache_dir is None:
+        cache_dir = Path(get_install_dir(), '.http_cache')
+    cache_path = Path(cache_dir, f'{hashlib.sha256(url.encode()).hexdigest()[:32]}.json')
+    cache_entry = _read_cache_entry(cache_path)
+
+    def from_cache() -> Optional[CachedJsonResponse]:
+        if cache_entry is None:
+            return None
+        log.info(f'Using cached response for {url}')
+        return CachedJsonResponse(cache_entry['body'], cache_entry.get('link'))
+
+    headers = {}
+    if cache_entry is not None:
+        if cache_entry.get('etag'):
+            headers['If-None-Match'] = cache_entry['etag']
+        if cache_entry.get('last_modified'):
+            headers['If-Modified-Since'] = cache_entry['last_modified']
+
+    try:
+        r = get(url, headers=headers)
+    except requests.exceptions.RequestException as e:
+        log.warning(f'Could not reach {url}: {e}')
+        return from_cache()
+
+    if r.status_code == requests.codes.not_modified and cache_entry is not None:
+        log.debug(f'{url} not modified')
+        return from_cache()
+    if r.status_code != requests.codes.ok:
+        rate_limit_remaining = r.headers.get('X-RateLimit-Remaining')
+        log.error(f'Failed to GET {url}: {r.status_code} {r.reason} {r.text} '
+                  f'(rate limit remaining: {rate_limit_remaining})')
+        return from_cache()
+
+    try:
+        body = r.json()
+    except ValueError as e:
+        log.error(f'Could not decode JSON from {url}: {e}')
+        return from_cache()
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    atomic_write_text(cache_path, json.dumps({
+        'url': url,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'link': r.headers.get('Link'),
+        'body': body,
+    }))
+    return CachedJsonResponse(body, r.headers.get('Link'))
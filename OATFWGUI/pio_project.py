@@ -0,0 +1,179 @@
+import os
+import re
+import logging
+import threading
+import configparser
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Dict, Optional, NamedTuple, Tuple
+
+log = logging.getLogger('')
+
+# ${section.option}, ${this.option}, ${sysenv.NAME}
+INTERPOLATION_RE = re.compile(r'\$\{([^.}\s]+)\.([^}\s]+)\}')
+MAX_INTERPOLATION_DEPTH = 10
+
+
+class PioProjectError(Exception):
+    pass
+
+
+class PioEnvConfig(NamedTuple):
+    name: str
+    platform: Optional[str]
+    board: Optional[str]
+    framework: List[str]
+    lib_deps: List[str]
+    extra_scripts: List[str]
+    build_flags: List[str]
+    upload_protocol: Optional[str]
+    upload_speed: Optional[int]
+    upload_port: Optional[str]
+    upload_flags: List[str]
+
+    @property
+    def is_avr_based(self) -> bool:
+        return self.platform is not None and self.platform.split('@')[0].strip().endswith('atmelavr')
+
+
+def parse_multi_value(value: str) -> List[str]:
+    # Same as platformio: one item per line, or ', ' separated if it's all on one line
+    if '\n' in value.strip():
+        items = value.split('\n')
+    else:
+        items = value.split(', ')
+    return [item.strip() for item in items if item.strip()]
+
+
+class PioProject:
+    """
+    A parsed platformio.ini, resolved the way platformio does it: an [env:NAME] falls back to
+    the sections it `extends`, then to [env], and ${section.option} is interpolated.
+    Use get_pio_project() to share one parse between everything that needs the ini.
+    """
+
+    def __init__(self, ini_text: str):
+        # platformio has its own ${section.option} interpolation, see interpolate()
+        self.config = configparser.ConfigParser(interpolation=None, inline_comment_prefixes=(';',))
+        try:
+            self.config.read_string(ini_text)
+        except configparser.Error as e:
+            raise PioProjectError(f'Could not parse platformio.ini: {e}')
+        self.env_cache: Dict[str, PioEnvConfig] = {}
+
+    @property
+    def env_names(self) -> List[str]:
+        return [s.split(':', maxsplit=1)[1] for s in self.config.sections() if s.startswith('env:')]
+
+    def section_lookup_order(self, section: str, seen: Optional[List[str]] = None) -> List[str]:
+        seen = [] if seen is None else seen
+        if section in seen or not self.config.has_section(section):
+            return []
+        seen.append(section)
+        order = [section]
+        extends = self.config.get(section, 'extends', fallback='')
+        for base_section in parse_multi_value(extends):
+            order += self.section_lookup_order(base_section, seen)
+        return order
+
+    def get_raw(self, section: str, option: str) -> Optional[str]:
+        lookup_order = self.section_lookup_order(section)
+        if section.startswith('env:'):
+            lookup_order.append('env')
+        for lookup_section in lookup_order:
+            if self.config.has_option(lookup_section, option):
+                return self.config.get(lookup_section, option)
+        return None
+
+    def interpolate(self, value: str, section: str, depth: int = 0) -> str:
+        if depth > MAX_INTERPOLATION_DEPTH:
+            raise PioProjectError(f'Too much interpolation (a loop?) in [{section}]: {value}')
+
+        def replace(var_match: re.Match) -> str:
+            ref_section, ref_option = var_match.groups()
+            if ref_section == 'sysenv':
+                return os.environ.get(ref_option, '')
+            if ref_section == 'this':
+                if ref_option == '__env__':
+                    return section.split(':', maxsplit=1)[-1]
+                ref_section = section
+            ref_value = self.get_raw(ref_section, ref_option)
+            if ref_value is None:
+                log.warning(f'platformio.ini: could not resolve {var_match.group(0)} in [{section}]')
+                return ''
+            return self.interpolate(ref_value, ref_section, depth + 1)
+
+        return INTERPOLATION_RE.sub(replace, value)
+
+    def get(self, section: str, option: str) -> Optional[str]:
+        raw_value = self.get_raw(section, option)
+        if raw_value is None:
+            return None
+        return self.interpolate(raw_value, section)
+
+    def get_list(self, section: str, option: str) -> List[str]:
+        value = self.get(section, option)
+        return parse_multi_value(value) if value is not None else []
+
+    def env(self, env_name: str) -> PioEnvConfig:
+        if env_name not in self.env_cache:
+            section = f'env:{env_name}'
+            if not self.config.has_section(section):
+                raise PioProjectError(f'No environment {env_name} in platformio.ini, have {self.env_names}')
+            upload_speed = self.get(section, 'upload_speed')
+            self.env_cache[env_name] = PioEnvConfig(
+                name=env_name,
+                platform=self.get(section, 'platform'),
+                board=self.get(section, 'board'),
+                framework=self.get_list(section, 'framework'),
+                lib_deps=self.get_list(section, 'lib_deps'),
+                extra_scripts=self.get_list(section, 'extra_scripts'),
+                build_flags=self.get_list(section, 'build_flags'),
+                upload_protocol=self.get(section, 'upload_protocol'),
+                upload_speed=int(upload_speed) if upload_speed and upload_speed.isdigit() else None,
+                upload_port=self.get(section, 'upload_port'),
+                upload_flags=self.get_list(section, 'upload_flags'),
+            )
+        return self.env_cache[env_name]
+
+
+class PioProjectCache:
+    """One PioProject per platformio.ini, parsed again only when the file's size/mtime change"""
+
+    def __init__(self):
+        self.projects: Dict[Path, Tuple[Tuple[int, int], PioProject]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, fw_dir: Path) -> PioProject:
+        ini_path = Path(fw_dir, 'platformio.ini').resolve()
+        ini_stat = ini_path.stat()
+        signature = (ini_stat.st_size, ini_stat.st_mtime_ns)
+        with self.lock:
+            cached = self.projects.get(ini_path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            log.debug(f'Parsing {ini_path}')
+            with open(ini_path, 'r') as fp:
+                project = PioProject(fp.read())
+            self.projects[ini_path] = (signature, project)
+            return project
+
+
+@lru_cache(maxsize=1)
+def get_pio_project_cache() -> PioProjectCache:
+    return PioProjectCache()
+
+
+def get_pio_project(fw_dir: Path) -> PioProject:
+    return get_pio_project_cache().get(fw_dir)
+
+
+def pio_env_is_avr_based(fw_dir: Optional[Path], pio_env: Optional[str]) -> bool:
+    # For stupid hot patches and upload flags that only affect AVR based boards :/
+    if fw_dir is None or pio_env is None:
+        return False
+    try:
+        return get_pio_project(fw_dir).env(pio_env).is_avr_based
+    except (PioProjectError, OSError) as e:
+        log.warning(f'Could not tell if {pio_env} is AVR based: {e}')
+        return False
@@ -0,0 +1,100 @@
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from external_processes import get_install_dir
+from pio_project import pio_env_is_avr_based
+from fw_build import do_hot_patches, run_platformio, get_lib_mirror
+
+log = logging.getLogger('')
+
+
+class PackagePrefetcher:
+    """
+    Installs an environment's platform, toolchain and libraries (`pio pkg install`) in the
+    background, as soon as we know which environment will be built. platformio doesn't like
+    two processes installing packages at once, so a build must wait_all() for any install
+    that's still running first (they share one package directory, whichever environment).
+    """
+
+    def __init__(self):
+        self.futures: Dict[Tuple[Path, str], Future] = {}
+        self.installed = set()  # (fw_dir, pio_env, platformio.ini hash) that installed fine
+        self.lock = threading.Lock()
+        # One install at a time, they'd only fight over the package directory
+        self.install_lock = threading.Lock()
+
+    def start(self, fw_dir: Path, pio_env: str, fw_version_name: Optional[str] = None):
+        key = (fw_dir.resolve(), pio_env)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None and not future.done():
+                return
+            log.info(f'Prefetching packages for {pio_env} in the background')
+            future = Future()
+            self.futures[key] = future
+        # Daemon, so closing the window doesn't wait for a download nobody needs any more
+        threading.Thread(target=self._run, args=(future, fw_dir, pio_env, fw_version_name),
+                         name=f'pkg_prefetch_{pio_env}', daemon=True).start()
+
+    def _run(self, future: Future, fw_dir: Path, pio_env: str, fw_version_name: Optional[str]):
+        try:
+            with self.install_lock:
+                future.set_result(self._install(fw_dir, pio_env, fw_version_name))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _install(self, fw_dir: Path, pio_env: str, fw_version_name: Optional[str]) -> bool:
+        # Patch first, the patches pin package versions
+        hot_patch_result = do_hot_patches(fw_dir, pio_env_is_avr_based(fw_dir, pio_env), fw_version_name)
+        installed_key = (fw_dir.resolve(), pio_env, hot_patch_result.ini_sha256)
+        if installed_key in self.installed:
+            log.debug(f'Packages for {pio_env} already installed')
+            return True
+        date_str = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+        log_path = Path(get_install_dir(), 'logs', f'pkg_install_{date_str}_{pio_env}.log')
+        # Libraries come from the local mirror if we have them
+        get_lib_mirror().prepare(fw_dir, pio_env)
+        exit_code = run_platformio(
+            ['pkg', 'install', '--environment', pio_env, '--project-dir', str(fw_dir)], {}, log_path)
+        if exit_code != 0:
+            # Not fatal, the build installs whatever is still missing and reports it properly
+            log.warning(f'Prefetching packages for {pio_env} failed ({exit_code}), see {log_path}')
+            return False
+        log.info(f'Prefetched packages for {pio_env}')
+        get_lib_mirror().store(fw_dir, pio_env)
+        self.installed.add(installed_key)
+        return True
+
+    def wait(self, fw_dir: Path, pio_env: str) -> Optional[bool]:
+        """Wait for a prefetch of this environment to finish. None if there wasn't one."""
+        with self.lock:
+            future = self.futures.get((fw_dir.resolve(), pio_env))
+        if future is None:
+            return None
+        if not future.done():
+            log.info(f'Waiting for the package prefetch of {pio_env} to finish')
+        try:
+            return future.result()
+        except Exception as e:
+            log.warning(f'Prefetching packages for {pio_env} failed: {e}')
+            return False
+
+    def wait_all(self):
+        """Wait until no prefetch is running, including ones started while waiting"""
+        while True:
+            with self.lock:
+                running = [key for key, future in self.futures.items() if not future.done()]
+            if not running:
+                return
+            for fw_dir, pio_env in running:
+                self.wait(fw_dir, pio_env)
+
+
+@lru_cache(maxsize=1)
+def get_pkg_prefetcher() -> PackagePrefetcher:
+    return PackagePrefetcher()
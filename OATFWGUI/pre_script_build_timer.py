@@ -0,0 +1,20 @@
+import os
+import sys
+
+Import("env")
+
+sys.path.insert(0, os.environ['OATFWGUI_SCRIPT_DIR'])
+from scons_launcher import python_script_launcher, prefix_commands
+
+
+def cprint(*args, **kwargs):
+    print(f'pre_script_build_timer.py:', *args, **kwargs)
+
+
+# build_timer.py records how long every compile, archive and link step took
+build_timer = python_script_launcher(env, 'OATFWGUI_BUILD_TIMER')
+if build_timer:
+    cprint(f'Timing build steps with {build_timer}')
+    prefix_commands(env, 'OATFWGUI_BUILD_TIMER_LAUNCHER', build_timer, ['CCCOM', 'CXXCOM', 'ARCOM', 'LINKCOM'])
+else:
+    cprint('Build timer not found, not profiling')
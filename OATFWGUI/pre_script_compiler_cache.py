@@ -0,0 +1,31 @@
+import os
+import sys
+
+Import("env")
+
+sys.path.insert(0, os.environ['OATFWGUI_SCRIPT_DIR'])
+from scons_launcher import python_script_launcher, prefix_commands
+
+
+def cprint(*args, **kwargs):
+    print(f'pre_script_compiler_cache.py:', *args, **kwargs)
+
+
+def get_compiler_launcher(env) -> list:
+    """
+    Prefer a real ccache if it's installed, otherwise use our own (slower, but good enough)
+    compiler_cache.py. Both are told where the cache is and where to log hits/misses
+    through environment variables set by OATFWGUI.
+    """
+    ccache_path = env.WhereIs('ccache')
+    if ccache_path:
+        return [ccache_path]
+    return python_script_launcher(env, 'OATFWGUI_COMPILER_CACHE_WRAPPER')
+
+
+compiler_launcher = get_compiler_launcher(env)
+if compiler_launcher:
+    cprint(f'Compiling through {compiler_launcher}')
+    prefix_commands(env, 'OATFWGUI_COMPILER_LAUNCHER', compiler_launcher, ['CCCOM', 'CXXCOM'])
+else:
+    cprint('No compiler cache available')
@@ -1,4 +1,5 @@
 import sys
+import inspect
 import traceback
 import logging
 from typing import Optional
@@ -13,6 +14,7 @@ class WorkerSignals(QObject):
     finished = Signal()
     error = Signal(tuple)
     result = Signal(object)
+    partial_result = Signal(object)
     progress = Signal(int)
 
 
@@ -25,8 +27,11 @@ class Worker(QRunnable):
         self.kwargs = kwargs
         self.signals = WorkerSignals()
 
-        # Add the callback to our kwargs
-        # self.kwargs['progress_callback'] = self.signals.progress
+        # Add the callback to our kwargs, if the function wants it
+        if 'progress_callback' in inspect.signature(fn).parameters:
+            self.kwargs['progress_callback'] = self.signals.progress.emit
+        if 'partial_result_callback' in inspect.signature(fn).parameters:
+            self.kwargs['partial_result_callback'] = self.signals.partial_result.emit
 
     @Slot()
     def run(self):
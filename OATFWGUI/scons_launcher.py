@@ -0,0 +1,22 @@
+"""
+Helpers for the pre_script_*.py files, which platformio runs as SCons scripts. Those can't
+import each other by themselves, OATFWGUI puts this directory in OATFWGUI_SCRIPT_DIR.
+"""
+import os
+
+
+def python_script_launcher(env, script_path_env: str) -> list:
+    """`<platformio's python> <script>` for the script in the script_path_env environment variable"""
+    script_path = os.environ.get(script_path_env)
+    if not script_path or not os.path.isfile(script_path):
+        return []
+    return [env.subst('$PYTHONEXE'), script_path]
+
+
+def prefix_commands(env, launcher_var: str, launcher: list, com_vars: list):
+    """Run the com_vars commands (i.e. CCCOM) through launcher"""
+    # A list, so that SCons quotes each part if it has spaces in it
+    env[launcher_var] = launcher
+    for com_var in com_vars:
+        if com_var in env:
+            env[com_var] = f'${launcher_var} ' + env[com_var]
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from background_cleanup import tombstone_directory
+from misc_utils import delete_directory, load_json_index, save_json_index
+
+log = logging.getLogger('')
+
+PIO_CORE_PREFIX = '.pioOATFWGUI'
+# Disk budget for all platformio core directories together, override with OATFWGUI_TOOLCHAIN_BUDGET_MB
+DEFAULT_TOOLCHAIN_BUDGET_MB = 6 * 1024
+# Sub directories of a core directory holding installed packages
+PACKAGE_DIR_NAMES = ['packages', 'platforms']
+
+
+def get_toolchain_budget_bytes() -> int:
+    budget_mb_str = os.environ.get('OATFWGUI_TOOLCHAIN_BUDGET_MB', '')
+    if budget_mb_str.isdigit():
+        return int(budget_mb_str) * 1024 * 1024
+    return DEFAULT_TOOLCHAIN_BUDGET_MB * 1024 * 1024
+
+
+def package_key(package_dir: Path) -> Optional[str]:
+    # platformio writes a .piopm manifest (name, version, spec) into every installed package
+    manifest_path = Path(package_dir, '.piopm')
+    try:
+        manifest_bytes = manifest_path.read_bytes()
+    except OSError:
+        return None
+    try:
+        manifest = json.loads(manifest_bytes)
+        name_version = f'{manifest["name"]}@{manifest["version"]}'
+    except (ValueError, KeyError, TypeError):
+        name_version = package_dir.name
+    return f'{name_version}:{hashlib.sha256(manifest_bytes).hexdigest()[:16]}'
+
+
+def dir_size(dir_path: Path) -> int:
+    total_bytes = 0
+    for sub_dir, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            try:
+                total_bytes += os.lstat(os.path.join(sub_dir, file_name)).st_size
+            except OSError:
+                pass
+    return total_bytes
+
+
+def link_tree(src_dir: Path, dest_dir: Path):
+    def link_or_copy(src: str, dest: str):
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+    shutil.copytree(src_dir, dest_dir, symlinks=True, copy_function=link_or_copy)
+
+
+class ToolchainStore:
+    """
+    PlatformIO core directories (toolchains, platforms, frameworks) shared between OATFWGUI
+    versions. There is one core directory per PlatformIO version instead of one per OATFWGUI
+    version, so upgrading OATFWGUI doesn't re-download hundreds of MB of toolchains.
+    A new core directory is seeded with hard links to the packages of the most recently
+    used one, so identical packages only take up disk space once. The index counts which
+    core directories reference each package, and least recently used core directories are
+    evicted when the total goes over the disk budget.
+    """
+
+    def __init__(self, root_dir: Path, budget_bytes: Optional[int] = None):
+        self.root_dir = root_dir
+        self.budget_bytes = budget_bytes if budget_bytes is not None else get_toolchain_budget_bytes()
+        self.index_path = Path(root_dir, f'{PIO_CORE_PREFIX}_store.json')
+        self.index = self._load_index()
+
+    def _load_index(self) -> dict:
+        index = load_json_index(self.index_path, 'toolchain store index')
+        index.setdefault('cores', {})
+        index.setdefault('packages', {})
+        index['cores'] = {
+            name: entry for name, entry in index['cores'].items()
+            if Path(self.root_dir, name).is_dir()
+        }
+        return index
+
+    def _save_index(self):
+        save_json_index(self.index_path, self.index)
+
+    @staticmethod
+    def core_dir_name(pio_version: str) -> str:
+        return f'{PIO_CORE_PREFIX}_pio{pio_version}'
+
+    def managed_core_dir_names(self) -> List[str]:
+        return list(self.index['cores'])
+
+    def get_core_dir(self, pio_version: str) -> Path:
+        name = self.core_dir_name(pio_version)
+        core_dir = Path(self.root_dir, name)
+        if not core_dir.is_dir() and not self._adopt_legacy_core_dir(core_dir):
+            core_dir.mkdir(parents=True)
+            self._seed_core_dir(core_dir)
+        self.index['cores'][name] = {
+            'pio_version': pio_version,
+            'last_used': time.time(),
+        }
+        self._save_index()
+        return core_dir
+
+    def _adopt_legacy_core_dir(self, core_dir: Path) -> bool:
+        # Older OATFWGUI versions had a core directory per OATFWGUI version, reuse the newest one
+        if self.index['cores']:
+            return False
+        legacy_core_dirs = [
+            p for p in self.root_dir.glob(f'{PIO_CORE_PREFIX}*')
+            if p.is_dir() and not p.name.startswith(f'{PIO_CORE_PREFIX}_')
+        ]
+        if not legacy_core_dirs:
+            return False
+        newest_legacy_core_dir = max(legacy_core_dirs, key=lambda p: p.stat().st_mtime)
+        log.info(f'Adopting {newest_legacy_core_dir} as {core_dir}')
+        try:
+            newest_legacy_core_dir.rename(core_dir)
+        except OSError as e:
+            log.warning(f'Could not adopt {newest_legacy_core_dir}: {e}')
+            return False
+        return True
+
+    def _seed_core_dir(self, core_dir: Path):
+        other_cores = sorted(
+            (name for name in self.index['cores'] if name != core_dir.name),
+            key=lambda n: self.index['cores'][n]['last_used'],
+            reverse=True,
+        )
+        if not other_cores:
+            return
+        seed_core_dir = Path(self.root_dir, other_cores[0])
+        log.info(f'Seeding {core_dir} with packages from {seed_core_dir}')
+        for package_dir_name in PACKAGE_DIR_NAMES:
+            seed_package_dir = Path(seed_core_dir, package_dir_name)
+            if seed_package_dir.is_dir():
+                link_tree(seed_package_dir, Path(core_dir, package_dir_name))
+
+    def _core_packages(self, core_name: str) -> Dict[str, Path]:
+        core_packages = {}
+        for package_dir_name in PACKAGE_DIR_NAMES:
+            packages_dir = Path(self.root_dir, core_name, package_dir_name)
+            if not packages_dir.is_dir():
+                continue
+            for package_dir in packages_dir.iterdir():
+                key = package_key(package_dir)
+                if key is not None:
+                    core_packages[key] = package_dir
+        return core_packages
+
+    def refresh(self, active_core_name: Optional[str] = None):
+        """
+        Recount package references, deduplicating identical packages installed separately.
+        Packages of active_core_name are never replaced (platformio may be using them right
+        now), they are what the other core directories get relinked to.
+        """
+        packages: Dict[str, dict] = {}
+        first_seen: Dict[str, Path] = {}
+        core_names = sorted(self.index['cores'], key=lambda n: n != active_core_name)
+        for core_name in core_names:
+            for key, package_dir in self._core_packages(core_name).items():
+                if key not in packages:
+                    old_entry = self.index['packages'].get(key, {})
+                    size = old_entry.get('size') or dir_size(package_dir)
+                    packages[key] = {'cores': [], 'size': size}
+                    first_seen[key] = package_dir
+                elif core_name != active_core_name \
+                        and not Path(package_dir, '.piopm').samefile(Path(first_seen[key], '.piopm')):
+                    log.info(f'Deduplicating {key} in {core_name}')
+                    tmp_package_dir = package_dir.with_name(package_dir.name + '.oatfwgui_tmp')
+                    link_tree(first_seen[key], tmp_package_dir)
+                    tombstone = tombstone_directory(package_dir, tombstone_parent=self.root_dir)
+                    if tombstone is not None:
+                        tmp_package_dir.rename(package_dir)
+                    else:
+                        delete_directory(tmp_package_dir)
+                packages[key]['cores'].append(core_name)
+        self.index['packages'] = packages
+        self._save_index()
+
+    def total_bytes(self) -> int:
+        # Hard linked packages only count once
+        return sum(entry['size'] for entry in self.index['packages'].values())
+
+    def evict(self, keep_core_name: str) -> List[str]:
+        """Tombstone least recently used core directories until the store is under budget"""
+        evicted = []
+        lru_core_names = sorted(self.index['cores'], key=lambda n: self.index['cores'][n]['last_used'])
+        for core_name in lru_core_names:
+            total_bytes = self.total_bytes()
+            if total_bytes <= self.budget_bytes:
+                break
+            if core_name == keep_core_name:
+                continue
+            log.info(f'Toolchain store is {total_bytes / 1e6:.0f}MB (budget {self.budget_bytes / 1e6:.0f}MB), '
+                     f'evicting {core_name}')
+            if tombstone_directory(Path(self.root_dir, core_name)) is None:
+                continue
+            del self.index['cores'][core_name]
+            for key in list(self.index['packages']):
+                package_entry = self.index['packages'][key]
+                if core_name in package_entry['cores']:
+                    package_entry['cores'].remove(core_name)
+                if not package_entry['cores']:
+                    # Last reference gone, the space is actually freed
+                    del self.index['packages'][key]
+            evicted.append(core_name)
+        self._save_index()
+        return evicted
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The OATFWGUI modules import each other as top level modules, same as when running main.py
+sys.path.insert(0, str(Path(__file__).parent.parent / 'OATFWGUI'))
@@ -0,0 +1,88 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+import network
+from fw_releases import list_fw_releases
+
+# Deliberately not in order, the pages have to be merged and sorted
+RELEASE_PAGES = {
+    1: ['V1.9.0', 'V1.13.2'],
+    2: ['V1.10.0', 'nightly'],
+    3: ['V1.13.14'],
+}
+
+
+def release_json(tag_name: str) -> dict:
+    return {
+        'name': tag_name,
+        'tag_name': tag_name,
+        'zipball_url': f'https://example.com/{tag_name}.zip',
+    }
+
+
+class ReleasesHandler(BaseHTTPRequestHandler):
+    """Paginates like the GitHub releases API, with a Link header pointing at the next/last page"""
+
+    def do_GET(self):
+        split_url = urlsplit(self.path)
+        page = int(parse_qs(split_url.query).get('page', ['1'])[0])
+        if page not in RELEASE_PAGES:
+            self.send_error(404)
+            return
+        base_url = f'http://{self.headers["Host"]}{split_url.path}'
+        last_page = max(RELEASE_PAGES)
+        links = []
+        if page < last_page:
+            links.append(f'<{base_url}?per_page=100&page={page + 1}>; rel="next"')
+        links.append(f'<{base_url}?per_page=100&page={last_page}>; rel="last"')
+        body = json.dumps([release_json(t) for t in RELEASE_PAGES[page]]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Link', ', '.join(links))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def releases_api_url(tmp_path, monkeypatch):
+    # Keep the HTTP cache out of the install directory
+    monkeypatch.setattr(network, 'get_install_dir', lambda: tmp_path)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReleasesHandler)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/repos/OpenAstroTech/OpenAstroTracker-Firmware/releases'
+    server.shutdown()
+    server.server_close()
+
+
+def test_all_pages_merged_and_sorted(releases_api_url):
+    fw_versions = list_fw_releases(releases_api_url)
+    assert [v.nice_name for v in fw_versions] == ['V1.13.14', 'V1.13.2', 'V1.10.0', 'V1.9.0', 'nightly']
+    assert fw_versions[0].url == 'https://example.com/V1.13.14.zip'
+
+
+def test_partial_result_per_page(releases_api_url):
+    partial_results = []
+    fw_versions = list_fw_releases(releases_api_url, page_callback=partial_results.append)
+    # One partial result per page, each one sorted and a superset of the previous one
+    assert len(partial_results) == len(RELEASE_PAGES)
+    assert [len(r) for r in partial_results] == sorted(len(r) for r in partial_results)
+    assert [v.nice_name for v in partial_results[0]] == ['V1.13.2', 'V1.9.0']
+    assert partial_results[-1] == fw_versions
+
+
+def test_offline_uses_cache(releases_api_url, monkeypatch):
+    fw_versions = list_fw_releases(releases_api_url)
+
+    def offline(*args, **kwargs):
+        raise network.requests.exceptions.ConnectionError('offline')
+    monkeypatch.setattr(network, 'get', offline)
+    assert list_fw_releases(releases_api_url) == fw_versions